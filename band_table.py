@@ -0,0 +1,223 @@
+from typing import Any, Dict, Iterator, Literal, Optional, Tuple, Union
+
+import numpy as np
+
+from utils import determine_scaling
+
+SCALINGS = ('none', 'lower', 'upper', 'both')
+# low, high and heavy outliers, zeroes, events and baseline samples
+COUNT_COLUMNS = (
+    'low_outs', 'high_outs', 'heavy_outs', 'zeroes', 'events', 'baseline'
+)
+
+Scaling = Literal['none', 'lower', 'upper', 'both']
+BandKey = Tuple[int, Scaling, Union[float, int], Union[float, int]]
+
+
+def count_densities(
+    counts: np.ndarray,
+    key: Literal['outlier', 'zeroes', 'events', 'baseline'] = 'events'
+) -> np.ndarray:
+    # vectorised utils.event_density over the last axis of band counts
+    # in COUNT_COLUMNS order, NaN where nothing was counted
+    low, high, heavy, zeroes, events, baseline = np.moveaxis(counts, -1, 0)
+    run_length = low + high + heavy + zeroes + events + baseline
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if key == 'outlier':
+            return heavy / run_length
+        if key == 'zeroes':
+            return zeroes / run_length
+        return {'events': events, 'baseline': baseline}[key] \
+            / (run_length - zeroes - heavy)
+
+
+class BandTable:
+    # Band distributions of an experiment, one row per channel and band
+    # configuration, stored column wise. The scaling code also tells whether
+    # the event bounds are absolute (int, pA) or relative (float), so the
+    # original keys are restored exactly.
+
+    def __init__(
+        self, channel: np.ndarray, scaling: np.ndarray,
+        event_low: np.ndarray, event_high: np.ndarray,
+        baseline: np.ndarray, counts: np.ndarray
+    ) -> None:
+        self.channel = np.asarray(channel, dtype=np.int16)
+        self.scaling = np.asarray(scaling, dtype=np.uint8)
+        self.event_low = np.asarray(event_low, dtype=np.float64)
+        self.event_high = np.asarray(event_high, dtype=np.float64)
+        self.baseline = np.asarray(baseline, dtype=np.int32)
+        self.counts = np.asarray(counts, dtype=np.int64).reshape(
+            -1, len(COUNT_COLUMNS)
+        )
+
+    @classmethod
+    def empty(cls) -> 'BandTable':
+        return cls([], [], [], [], [], [])
+
+    @classmethod
+    def from_band_distribution(
+        cls, band_distribution: Dict[int, Dict[str, Dict[Tuple, Any]]]
+    ) -> 'BandTable':
+        # from the nested {channel -> {scaling -> {bounds -> (bl, band)}}}
+        rows = [
+            (channel, SCALINGS.index(scaling), low, high, baseline,
+             [*band['outlier'], band['zeroes'], band['events'],
+              band['baseline']])
+            for channel, scalings in band_distribution.items()
+            for scaling, bands in scalings.items()
+            for (low, high), (baseline, band) in bands.items()
+        ]
+        if not rows:
+            return cls.empty()
+        return cls(*(list(col) for col in zip(*rows)))
+
+    def __len__(self) -> int:
+        return len(self.channel)
+
+    def _take(self, mask: np.ndarray) -> 'BandTable':
+        return BandTable(
+            self.channel[mask], self.scaling[mask], self.event_low[mask],
+            self.event_high[mask], self.baseline[mask], self.counts[mask]
+        )
+
+    def _bounds_mask(
+        self, event_low: Union[float, int], event_high: Union[float, int]
+    ) -> np.ndarray:
+        code = SCALINGS.index(determine_scaling(event_low, event_high))
+        return (self.scaling == code) & (self.event_low == event_low) \
+            & (self.event_high == event_high)
+
+    # ################ Updates ################################################
+    def update(self, other: 'BandTable') -> 'BandTable':
+        # rows of other replace rows with the same key, like deep_update
+        keep = np.ones(len(self), dtype=bool)
+        for code, low, high in {
+            (int(s), float(lo), float(hi)) for s, lo, hi
+            in zip(other.scaling, other.event_low, other.event_high)
+        }:
+            same = (other.scaling == code) & (other.event_low == low) \
+                & (other.event_high == high)
+            keep &= ~(
+                (self.scaling == code) & (self.event_low == low)
+                & (self.event_high == high)
+                & np.isin(self.channel, other.channel[same])
+            )
+        return BandTable(*(
+            np.concatenate((mine[keep], theirs)) for mine, theirs in zip(
+                self._columns(), other._columns()
+            )
+        ))
+
+    def _columns(self) -> Tuple[np.ndarray, ...]:
+        return (
+            self.channel, self.scaling, self.event_low, self.event_high,
+            self.baseline, self.counts
+        )
+
+    # ################ Queries ################################################
+    def select(
+        self, event_low: Union[float, int], event_high: Union[float, int]
+    ) -> 'BandTable':
+        return self._take(self._bounds_mask(event_low, event_high))
+
+    def channels(self) -> np.ndarray:
+        return np.unique(self.channel)
+
+    def has_bounds(
+        self, event_low: Union[float, int], event_high: Union[float, int]
+    ) -> bool:
+        # for all channels
+        return self._select_complete(event_low, event_high) is not None
+
+    def _select_complete(
+        self, event_low: Union[float, int], event_high: Union[float, int]
+    ) -> Optional['BandTable']:
+        # rows of the bounds if every channel has them, a channel without
+        # failed the lookups of the former nested dicts
+        table = self.select(event_low, event_high)
+        if len(table) == 0 or len(table) < len(self.channels()):
+            return None
+        return table
+
+    def lookup(
+        self, channel: int,
+        event_low: Optional[Union[float, int]] = None,
+        event_high: Optional[Union[float, int]] = None
+    ) -> Optional[Tuple[int, Dict[str, Any]]]:
+        # (baseline, band) of a channel, any bounds if none are given
+        mask = self.channel == channel
+        if event_low is not None:
+            mask &= self._bounds_mask(event_low, event_high)
+        if not np.any(mask):
+            return None
+        row = int(np.argmax(mask))
+        return int(self.baseline[row]), self._band(row)
+
+    def _band(self, row: int) -> Dict[str, Any]:
+        counts = [int(val) for val in self.counts[row]]
+        return {
+            'outlier': tuple(counts[:3]),
+            'zeroes': counts[3],
+            'events': counts[4],
+            'baseline': counts[5],
+        }
+
+    def _bounds(self, row: int) -> Tuple[Union[float, int], ...]:
+        scaling = SCALINGS[self.scaling[row]]
+        low, high = float(self.event_low[row]), float(self.event_high[row])
+        if scaling in ('none', 'upper'):
+            low = int(low)
+        if scaling in ('none', 'lower'):
+            high = int(high)
+        return low, high
+
+    def rows(self) -> Iterator[Tuple[BandKey, int, Dict[str, Any]]]:
+        for row in np.argsort(self.channel, kind='stable'):
+            yield (
+                (int(self.channel[row]), SCALINGS[self.scaling[row]],
+                 *self._bounds(row)),
+                int(self.baseline[row]), self._band(row)
+            )
+
+    def to_band_distribution(self) -> Dict[int, Dict[str, Dict[Tuple, Any]]]:
+        nested = {}
+        for (channel, scaling, low, high), baseline, band in self.rows():
+            nested.setdefault(channel, {}).setdefault(scaling, {})[
+                (low, high)
+            ] = (baseline, band)
+        return nested
+
+    # ################ Aggregates #############################################
+    def densities(
+        self, key: Literal['outlier', 'zeroes', 'events', 'baseline'] =
+        'events'
+    ) -> np.ndarray:
+        return count_densities(self.counts, key)
+
+    def mad_mask(self) -> np.ndarray:
+        # channels with a baseline within 3 median absolute deviations
+        deviation = np.abs(self.baseline - np.median(self.baseline))
+        return deviation < 3 * np.median(deviation)
+
+    def mean_events(
+        self, event_low: Union[float, int], event_high: Union[float, int],
+        filter_mad: bool = True
+    ) -> Optional[Tuple[float, float]]:
+        if (table := self._select_complete(event_low, event_high)) is None:
+            return None
+        events = table.densities()
+        if filter_mad:
+            events = events[table.mad_mask()]
+        return (round(np.mean(events), 4), round(np.std(events), 3))
+
+    def mean_baselines(
+        self, event_low: Union[float, int], event_high: Union[float, int],
+        filter_mad: bool = True
+    ) -> Optional[Tuple[float, float]]:
+        if (table := self._select_complete(event_low, event_high)) is None:
+            return None
+        baselines = table.baseline
+        if filter_mad:
+            baselines = baselines[table.mad_mask()]
+        return (round(np.mean(baselines), 2), round(np.std(baselines), 3))
@@ -0,0 +1,184 @@
+import argparse
+import csv
+import glob
+import os
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+from context import Context, DEFAULT_SETTINGS
+from experiment import Experiment
+import instrumentation
+from utils import event_density
+
+# Headless processing of whole directories of bulk files, must not import
+# dearpygui (directly or through any of the gui modules).
+
+
+def find_bulk_files(patterns: Iterable[str]) -> List[str]:
+    # directories contribute their .fast5 files, anything else is a glob
+    files = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "*.fast5")
+        files.extend(sorted(glob.glob(pattern, recursive=True)))
+    return list(dict.fromkeys(os.path.abspath(f) for f in files))
+
+
+def channel_rows(
+    exp: Experiment, settings: Dict[str, Any]
+) -> List[Dict[str, Any]]:
+    bands = exp.band_table.select(
+        settings['min_event_band'], settings['max_event_band']
+    )
+    rows = []
+    for (channel, *_), baseline, band in bands.rows():
+        low_outs, high_outs, heavy_outs = band['outlier']
+        rows.append({
+            'name': exp.name,
+            'hash': exp.get_hash(),
+            'concentration': exp.properties.get('concentration'),
+            'channel': channel,
+            'baseline': baseline,
+            'event_density': event_density(band),
+            'baseline_density': event_density(band, 'baseline'),
+            'zeroes_density': event_density(band, 'zeroes'),
+            'events': band['events'],
+            'baseline_samples': band['baseline'],
+            'zeroes': band['zeroes'],
+            'low_outliers': low_outs,
+            'high_outliers': high_outs,
+            'heavy_outliers': heavy_outs,
+        })
+    return rows
+
+
+def experiment_row(
+    exp: Experiment, settings: Dict[str, Any]
+) -> Dict[str, Any]:
+    min_ev = settings['min_event_band']
+    max_ev = settings['max_event_band']
+    nan = float('nan')
+    mean_ev, sd_ev = exp.get_mean_events(min_ev, max_ev) or (nan, nan)
+    mean_bl, sd_bl = exp.get_mean_baselines(min_ev, max_ev) or (nan, nan)
+    return {
+        'name': exp.name,
+        'path': exp.path,
+        'hash': exp.get_hash(),
+        'concentration': exp.properties.get('concentration'),
+        'buffer': exp.properties.get('buffer', False),
+        'active_channels': len(exp.get_active_channels() or []),
+        'min_event_band': min_ev,
+        'max_event_band': max_ev,
+        'mean_event_density': mean_ev,
+        'sd_event_density': sd_ev,
+        'mean_baseline': mean_bl,
+        'sd_baseline': sd_bl,
+    }
+
+
+def write_table(rows: List[Dict[str, Any]], fpath: Path) -> None:
+    if fpath.suffix == ".parquet":
+        # optional, only needed for parquet output
+        import pandas as pd
+        pd.DataFrame(rows).to_parquet(fpath, index=False)
+        return
+    with open(fpath, 'w', newline='') as fh:
+        writer = csv.DictWriter(
+            fh, fieldnames=list(rows[0].keys()) if rows else []
+        )
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def _parse_args(argv: Optional[List[str]]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="nanotrace batch",
+        description=(
+            "Detect active channels and compute band distributions of bulk "
+            "files with the settings stored in the experiment database."
+        )
+    )
+    parser.add_argument(
+        "paths", nargs="+",
+        help="directories, bulk files or glob patterns (quoted)"
+    )
+    parser.add_argument(
+        "--db", help="experiment database, created if it does not exist"
+    )
+    parser.add_argument(
+        "--out",
+        help=(
+            "per channel result table (.csv or .parquet), the per "
+            "experiment summary is written to <name>_experiments.<ext>"
+        )
+    )
+    parser.add_argument(
+        "--workers", type=int,
+        help="scan worker processes, defaults to the database setting"
+    )
+    parser.add_argument(
+        "--profile", action="store_true",
+        help=(
+            "log stage timings to "
+            f"{instrumentation.DEFAULT_LOG_PATH} (json lines)"
+        )
+    )
+    return parser.parse_args(argv)
+
+
+def run_batch(argv: Optional[List[str]] = None) -> int:
+    args = _parse_args(argv)
+    if not (files := find_bulk_files(args.paths)):
+        print(f"No bulk files found for {args.paths}")
+        return 1
+    instrumentation.configure(args.profile)
+
+    context = Context()
+    if args.db and Path(args.db).is_file():
+        context.update_experiment_db(args.db, dump_first=False)
+    elif args.db:
+        context.experiment_db = args.db
+    # keep defaults for settings unknown to (or missing from) the database
+    context.settings = {**DEFAULT_SETTINGS, **context.settings}
+    if args.workers is not None:
+        context.settings['scan_workers'] = args.workers
+
+    exps = []
+    for count, fpath in enumerate(files, start=1):
+        print(f"[{count}/{len(files)}] {fpath}")
+        try:
+            context.update_context(fpath, hash_in_background=False)
+        except Exception as e:
+            print(e)
+            continue
+        # copies of a file share their experiment
+        if context.active_exp not in exps:
+            exps.append(context.active_exp)
+
+    # (file, channel) pairs of all files are balanced over the workers,
+    # results are written to the database as each file completes
+    status = 0
+    try:
+        context.calculate_experiments(exps)
+    except Exception as e:
+        # completed files are stored, the others keep no results
+        print(e)
+        status = 1
+    if context.scan_stats is not None:
+        print(context.scan_stats)
+    for exp in exps:
+        print(f"{exp.name}: {len(exp.get_active_channels() or [])} active")
+    context._dump_exps()
+
+    if args.out:
+        out = Path(args.out)
+        rows = [
+            row for exp in exps for row in channel_rows(exp, context.settings)
+        ]
+        write_table(rows, out)
+        write_table(
+            [experiment_row(exp, context.settings) for exp in exps],
+            out.with_name(f"{out.stem}_experiments{out.suffix}")
+        )
+        print(f"Wrote {len(rows)} channels of {len(exps)} files to {out}")
+    return status
@@ -0,0 +1,296 @@
+import argparse
+from dataclasses import asdict, dataclass
+import json
+import os
+from pathlib import Path
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from fast5_research.fast5_bulk import BulkFast5
+
+from context import Context, DEFAULT_SETTINGS
+from experiment import Experiment
+from fingerprint import get_fingerprint, hash_file
+from kde import normal_reference_bw
+from kde_cache import KdeCache
+from probe import probe_channel
+from synthetic import write_bulk_file
+import utils
+
+# Reproducible timings of the expensive stages on synthetic bulk files.
+# Results are written as JSON, compare two runs with --compare.
+
+
+@dataclass
+class StageResult:
+    wall_time: float
+    peak_mb: float
+    # processed samples (or bytes for hashing) per second, if meaningful
+    throughput: Optional[float] = None
+    unit: Optional[str] = None
+    extra: Optional[Dict[str, Any]] = None
+
+
+def measure(
+    func: Callable[[], Any], repeat: int = 1
+) -> Tuple[Any, float, float]:
+    # best wall time of repeat runs, peak python/numpy allocation in MiB
+    best, peak, result = float('inf'), 0.0, None
+    for _ in range(repeat):
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+        peak = max(peak, tracemalloc.get_traced_memory()[1] / 2**20)
+        tracemalloc.stop()
+    return result, best, peak
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+            cwd=Path(__file__).parent, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(
+    workdir: Path, channels: int, length: int, repeat: int, workers: int
+) -> Dict[str, Any]:
+    fpath = str(workdir / "synthetic_1nM.fast5")
+    write_bulk_file(fpath, channels=channels, length=length, seed=0)
+    burnin = DEFAULT_SETTINGS['burnin']
+    samples = channels * max(0, length - burnin)
+    results: Dict[str, StageResult] = {}
+
+    # channel scan: activity, baselines and histograms in one read
+    stats = utils.ScanStats()
+    histograms, wall, peak = measure(
+        lambda: utils.get_channel_histograms(
+            fpath, burnin, stats=stats, workers=workers
+        ), repeat
+    )
+    results['scan'] = StageResult(
+        wall, peak, samples / wall, "samples/s",
+        {'active': len(histograms), 'workers': workers}
+    )
+
+    _, wall, peak = measure(
+        lambda: utils.get_band_distributions(histograms, 0.27, 0.48), repeat
+    )
+    results['bands'] = StageResult(wall, peak)
+    results.update(
+        _probe_benchmarks(workdir, channels, length, repeat, workers)
+    )
+
+    # hashing: fingerprint on open and the full hash in the background
+    size = os.path.getsize(fpath)
+    _, wall, peak = measure(lambda: get_fingerprint(fpath), repeat)
+    results['fingerprint'] = StageResult(wall, peak)
+    file_hash, wall, peak = measure(lambda: hash_file(fpath), repeat)
+    results['hash'] = StageResult(wall, peak, size / wall, "bytes/s")
+
+    # plots need the gui modules, dearpygui is imported but not started
+    context = Context(settings=dict(DEFAULT_SETTINGS))
+    exp = Experiment(
+        Path(fpath).name, fpath, {'blake2b': file_hash},
+        utils.parse_exp_name(Path(fpath).name)
+    )
+    exp.histograms = histograms
+    context.exps[exp.get_hash()] = exp
+    context.active_exp = exp
+    context._kde_cache = KdeCache(workdir / "kde_cache")
+    results.update(_plot_benchmarks(context, histograms, samples, repeat))
+
+    # database: write all results, reopen and load the experiment lazily
+    context.calculate_band_distributions()
+    db_path = workdir / "bench.db"
+    context.experiment_db = str(db_path)
+    _, wall, peak = measure(context._dump_exps)
+    results['db_save'] = StageResult(
+        wall, peak, extra={'bytes': os.path.getsize(db_path)}
+    )
+
+    def _load():
+        loaded = Context(str(db_path))
+        return loaded.exps[exp.get_hash()].band_distribution
+
+    _, wall, peak = measure(_load, repeat)
+    results['db_load'] = StageResult(wall, peak)
+    context.exps.close()
+
+    return {
+        'meta': {
+            'commit': _git_commit(),
+            'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'channels': channels,
+            'length': length,
+            'repeat': repeat,
+        },
+        'results': {name: asdict(res) for name, res in results.items()},
+    }
+
+
+def _probe_benchmarks(
+    workdir: Path, channels: int, length: int, repeat: int, workers: int
+) -> Dict[str, StageResult]:
+    # Scan with and without the activity probe on a file with many dead
+    # and some saturated channels. The probe has to agree with the
+    # activity of the full read: no channel it calls dead may be active,
+    # none it calls active inactive, and the histograms must be the same.
+    fpath = str(workdir / "synthetic_probe.fast5")
+    write_bulk_file(
+        fpath, channels=channels, length=length, dead_channels=0.4, seed=1,
+        saturated_channels=range(1, channels + 1, 20)
+    )
+    burnin = DEFAULT_SETTINGS['burnin']
+    margin = DEFAULT_SETTINGS['probe_margin']
+    samples = channels * max(0, length - burnin)
+    results: Dict[str, StageResult] = {}
+
+    full, wall, peak = measure(
+        lambda: utils.get_channel_histograms(fpath, burnin, workers=workers),
+        repeat
+    )
+    results['scan_unprobed'] = StageResult(
+        wall, peak, samples / wall, "samples/s"
+    )
+    probed, wall, peak = measure(
+        lambda: utils.get_channel_histograms(
+            fpath, burnin, workers=workers, probe_margin=margin
+        ), repeat
+    )
+
+    with BulkFast5(fpath) as fh:
+        states = {
+            c: probe_channel(fh, c, burnin, margin).state
+            for c in range(1, channels + 1)
+        }
+    disagreements = [
+        c for c, state in states.items()
+        if state == 'dead' and c in full
+        or state == 'active' and c not in full
+    ]
+    same = list(probed) == list(full) and all(
+        np.array_equal(probed[c].counts, full[c].counts)
+        and probed[c].baseline == full[c].baseline
+        for c in full
+    )
+    results['scan_probed'] = StageResult(
+        wall, peak, samples / wall, "samples/s", {
+            'margin': margin,
+            **{
+                state: sum(s == state for s in states.values())
+                for state in ('dead', 'active', 'uncertain')
+            },
+            'disagreements': disagreements,
+            'same_histograms': same,
+        }
+    )
+    return results
+
+
+def _plot_benchmarks(
+    context: Context, histograms: Dict, samples: int, repeat: int
+) -> Dict[str, StageResult]:
+    from series_plots import _get_kdes, _get_series_data
+
+    results = {}
+    channels = sorted(histograms)
+    kdes, wall, peak = measure(lambda: _get_kdes(context, channels))
+    results['kde_cold'] = StageResult(
+        wall, peak, samples / wall, "samples/s", {'channels': len(channels)}
+    )
+    _, wall, peak = measure(lambda: _get_kdes(context, channels), repeat)
+    results['kde_cached'] = StageResult(wall, peak)
+    if (agreement := _kde_agreement(histograms, channels, kdes)) is not None:
+        results['kde_cold'].extra['max_rel_deviation'] = agreement
+
+    for stream in (True, False):
+        context.settings['stream_raw'] = stream
+        _, wall, peak = measure(
+            lambda: _get_series_data(context, "raw", channels[:1]), repeat
+        )
+        name = "squiggle_streamed" if stream else "squiggle_full"
+        results[name] = StageResult(wall, peak)
+    return results
+
+
+def _kde_agreement(
+    histograms: Dict, channels: List[int],
+    kdes: Tuple[np.ndarray, List[np.ndarray]]
+) -> Optional[float]:
+    # deviation of the binned kde from statsmodels' on a subsample drawn
+    # from the histogram, relative to the density peak
+    try:
+        from statsmodels.nonparametric.kde import KDEUnivariate
+    except ImportError:
+        return None
+    support, densities = kdes
+    rng = np.random.default_rng(0)
+    deviations = []
+    for chan, density in list(zip(channels, densities))[:3]:
+        hist = histograms[chan]
+        data = rng.choice(
+            hist.bin_centers, size=200_000,
+            p=hist.counts / hist.counts.sum()
+        )
+        kde = KDEUnivariate(data)
+        kde.fit(bw=normal_reference_bw(hist), fft=True)
+        exact = np.interp(support, kde.support, kde.density)
+        deviations.append(np.max(np.abs(exact - density)) / exact.max())
+    return float(max(deviations))
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]) -> None:
+    print(f"{'stage':<20}{'baseline':>12}{'current':>12}{'ratio':>8}")
+    for name, res in current['results'].items():
+        if (old := baseline['results'].get(name)) is None:
+            continue
+        ratio = res['wall_time'] / old['wall_time']
+        print(
+            f"{name:<20}{old['wall_time']:>11.3f}s{res['wall_time']:>11.3f}s"
+            f"{ratio:>8.2f}"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmark NanoTrace on synthetic bulk files."
+    )
+    parser.add_argument("--out", default="benchmark.json")
+    parser.add_argument("--compare", help="earlier result file")
+    parser.add_argument("--channels", type=int, default=126)
+    parser.add_argument("--length", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        report = run_benchmarks(
+            Path(tmp), args.channels, args.length, args.repeat, args.workers
+        )
+    with open(args.out, 'w') as fh:
+        json.dump(report, fh, indent=2)
+    for name, res in report['results'].items():
+        print(
+            f"{name:<20}{res['wall_time']:>9.3f}s {res['peak_mb']:>9.1f} MiB"
+        )
+    if args.compare:
+        with open(args.compare) as fh:
+            compare(report, json.load(fh))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+from typing import Any, Optional, Tuple, Union
+
+import dearpygui.dearpygui as dpg
+import numpy as np
+
+from context import Context
+from dose_response import (
+    CalibrationData, DoseResponse, Model, fit_dose_response
+)
+from instrumentation import span
+from tasks import executor
+from utils import ProgressCallback
+
+DpgItem = Union[int, str]
+
+
+def add_calibration(tab_tag: DpgItem, context: Context):
+    with dpg.tab(label="Calibration", parent=tab_tag) as tab:
+        dpg.add_spacer(height=5)
+        with dpg.group(horizontal=True):
+            dpg.add_text("Model:")
+            dpg.add_combo(
+                ['linear', 'logistic'], tag="calibration_model",
+                default_value='linear', width=100
+            )
+            with dpg.tooltip(dpg.last_item()):
+                dpg.add_text(
+                    "[linear: density = a + b * concentration,\n"
+                    " logistic: four parameter dose-response curve]"
+                )
+            dpg.add_checkbox(
+                label="MAD filter", tag="calibration_mad", default_value=True
+            )
+            dpg.add_button(
+                label="Refresh", tag="calibration_refresh",
+                callback=refresh_calibration, user_data=context
+            )
+        dpg.add_text(tag="calibration_info")
+        dpg.add_spacer(height=5)
+        dpg.add_group(tag="calibration_plot")
+        with dpg.table(
+            tag="calibration_table", header_row=True, resizable=True,
+            borders_innerH=True, borders_outerH=True, scrollY=True,
+            height=-1, policy=dpg.mvTable_SizingStretchProp
+        ):
+            for label in (
+                "Experiment", "Concentration", "Event density", "Channels",
+                "Predicted", "95% CI"
+            ):
+                dpg.add_table_column(label=label)
+    return tab
+
+
+def _calibrate(
+    context: Context, model: Model, filter_mad: bool,
+    progress: Optional[ProgressCallback] = None
+) -> Tuple[CalibrationData, Optional[DoseResponse], str]:
+    if progress is not None:
+        progress(0.1, "Collecting event densities")
+    data = context.calibration_data(filter_mad)
+    if progress is not None:
+        progress(0.5, "Fitting calibration curve")
+    calibrants = data.calibrants
+    try:
+        with span("calibration_fit", experiments=int(calibrants.sum())):
+            fit = fit_dose_response(
+                data.concentrations[calibrants],
+                data.densities[calibrants], model
+            )
+    except ValueError as e:
+        return data, None, str(e)
+    return data, fit, ""
+
+
+# ################ Callbacks ##################################################
+
+def refresh_calibration(
+    sender: DpgItem,
+    app_data: Any,
+    user_data: Context
+) -> None:
+    dpg.configure_item("calibration_refresh", show=False)
+
+    def _on_done(result):
+        dpg.configure_item("calibration_refresh", show=True)
+        _show_calibration(user_data, *result)
+
+    def _on_fail():
+        dpg.configure_item("calibration_refresh", show=True)
+
+    executor.submit(
+        "Calibrating", _calibrate, user_data,
+        dpg.get_value("calibration_model"), dpg.get_value("calibration_mad"),
+        on_done=_on_done, on_fail=_on_fail
+    )
+
+
+def _show_calibration(
+    context: Context, data: CalibrationData, fit: Optional[DoseResponse],
+    error: str
+) -> None:
+    calibrants = data.calibrants
+    info = (
+        f"{int(calibrants.sum())} calibrants at "
+        f"{len(np.unique(data.concentrations[calibrants]))} concentrations, "
+        f"{int(data.unknowns.sum())} unknown, event band "
+        f"({context.settings['min_event_band']}, "
+        f"{context.settings['max_event_band']})"
+    )
+    dpg.set_value("calibration_info", f"{info}\n{error}" if error else info)
+    _plot_calibration(data, fit)
+
+    estimate = low = high = np.full(len(data.keys), np.nan)
+    if fit is not None:
+        estimate, low, high = fit.invert(data.densities)
+    dpg.delete_item("calibration_table", children_only=True, slot=1)
+    # unknowns first
+    for i in np.lexsort((data.concentrations, ~np.isnan(data.concentrations))):
+        if data.channels[i] == 0:
+            continue
+        with dpg.table_row(parent="calibration_table"):
+            dpg.add_text(data.names[i])
+            dpg.add_text(
+                "" if np.isnan(data.concentrations[i])
+                else f"{data.concentrations[i]:g}"
+            )
+            dpg.add_text(
+                f"{data.densities[i]:.4f} (+/- {2*data.sd[i]:.4f})"
+            )
+            dpg.add_text(str(data.channels[i]))
+            dpg.add_text(_format(estimate[i]))
+            dpg.add_text(f"[{_format(low[i])}, {_format(high[i])}]")
+
+
+def _plot_calibration(
+    data: CalibrationData, fit: Optional[DoseResponse]
+) -> None:
+    dpg.delete_item("calibration_plot", children_only=True)
+    calibrants = data.calibrants
+    if not np.any(calibrants):
+        return
+    conc = data.concentrations[calibrants]
+    log_scale = fit is not None and fit.model == 'logistic'
+    if log_scale:
+        # blanks sit at the floor of the fit
+        conc = np.maximum(conc, fit.floor)
+    with dpg.plot(
+        label="Calibration", height=300, width=-1, parent="calibration_plot"
+    ):
+        dpg.add_plot_legend()
+        dpg.add_plot_axis(
+            dpg.mvXAxis, label="Concentration",
+            scale=dpg.mvPlotScale_Log10 if log_scale
+            else dpg.mvPlotScale_Linear
+        )
+        y_axis = dpg.add_plot_axis(dpg.mvYAxis, label="Event density")
+        if fit is not None:
+            if log_scale:
+                curve_x = np.logspace(
+                    np.log10(fit.floor), np.log10(conc.max()), 200
+                )
+            else:
+                curve_x = np.linspace(0, conc.max(), 200)
+            low, high = fit.band(curve_x)
+            dpg.add_shade_series(
+                curve_x.tolist(), low.tolist(), y2=high.tolist(),
+                label="95% CI", parent=y_axis
+            )
+            dpg.add_line_series(
+                curve_x.tolist(), fit.predict(curve_x).tolist(),
+                label=fit.model, parent=y_axis
+            )
+        dpg.add_scatter_series(
+            conc.tolist(), data.densities[calibrants].tolist(),
+            label="Calibrants", parent=y_axis
+        )
+
+
+def _format(value: float) -> str:
+    return "" if np.isnan(value) else f"{value:.3g}"
@@ -1,16 +1,24 @@
+from math import nan
 from typing import Dict, Any, Union
 
 import dearpygui.dearpygui as dpg
 
 from context import Context
 from python_toolbox.util import split_string_to_size
-from series_plots import show_kde, show_rand_kde, show_raw
-from utils import event_density, determine_scaling
+from series_plots import (
+    show_events, show_kde, show_mean_timeline, show_rand_kde, show_raw,
+    show_timeline
+)
+from tasks import executor
+from utils import event_density
 
 DpgItem = Union[int, str]
 
 
 def add_command_central(tab_tag: DpgItem, context: Context):
+    # reading ahead must not slow down what the user asked for
+    context.prefetcher.paused = lambda: executor.busy
+    context.index_paused = lambda: executor.busy
     with dpg.tab(label="Command Central", parent=tab_tag) as tab:
         dpg.add_spacer(height=5)
         _add_file_select(context)
@@ -19,7 +27,12 @@ def add_command_central(tab_tag: DpgItem, context: Context):
         dpg.add_spacer(height=5)
         _add_func_choose(context)
         dpg.add_spacer(height=5)
-        dpg.add_progress_bar(tag="Progress Bar", show=False, width=175)
+        with dpg.group(horizontal=True):
+            dpg.add_progress_bar(tag="Progress Bar", show=False, width=175)
+            dpg.add_button(
+                label="Cancel", tag="cancel_task", show=False,
+                callback=lambda: executor.cancel()
+            )
         dpg.add_spacer(height=5)
         _add_exp_info(context)
         dpg.add_spacer(height=10)
@@ -107,6 +120,18 @@ def _add_func_choose(context: Context):
             label="Show Random Densities",
             callback=show_rand_kde, user_data=context
         )
+        dpg.add_button(
+            label="Show Event Statistics",
+            callback=show_events, user_data=context
+        )
+        dpg.add_button(
+            label="Show Density over Time",
+            callback=show_timeline, user_data=context
+        )
+        dpg.add_button(
+            label="Show Mean Density over Time",
+            callback=show_mean_timeline, user_data=context
+        )
 
 
 def _add_exp_info(context: Context):
@@ -157,13 +182,28 @@ def set_active_channels(
 ) -> None:
     # first thing to happen: button vanishes
     dpg.configure_item("get_active_channels", show=False)
-    user_data.calculate_band_distributions()
-    dpg.configure_item(
-        "channel", items=user_data.get_active_channels(), show=True
+    exp = user_data.active_exp
+
+    def _on_done(_):
+        if user_data.active_exp is not exp:
+            return
+        dpg.configure_item(
+            "channel", items=user_data.get_active_channels(), show=True
+        )
+        dpg.configure_item("toggle_channels", show=True)
+        dpg.configure_item("func_choose", show=True)
+        _show_experiment_info(user_data)
+        user_data.prefetch_channels()
+
+    def _on_fail():
+        # cancelled or failed, let the user retry
+        if user_data.active_exp is exp:
+            dpg.configure_item("get_active_channels", show=True)
+
+    executor.submit(
+        "Scanning channels", user_data.calculate_band_distributions,
+        on_done=_on_done, on_fail=_on_fail
     )
-    dpg.configure_item("toggle_channels", show=True)
-    dpg.configure_item("func_choose", show=True)
-    _show_experiment_info(user_data)
 
 
 def get_band_distributions(
@@ -173,8 +213,20 @@ def get_band_distributions(
 ) -> None:
     # first thing to happen: button vanishes
     dpg.configure_item("get_band_distributions", show=False)
-    user_data.calculate_band_distributions()
-    _show_experiment_info(user_data)
+    exp = user_data.active_exp
+
+    def _on_done(_):
+        if user_data.active_exp is exp:
+            _show_experiment_info(user_data)
+
+    def _on_fail():
+        if user_data.active_exp is exp:
+            dpg.configure_item("get_band_distributions", show=True)
+
+    executor.submit(
+        "Calculating event bands", user_data.calculate_band_distributions,
+        on_done=_on_done, on_fail=_on_fail
+    )
 
 
 def choose_file(
@@ -189,12 +241,25 @@ def choose_file(
 
     # TODO/HACK: invent state interface to allow for
     #            easier switching of displayed stuff
-    dpg.configure_item("channel_choose", show=False)
-    dpg.configure_item("func_choose", show=False)
-    dpg.configure_item("exp_info", show=False)
+    items = ["channel_choose", "func_choose", "exp_info", "filename"]
+    shown = [item for item in items if dpg.is_item_shown(item)]
     # reset filename first as file loading might take some time
-    dpg.configure_item("filename", show=False)
-    user_data.update_context(fpath, progressbar="Progress Bar")
+    for item in items:
+        dpg.configure_item(item, show=False)
+    user_data.prefetcher.stop()
+
+    def _on_fail():
+        # opening failed, show the previous state again
+        for item in shown:
+            dpg.configure_item(item, show=True)
+
+    executor.submit(
+        "Opening file", user_data.update_context, fpath,
+        on_done=lambda _: _show_file(user_data), on_fail=_on_fail
+    )
+
+
+def _show_file(user_data: Context) -> None:
     dpg.set_value(
         "filename",
         "\n".join(split_string_to_size(user_data.active_exp.name, 60, sep="_"))
@@ -207,6 +272,7 @@ def choose_file(
         dpg.configure_item("channel", items=chans, show=True)
         dpg.configure_item("toggle_channels", show=True)
         dpg.configure_item("func_choose", show=True)
+        user_data.prefetch_channels()
         if user_data.has_band_distribution():
             _show_experiment_info(user_data)
         else:
@@ -223,9 +289,10 @@ def _show_experiment_info(context: Context) -> None:
     ev_low = context.settings['min_event_band']
     ev_high = context.settings['max_event_band']
     dpg.set_value("active_channels_info", len(exp.get_active_channels()))
-    mean, sd = exp.get_mean_events(ev_low, ev_high)
+    # None while some channels lack the bands
+    mean, sd = exp.get_mean_events(ev_low, ev_high) or (nan, nan)
     dpg.set_value("avg_event_info", f"{mean} (+/-{2*sd})")
-    mean_bl, sd_bl = exp.get_mean_baselines(ev_low, ev_high)
+    mean_bl, sd_bl = exp.get_mean_baselines(ev_low, ev_high) or (nan, nan)
     dpg.set_value("avg_baseline_info", f"{mean_bl} (+/-{2*sd_bl})")
     dpg.set_value("concentration_info", exp.properties['concentration'])
     dpg.configure_item("exp_info", show=True)
@@ -237,29 +304,32 @@ def set_channel(
     user_data: Context
 ) -> None:
     channel = int(dpg.get_value(sender))
-    if user_data.active_exp.band_distribution == {}:
+    user_data.prefetcher.prioritize(channel)
+    bands = user_data.active_exp.band_table
+    if len(bands) == 0:
         dpg.set_value("channel", "")
         return
-    try:
-        band_dict = user_data.active_exp.band_distribution[channel]
-    except KeyError:
+    if bands.lookup(channel) is None:
         dpg.set_value("channel", "")
         dpg.configure_item("channel_info", show=False)
         return
 
     ev_low = user_data.settings['min_event_band']
     ev_high = user_data.settings['max_event_band']
-    try:
-        bl, band = band_dict[
-            determine_scaling(ev_low, ev_high)
-        ][(ev_low, ev_high)]
-    except KeyError:
+    if (found := bands.lookup(channel, ev_low, ev_high)) is None:
         dpg.configure_item("channel_info", show=False)
         return
+    bl, band = found
 
     dpg.set_value("sel_channel_info", channel)
     dpg.set_value("sel_event_info", round(event_density(band), 4))
-    dpg.set_value("sel_baseline_info", bl)
+    hist = user_data.active_exp.histograms.get(channel)
+    if hist is None or hist.baseline_mad is None:
+        dpg.set_value("sel_baseline_info", bl)
+    else:
+        dpg.set_value(
+            "sel_baseline_info", f"{bl} (MAD {hist.baseline_mad:.2f})"
+        )
     dpg.set_value(
         "sel_baseline_density_info",
         round(event_density(band, 'baseline'), 4))
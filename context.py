@@ -1,27 +1,43 @@
-from typing import Dict, Any, List, Optional, Tuple, Union
+from typing import Callable, Dict, Any, List, Optional, Tuple
 from os import path
 from pathlib import Path
-import pickle
-
-import dearpygui.dearpygui as dpg
+import threading
 
+from dose_response import CalibrationData, experiment_densities
+from events import EventTable, get_channel_events
 from experiment import Experiment
+from experiment_store import ExperimentStore
+from fingerprint import (
+    FileFingerprint, get_fingerprint, hash_file, hash_file_async
+)
+from instrumentation import span
+from kde_cache import KdeCache
+from prefetch import Prefetcher
+from raw_io import configure_cache
+from timeline import DensityTimeline, get_density_timeline
 import utils
-from python_toolbox.util import deep_update, get_file_hash
+from zone_map import ZoneMap, ZoneMapStore
 
 # HACK
 DEFAULT_SETTINGS = {
     'kde_resolution': 1_000_000,
+    'kde_bandwidth': 'normal_reference',
+    'kde_cache_mb': 256,
+    'raw_cache_mb': 0,
+    'prefetch_mb': 512,
     'burnin': 350_000,
     'min_event_band': 0.27,
     'max_event_band': 0.48,
     'random_kdes': 10,
     'scale_in_seconds': False,
-    'plot_event_bands': False
+    'plot_event_bands': False,
+    'stream_raw': True,
+    'scan_workers': 1,
+    'probe_margin': 5.0,
+    'density_window': 10,
+    'instrumentation': False
 }
 
-DpgItem = Union[int, str]
-
 
 class Context:
 
@@ -32,101 +48,378 @@ class Context:
         self.settings: Dict[str, Any] = settings
         self.experiment_db = experiment_db
 
-        self.exps: Dict[str, Experiment] = self._load_exps()[0]
+        # guards exps and fingerprints against the background hashing
+        self._exps_lock = threading.RLock()
+        exps, _, fingerprints = self._load_exps()
+        # experiments are loaded from the store on first access
+        self.exps: ExperimentStore = exps
+        # {file path -> (fingerprint, full hash if already known)}
+        self.fingerprints: Dict[
+            str, Tuple[FileFingerprint, Optional[str]]
+        ] = fingerprints
         self.active_exp: Optional[Experiment] = None
 
         # flag to determine changed settings for recomputation of bands
         self.dirty = False
+        # read/count statistics of the last channel scan
+        self.scan_stats: Optional[utils.ScanStats] = None
+        self._kde_cache: Optional[KdeCache] = None
+        self.configure_raw_cache()
+        # channels of the active experiment read ahead in the background
+        self.prefetcher = Prefetcher(
+            self.settings.get('prefetch_mb', 512) * 2**20
+        )
+        self._zone_maps: Optional[ZoneMapStore] = None
+        # zone maps are built in the background of the gui, waiting while
+        # this holds; None leaves files unindexed
+        self.index_paused: Optional[Callable[[], bool]] = None
 
     def update_experiment_db(self, fpath: str, dump_first=True) -> None:
         if dump_first:
             self._dump_exps()
         self.experiment_db = fpath
-        self.exps, self.settings = self._load_exps()
+        with self._exps_lock:
+            self.exps.close()
+            self.exps, self.settings, self.fingerprints = self._load_exps()
+        self.configure_raw_cache()
+        self.prefetcher.stop()
+        self.prefetcher.max_bytes = self.settings.get('prefetch_mb', 512) \
+            * 2**20
+        self.prefetcher.evict()
         self.dirty = True
 
     def update_context(
         self, fpath: str,
-        progressbar: Optional[DpgItem] = None
+        progress: Optional[utils.ProgressCallback] = None,
+        hash_in_background: bool = True
     ) -> None:
         # TODO: add sanity checks for file values
-        # calculate hash first and check if experiment is known
-        if progressbar is not None:
-            dpg.configure_item(
-                progressbar, show=True, overlay="Calculating file hash"
-            )
-            dpg.set_value(progressbar, 0.5)
-        hash = get_file_hash(fpath, algo='blake2b')
-        if progressbar is not None:
-            dpg.configure_item(progressbar, show=False)
-
-        if hash not in self.exps.keys():
-            # TODO: add different hash algorithms?
-            fname = path.split(fpath)[1]
-            properties = utils.parse_exp_name(fname)
-            exp = Experiment(fname, fpath, {'blake2b': hash}, properties)
-            self.exps[hash] = exp
+        # identify the file by its fingerprint, the full hash follows
+        # in the background unless the path index knows the file as is
+        if progress is not None:
+            progress(0.5, "Fingerprinting file")
+        with span("fingerprint"):
+            fingerprint = get_fingerprint(fpath)
+
+        with self._exps_lock:
+            exp, indexed = self._find_experiment(fpath, fingerprint)
+            if exp is None:
+                exp = self._new_experiment(fpath, fingerprint)
+                self.exps[exp.get_hash()] = exp
+            former_path = exp.path
+            # the file might have been moved since
+            exp.path = fpath
+            exp.hashs['sampled'] = fingerprint.identity
+            self.active_exp = exp
+        if indexed:
+            self.index_file(exp)
+            return
+
+        def _on_hash(_, file_hash):
+            self._set_full_hash(exp, fingerprint, file_hash, former_path)
+
+        if hash_in_background:
+            hash_file_async(fpath, _on_hash, algo='blake2b')
         else:
-            exp = self.exps[hash]
-        self.active_exp = exp
+            _on_hash(fpath, hash_file(fpath))
+
+    def _new_experiment(
+        self, fpath: str, fingerprint: FileFingerprint
+    ) -> Experiment:
+        fname = path.split(fpath)[1]
+        return Experiment(
+            fname, fpath, {'sampled': fingerprint.identity},
+            utils.parse_exp_name(fname)
+        )
+
+    def _find_experiment(
+        self, fpath: str, fingerprint: FileFingerprint
+    ) -> Tuple[Optional[Experiment], bool]:
+        # the experiment and whether the path index knows the file with
+        # the same size, mtime and sampled digest
+        known = self.fingerprints.get(fpath)
+        if known is not None and known[0] == fingerprint \
+                and known[1] in self.exps:
+            return self.exps[known[1]], True
+        # unknown path or changed mtime, compare the sampled contents; the
+        # full hash decides whether it is the same file
+        if (key := self.exps.find_by_sampled(fingerprint.identity)) \
+                is not None:
+            return self.exps[key], False
+        return None, False
+
+    def _set_full_hash(
+        self, exp: Experiment, fingerprint: FileFingerprint,
+        file_hash: Optional[str], former_path: Optional[str] = None
+    ) -> None:
+        # called from the hashing thread
+        if file_hash is None:
+            return
+        with self._exps_lock:
+            if exp.hashs.get('blake2b') not in (None, file_hash):
+                # same size and sampled blocks, other contents: a new
+                # experiment, the matched one keeps its file
+                fpath = exp.path
+                exp.path = former_path
+                new_exp = self._new_experiment(fpath, fingerprint)
+                if self.active_exp is exp:
+                    self.active_exp = new_exp
+                exp = new_exp
+            elif self.exps.get(exp.get_hash()) is exp:
+                del self.exps[exp.get_hash()]
+            exp.hashs['blake2b'] = file_hash
+            if (known := self.exps.get(file_hash)) not in (None, exp):
+                # experiment of a database without fingerprints
+                known.band_table = known.band_table.update(exp.band_table)
+                if not known.histograms:
+                    known.histograms = exp.histograms
+                known.path = exp.path
+                known.hashs['sampled'] = fingerprint.identity
+                if self.active_exp is exp:
+                    self.active_exp = known
+                exp = known
+            self.exps[file_hash] = exp
+            self.fingerprints[exp.path] = (fingerprint, file_hash)
+            self._dump_exps()
+        self.index_file(exp)
+
+    @property
+    def kde_cache(self) -> KdeCache:
+        if self._kde_cache is None:
+            self._kde_cache = KdeCache()
+        # budget may have changed with the settings
+        self._kde_cache.max_bytes = self.settings['kde_cache_mb'] * 2**20
+        return self._kde_cache
+
+    @property
+    def zone_maps(self) -> Optional[ZoneMapStore]:
+        # next to the experiment database, none without one
+        if not self.experiment_db:
+            return None
+        directory = Path(self.experiment_db).with_suffix(".zones")
+        if self._zone_maps is None or self._zone_maps.directory != directory:
+            self._zone_maps = ZoneMapStore(directory)
+            # maps of files removed from the database since the last run
+            with self._exps_lock:
+                self._zone_maps.prune(self.exps)
+        return self._zone_maps
+
+    def get_zone_map(
+        self, exp: Optional[Experiment] = None
+    ) -> Optional[ZoneMap]:
+        # only for files with a full hash, maps are keyed by it
+        exp = self.active_exp if exp is None else exp
+        if exp is None or (store := self.zone_maps) is None \
+                or (file_hash := exp.hashs.get('blake2b')) is None:
+            return None
+        return store.get(file_hash)
+
+    def index_file(self, exp: Optional[Experiment] = None) -> None:
+        # builds the zone map of a file in the background once
+        exp = self.active_exp if exp is None else exp
+        if exp is None or self.index_paused is None \
+                or (store := self.zone_maps) is None \
+                or (file_hash := exp.hashs.get('blake2b')) is None:
+            return
+        store.build_async(exp.path, file_hash, self.index_paused)
+
+    def configure_raw_cache(self) -> None:
+        # shared by all raw reads of the process, disabled at 0 MB
+        configure_cache(self.settings.get('raw_cache_mb', 0) * 2**20)
+
+    def prefetch_channels(self) -> None:
+        # active channels of a known experiment, in the order of the list
+        exp = self.active_exp
+        if exp is None or (channels := exp.get_active_channels()) is None:
+            return
+        burnin = self.settings['burnin']
+        self.prefetcher.start(
+            exp.path, sorted(channels), burnin,
+            histograms=not exp.has_histograms(burnin)
+        )
 
     def get_active_channels(self) -> List[int]:
         return self.active_exp.get_active_channels()
 
-    def has_band_distribution(self) -> bool:
-        if (bands := self.active_exp.band_distribution) == {}:
-            return False
+    def has_band_distribution(self, exp: Optional[Experiment] = None) -> bool:
+        if exp is None:
+            exp = self.active_exp
+        return exp.band_table.has_bounds(
+            self.settings['min_event_band'], self.settings['max_event_band']
+        )
+
+    def calibration_data(self, filter_mad: bool = True) -> CalibrationData:
+        # mean event densities of every experiment in the database for the
+        # current band setting, from the stored channel results
+        with self._exps_lock, span("calibration_data"):
+            return experiment_densities(
+                *self.exps.band_results(
+                    self.settings['min_event_band'],
+                    self.settings['max_event_band']
+                ),
+                filter_mad=filter_mad
+            )
+
+    def get_density_timeline(
+        self, progress: Optional[utils.ProgressCallback] = None
+    ) -> DensityTimeline:
+        # band densities over time of the active experiment, read once per
+        # band and window setting
+        exp = self.active_exp
+        burnin = self.settings['burnin']
+        window = float(self.settings['density_window'])
         min_ev = self.settings['min_event_band']
         max_ev = self.settings['max_event_band']
-        scaling = utils.determine_scaling(min_ev, max_ev)
+        key = (
+            burnin, window, utils.determine_scaling(min_ev, max_ev),
+            min_ev, max_ev
+        )
+        if (timeline := exp.timelines.get(key)) is not None:
+            return timeline
+        if not exp.has_histograms(burnin):
+            exp.histograms = utils.get_channel_histograms(
+                exp.path, burnin, workers=self.settings['scan_workers'],
+                progress=progress,
+                probe_margin=self.settings.get('probe_margin', 5.0)
+            )
+        timeline = get_density_timeline(
+            exp.path, exp.histograms, min_ev, max_ev, window, progress
+        )
+        exp.timelines[key] = timeline
+        self._dump_exps()
+        return timeline
+
+    def has_channel_histograms(self) -> bool:
+        return self.active_exp.has_histograms(self.settings['burnin'])
+
+    def calculate_band_distributions(
+        self, progress: Optional[utils.ProgressCallback] = None
+    ) -> List[int]:
+        # may run in the background, the active experiment might change
+        self.calculate_experiments([self.active_exp], progress)
+
+    def calculate_experiments(
+        self, exps: List[Experiment],
+        progress: Optional[utils.ProgressCallback] = None
+    ) -> None:
+        # the channels of all files to scan share one pool of workers
+        burnin = self.settings['burnin']
+        todo = [exp for exp in exps if not self.has_band_distribution(exp)]
+        scan = {
+            exp.path: exp for exp in todo if not exp.has_histograms(burnin)
+        }
+        for exp in todo:
+            if exp.path not in scan:
+                # band changes are served from the cached histograms
+                self._update_bands(exp)
+        if not scan:
+            return
+
+        # dead channels as of the zone maps are not read again
+        dead = {
+            fpath: zone_map.dead_channels(burnin)
+            for fpath, exp in scan.items()
+            if (zone_map := self.get_zone_map(exp)) is not None
+        }
+        pending = {fpath: 126 for fpath in scan}
+        histograms = {fpath: {} for fpath in scan}
+
+        def _store(fpath, channel, hist):
+            if hist is not None:
+                histograms[fpath][channel] = hist
+            pending[fpath] -= 1
+            if pending[fpath] == 0:
+                # complete files go into their experiment right away
+                scan[fpath].histograms = histograms[fpath]
+                self._update_bands(scan[fpath])
+
+        self.scan_stats = utils.ScanStats()
         try:
-            if (min_ev, max_ev) in next(iter(bands.values()))[scaling].keys():
-                return True
-        except (KeyError, StopIteration):
-            return False
-
-    def calculate_band_distributions(self) -> List[int]:
-        if not self.has_band_distribution():
-            details = utils.get_channel_details(
-                self.active_exp.path,
-                self.settings['burnin'],
+            utils.scan_files(
+                list(scan), burnin,
+                stats=self.scan_stats,
+                workers=self.settings['scan_workers'],
+                progress=progress,
+                on_result=_store,
+                probe_margin=self.settings.get('probe_margin', 5.0),
+                dead=dead
+            )
+        finally:
+            # partly scanned files keep no histograms, they are scanned
+            # again on the next request
+            incomplete = [
+                scan[fpath].name for fpath, left in pending.items() if left
+            ]
+            if incomplete:
+                print(f"Incomplete scan of {', '.join(incomplete)}")
+        if incomplete:
+            # surfaces through the executor's on_fail
+            raise RuntimeError(f"{len(incomplete)} files not fully scanned")
+
+    def _update_bands(self, exp: Experiment) -> None:
+        with span("bands", channels=len(exp.histograms)):
+            details = utils.get_band_distributions(
+                exp.histograms,
                 self.settings['min_event_band'],
                 self.settings['max_event_band']
             )
-            self.active_exp.band_distribution = deep_update(
-                self.active_exp.band_distribution,
-                details
-            )
+        exp.update_bands(details)
+        # only the new channel results are written
+        self._dump_exps()
 
-    def _load_exps(self) -> Tuple[Dict[str, Experiment], Dict]:
+    def _load_exps(self) -> Tuple[ExperimentStore, Dict, Dict]:
         if not self.experiment_db \
                 or not Path(self.experiment_db).is_file():
-            return ({}, {})
+            return (ExperimentStore(), {}, {})
 
-        with open(self.experiment_db, 'rb') as fh:
-            exp_dict = pickle.load(fh)
-        return self._sanitize_exps(exp_dict)
+        # pickled databases are migrated on opening
+        store = ExperimentStore(self.experiment_db)
+        return self._sanitize_exps({
+            'exps': store,
+            'settings': store.load_settings(),
+            'fingerprints': store.load_fingerprints()
+        })
 
-    def _sanitize_exps(self, exp_dict) -> Dict[str, Experiment]:
+    def _sanitize_exps(
+        self, exp_dict
+    ) -> Tuple[ExperimentStore, Dict, Dict]:
         # TODO: add version tag and version check
         # and reasoning about settings
-        experiments = {}
+        experiments = ExperimentStore()
         settings = DEFAULT_SETTINGS
+        fingerprints = {}
         try:
             experiments = exp_dict['exps']
             if (new_settings := exp_dict['settings']):
-                settings = new_settings
+                # keep defaults for settings unknown to older databases
+                settings = {**DEFAULT_SETTINGS, **new_settings}
+            # older databases come without a fingerprint index
+            fingerprints = exp_dict.get('fingerprints', {})
         finally:
-            return experiments, settings
+            return experiments, settings, fingerprints
 
     def _dump_exps(self) -> None:
-        dump = {
-            'settings': self.settings,
-            'exps': self.exps
-        }
-        if self.experiment_db:
-            with open(self.experiment_db, 'wb') as fh:
-                pickle.dump(dump, fh)
+        with self._exps_lock:
+            if not self.experiment_db:
+                return
+            if self.exps.db_path != Path(self.experiment_db):
+                # new database file, take all experiments along
+                store = self.exps.save_as(self.experiment_db)
+                self.exps.close()
+                self.exps = store
+            with span("db_save"):
+                self.exps.save(self.settings, self.fingerprints)
+
+    def get_channel_events(
+        self, channel: int,
+        progress: Optional[utils.ProgressCallback] = None
+    ) -> EventTable:
+        if progress is not None:
+            progress(0.0, f"Detecting events of channel {channel}")
+        return get_channel_events(
+            self.active_exp.path, channel, self.settings['burnin'],
+            *self.get_event_bands(channel)
+        )
 
     def get_event_bands(self, channel) -> Tuple[float, float]:
         min_ev = self.settings['min_event_band']
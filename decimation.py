@@ -0,0 +1,244 @@
+from collections import OrderedDict
+from math import ceil
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from fast5_research.fast5_bulk import BulkFast5
+
+from raw_io import (
+    calibrate, get_calibration, iter_raw_chunks, raw_length, read_raw
+)
+from utils import ProgressCallback
+from zone_map import ZoneMap
+
+
+class MinMaxPyramid:
+    # Multi level min/max decimation of a signal. Level k keeps the minimum
+    # and maximum of every bucket of factor**(k+1) samples, so any range
+    # can be drawn with a bounded number of points without losing peaks.
+
+    def __init__(
+        self, data: np.ndarray, factor: int = 8, min_buckets: int = 1024
+    ) -> None:
+        self.data: np.ndarray = data
+        self.factor: int = factor
+        self.levels: List[Tuple[np.ndarray, np.ndarray]] = []
+
+        mins = maxs = data
+        while len(mins) > min_buckets:
+            starts = np.arange(0, len(mins), factor)
+            mins = np.minimum.reduceat(mins, starts).astype(np.float32)
+            maxs = np.maximum.reduceat(maxs, starts).astype(np.float32)
+            self.levels.append((mins, maxs))
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def bucket_size(self, level: int) -> int:
+        return self.factor ** (level + 1)
+
+    def query(
+        self, start: float, stop: float, max_points: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        start = max(0, int(start))
+        stop = min(len(self.data), ceil(stop))
+        if stop <= start:
+            return np.empty(0), np.empty(0)
+        span = stop - start
+        if span <= max_points or not self.levels:
+            return np.arange(start, stop), self.data[start:stop]
+
+        # finest level whose buckets (two points each) fit into max_points
+        level = len(self.levels) - 1
+        for k in range(len(self.levels)):
+            if 2 * span / self.bucket_size(k) <= max_points:
+                level = k
+                break
+        bucket = self.bucket_size(level)
+        first, last = start // bucket, ceil(stop / bucket)
+        mins, maxs = self.levels[level]
+        centers = (np.arange(first, last) + 0.5) * bucket
+        y_data = np.empty(2 * (last - first), dtype=mins.dtype)
+        y_data[0::2] = mins[first:last]
+        y_data[1::2] = maxs[first:last]
+        return np.repeat(centers, 2), y_data
+
+
+class WindowedRawSource:
+    # Loads only the part of a channel needed for the visible range.
+    # Ranges are served from aligned windows of WINDOW_BUCKETS min/max
+    # buckets (or raw samples when zoomed in), recently used windows
+    # are kept in a small LRU cache. Buckets of whole blocks of a zone map
+    # are served from the map without reading. The render thread only
+    # draws cached windows (cached_query), missing ones are loaded in the
+    # background.
+    WINDOW_BUCKETS = 8192
+
+    def __init__(
+        self, fpath: str, channel: int, factor: int = 4,
+        cache_windows: int = 32, chunk_size: int = 1_048_576,
+        zone_map: Optional[ZoneMap] = None
+    ) -> None:
+        self.fpath: str = fpath
+        self.channel: int = channel
+        self.factor: int = factor
+        self.zone_map: Optional[ZoneMap] = \
+            zone_map if zone_map is not None and channel in zone_map \
+            else None
+        self.cache_windows: int = cache_windows
+        # power of factor, so chunks are aligned with all smaller buckets
+        self.chunk_size: int = 1
+        while self.chunk_size * factor <= chunk_size:
+            self.chunk_size *= factor
+        self._cache: Dict[Tuple[int, int], Tuple[np.ndarray, np.ndarray]] \
+            = OrderedDict()
+        # windows are loaded in the background and drawn on the render
+        # thread
+        self._lock = threading.Lock()
+        with BulkFast5(fpath) as fh:
+            self.length: int = raw_length(fh, channel)
+
+    def __len__(self) -> int:
+        return self.length
+
+    def _plan(
+        self, start: float, stop: float, max_points: int
+    ) -> Tuple[int, int, int]:
+        # clipped range and the bucket size to draw it with
+        start = max(0, int(start))
+        stop = min(self.length, ceil(stop))
+        span = stop - start
+        bucket = 1
+        if span > max_points:
+            # two points (min and max) per bucket
+            while 2 * span / bucket > max_points:
+                bucket *= self.factor
+        return start, stop, bucket
+
+    def _windows(self, start: int, stop: int, bucket: int) -> range:
+        window = bucket * self.WINDOW_BUCKETS
+        return range(start // window, ceil(stop / window))
+
+    def query(
+        self, start: float, stop: float, max_points: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # reads missing windows, use cached_query on the render thread
+        start, stop, bucket = self._plan(start, stop, max_points)
+        if stop <= start:
+            return np.empty(0), np.empty(0)
+        return self._assemble(start, stop, bucket, [
+            self._get_window(w, bucket)
+            for w in self._windows(start, stop, bucket)
+        ])
+
+    def missing(
+        self, start: float, stop: float, max_points: int
+    ) -> List[Tuple[int, int]]:
+        # (window, bucket) keys a query of the range would have to read
+        start, stop, bucket = self._plan(start, stop, max_points)
+        if stop <= start:
+            return []
+        with self._lock:
+            return [
+                (w, bucket) for w in self._windows(start, stop, bucket)
+                if (w, bucket) not in self._cache
+            ]
+
+    def cached_query(
+        self, start: float, stop: float, max_points: int
+    ) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        # like query without reading: the finest cached level from the
+        # requested one upwards, None if none covers the whole range
+        start, stop, bucket = self._plan(start, stop, max_points)
+        if stop <= start:
+            return np.empty(0), np.empty(0)
+        while bucket <= max(1, self.length):
+            with self._lock:
+                datas = [
+                    self._cache.get((w, bucket))
+                    for w in self._windows(start, stop, bucket)
+                ]
+            if all(data is not None for data in datas):
+                return self._assemble(start, stop, bucket, datas)
+            bucket *= self.factor
+        return None
+
+    def load(
+        self, keys: List[Tuple[int, int]],
+        progress: Optional[ProgressCallback] = None
+    ) -> None:
+        # fills the cache in the background, e.g. as an executor task
+        for count, (window, bucket) in enumerate(keys):
+            if progress is not None:
+                progress(count / len(keys), "Reading raw data")
+            self._get_window(window, bucket)
+
+    def _assemble(
+        self, start: int, stop: int, bucket: int,
+        datas: List[Tuple[np.ndarray, np.ndarray]]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        x_data = np.concatenate([x_data for x_data, _ in datas])
+        y_data = np.concatenate([y_data for _, y_data in datas])
+        # buckets overlapping the range are kept as a whole
+        mask = np.logical_and(
+            x_data >= start - bucket, x_data < stop + bucket
+        )
+        return x_data[mask], y_data[mask]
+
+    def _get_window(
+        self, window: int, bucket: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        key = (window, bucket)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        # read without the lock, the render thread keeps drawing
+        data = self._load_window(window, bucket)
+        with self._lock:
+            self._cache[key] = data
+            if len(self._cache) > self.cache_windows:
+                self._cache.popitem(last=False)
+        return data
+
+    def _load_window(
+        self, window: int, bucket: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        first = window * bucket * self.WINDOW_BUCKETS
+        last = min(self.length, first + bucket * self.WINDOW_BUCKETS)
+        if self.zone_map is not None \
+                and bucket % self.zone_map.block_size == 0:
+            mins, maxs = self.zone_map.min_max(
+                self.channel, first, last, bucket
+            )
+            return self._min_max_points(first, bucket, mins, maxs)
+        with BulkFast5(self.fpath) as fh:
+            if bucket == 1:
+                y_data = read_raw(fh, self.channel, first, last)
+                return np.arange(first, first + len(y_data)), y_data
+
+            # decimate chunk by chunk, chunks are aligned to the buckets;
+            # on the ADC codes, calibration keeps their order
+            calibration = get_calibration(fh, self.channel)
+            mins, maxs = [], []
+            for chunk in iter_raw_chunks(
+                fh, self.channel, first, last,
+                chunk_size=max(self.chunk_size, bucket), use_scaling=False
+            ):
+                starts = np.arange(0, len(chunk), bucket)
+                mins.append(np.minimum.reduceat(chunk, starts))
+                maxs.append(np.maximum.reduceat(chunk, starts))
+        mins = calibrate(np.concatenate(mins), calibration).astype(np.float32)
+        maxs = calibrate(np.concatenate(maxs), calibration).astype(np.float32)
+        return self._min_max_points(first, bucket, mins, maxs)
+
+    @staticmethod
+    def _min_max_points(
+        first: int, bucket: int, mins: np.ndarray, maxs: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        centers = first + (np.arange(len(mins)) + 0.5) * bucket
+        y_data = np.empty(2 * len(mins), dtype=np.float32)
+        y_data[0::2] = mins
+        y_data[1::2] = maxs
+        return np.repeat(centers, 2), y_data
@@ -0,0 +1,267 @@
+from dataclasses import dataclass
+from typing import Callable, List, Literal, Optional, Tuple
+import warnings
+
+import numpy as np
+
+from band_table import BandTable
+
+Model = Literal['linear', 'logistic']
+# fewest concentrations to fit a model
+MIN_LEVELS = {'linear': 2, 'logistic': 4}
+
+
+@dataclass
+class CalibrationData:
+    # mean event density per experiment of the database for one band
+    # setting, concentrations are NaN where unknown
+    keys: List[str]
+    names: List[str]
+    concentrations: np.ndarray
+    densities: np.ndarray
+    sd: np.ndarray
+    channels: np.ndarray
+
+    @property
+    def calibrants(self) -> np.ndarray:
+        return ~np.isnan(self.concentrations) & ~np.isnan(self.densities)
+
+    @property
+    def unknowns(self) -> np.ndarray:
+        return np.isnan(self.concentrations) & ~np.isnan(self.densities)
+
+
+def _group_median(
+    values: np.ndarray, groups: np.ndarray, n_groups: int
+) -> np.ndarray:
+    # median of values per group, NaN for empty groups
+    order = np.lexsort((values, groups))
+    counts = np.bincount(groups, minlength=n_groups)
+    starts = np.cumsum(counts) - counts
+    medians = np.full(n_groups, np.nan)
+    filled = counts > 0
+    lower = values[order][starts[filled] + (counts[filled] - 1) // 2]
+    upper = values[order][starts[filled] + counts[filled] // 2]
+    medians[filled] = (lower + upper) / 2
+    return medians
+
+
+def experiment_densities(
+    keys: List[str], names: List[str], concentrations: np.ndarray,
+    index: np.ndarray, table: BandTable, filter_mad: bool = True
+) -> CalibrationData:
+    # Experiment.get_mean_events for all experiments at once, index maps
+    # the rows of the table to their experiment
+    n_exps = len(keys)
+    densities = table.densities()
+    keep = np.isfinite(densities)
+    if filter_mad and len(table):
+        baselines = table.baseline.astype(np.float64)
+        deviation = np.abs(
+            baselines - _group_median(baselines, index, n_exps)[index]
+        )
+        keep &= deviation < 3 * _group_median(deviation, index, n_exps)[index]
+    channels = np.bincount(index[keep], minlength=n_exps)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.bincount(
+            index[keep], weights=densities[keep], minlength=n_exps
+        ) / channels
+        square = np.bincount(
+            index[keep], weights=densities[keep]**2, minlength=n_exps
+        ) / channels
+    return CalibrationData(
+        keys, names, concentrations, mean,
+        np.sqrt(np.clip(square - mean**2, 0, None)), channels
+    )
+
+
+# ################ Models #####################################################
+# Each model gives the densities at the concentrations x for a batch of
+# parameter sets p (n_sets, n_params) and their jacobian.
+
+def _linear(
+    x: np.ndarray, p: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    # density = intercept + slope * concentration
+    f = p[:, :1] + p[:, 1:2] * x
+    jac = np.stack((np.ones_like(f), np.broadcast_to(x, f.shape)), axis=-1)
+    return f, jac
+
+
+def _logistic(
+    x: np.ndarray, p: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    # four parameter logistic over log10 concentration:
+    # bottom, top, log10 of the half effective concentration and hill slope
+    bottom, top, log_ec50, hill = (p[:, i:i+1] for i in range(4))
+    dist = (log_ec50 - x) * np.log(10)
+    with np.errstate(over='ignore'):
+        s = 1 / (1 + np.exp(np.clip(hill * dist, -700, 700)))
+    ds = -s * (1 - s)
+    f = bottom + (top - bottom) * s
+    jac = np.stack((
+        1 - s, s, (top - bottom) * ds * hill * np.log(10),
+        (top - bottom) * ds * dist
+    ), axis=-1)
+    return f, jac
+
+
+_MODEL_FUNCS = {'linear': _linear, 'logistic': _logistic}
+
+
+def _fit_batch(
+    func: Callable, x: np.ndarray, y: np.ndarray, weights: np.ndarray,
+    p0: np.ndarray, iterations: int = 100
+) -> np.ndarray:
+    # Levenberg-Marquardt on many weighted least squares problems at once,
+    # one per row of weights (n_sets, len(x)). x and y are the mean
+    # densities per concentration, the weights the number of experiments
+    # behind them, which gives the same optimum as fitting the experiments.
+    p = np.array(np.broadcast_to(p0, (len(weights), len(p0))))
+    damping = np.full(len(weights), 1e-3)
+    diag = np.arange(p.shape[1])
+
+    def _sse(params):
+        return np.sum(weights * (y - func(x, params)[0])**2, axis=1)
+
+    sse = _sse(p)
+    for _ in range(iterations):
+        f, jac = func(x, p)
+        weighted = jac * weights[..., np.newaxis]
+        normal = np.einsum('bni,bnj->bij', weighted, jac)
+        gradient = np.einsum('bni,bn->bi', weighted, y - f)
+        normal[:, diag, diag] *= 1 + damping[:, np.newaxis]
+        # pseudo inverse, resamples may not determine all parameters
+        step = np.einsum('bij,bj->bi', np.linalg.pinv(normal), gradient)
+        new_sse = _sse(p + step)
+        better = new_sse < sse
+        p[better] += step[better]
+        sse[better] = new_sse[better]
+        damping = np.clip(
+            np.where(better, damping / 3, damping * 3), 1e-9, 1e9
+        )
+        if not np.any(better) and np.all(damping > 1e6):
+            # no resample improves even on tiny steps
+            break
+    return p
+
+
+def _initial_guess(model: Model, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    if model == 'linear':
+        slope, intercept = np.polyfit(x, y, 1)
+        return np.array([intercept, slope])
+    # rising or falling between the densities at the outer concentrations
+    return np.array([y[0], y[-1], np.median(x), 1.0])
+
+
+@dataclass
+class DoseResponse:
+    model: Model
+    params: np.ndarray
+    # parameters of the bootstrap resamples (n_boot, n_params)
+    bootstrap: np.ndarray
+    # stand-in for zero concentrations (blanks) on the log scale
+    floor: float = 0.0
+
+    def _x(self, concentrations: np.ndarray) -> np.ndarray:
+        concentrations = np.asarray(concentrations, dtype=np.float64)
+        if self.model == 'linear':
+            return concentrations
+        return np.log10(np.maximum(concentrations, self.floor))
+
+    def predict(self, concentrations: np.ndarray) -> np.ndarray:
+        return _MODEL_FUNCS[self.model](
+            self._x(concentrations), self.params[np.newaxis]
+        )[0][0]
+
+    def band(
+        self, concentrations: np.ndarray, level: float = 0.95
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # pointwise bootstrap confidence band of the curve
+        curves = _MODEL_FUNCS[self.model](
+            self._x(concentrations), self.bootstrap
+        )[0]
+        return _interval(curves, level)
+
+    def invert(
+        self, densities: np.ndarray, level: float = 0.95
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # concentrations of measured densities with bootstrap confidence
+        # intervals of the curve, NaN outside of the calibrated range
+        densities = np.asarray(densities, dtype=np.float64)
+        estimate = self._inverse(self.params[np.newaxis], densities)[0]
+        low, high = _interval(
+            self._inverse(self.bootstrap, densities), level
+        )
+        return estimate, low, high
+
+    def _inverse(self, p: np.ndarray, densities: np.ndarray) -> np.ndarray:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if self.model == 'linear':
+                return (densities - p[:, :1]) / p[:, 1:2]
+            bottom, top, log_ec50, hill = (p[:, i:i+1] for i in range(4))
+            s = (densities - bottom) / (top - bottom)
+            s = np.where((s > 0) & (s < 1), s, np.nan)
+            return 10 ** (log_ec50 - np.log10(1 / s - 1) / hill)
+
+
+def _interval(
+    values: np.ndarray, level: float
+) -> Tuple[np.ndarray, np.ndarray]:
+    # nan aware, resamples may not reach every density
+    if values.shape[0] == 0:
+        nans = np.full(values.shape[1:], np.nan)
+        return nans, nans
+    alpha = (1 - level) / 2 * 100
+    with warnings.catch_warnings():
+        # all NaN slices, e.g. densities out of the calibrated range
+        warnings.simplefilter('ignore', RuntimeWarning)
+        low, high = np.nanpercentile(values, [alpha, 100 - alpha], axis=0)
+    return low, high
+
+
+def fit_dose_response(
+    concentrations: np.ndarray, densities: np.ndarray,
+    model: Model = 'linear', n_boot: int = 500,
+    seed: Optional[int] = 0
+) -> DoseResponse:
+    # Least squares fit of the densities of the calibrants, experiments are
+    # resampled with replacement for the bootstrap. All resamples are
+    # fitted at once on the per concentration sums.
+    concentrations = np.asarray(concentrations, dtype=np.float64)
+    densities = np.asarray(densities, dtype=np.float64)
+    levels, index = np.unique(concentrations, return_inverse=True)
+    if len(levels) < (min_levels := MIN_LEVELS[model]):
+        raise ValueError(
+            f"A {model} calibration needs at least {min_levels} "
+            f"concentrations, got {len(levels)}."
+        )
+    floor = 0.0
+    x = levels
+    if model == 'logistic':
+        # blanks three decades below the lowest concentration
+        floor = levels[levels > 0].min() / 1000
+        x = np.log10(np.maximum(levels, floor))
+
+    onehot = (index[:, np.newaxis] == np.arange(len(levels))).astype(float)
+
+    def _level_sums(counts):
+        # experiments and mean density per concentration level
+        weights = counts @ onehot
+        sums = (counts * densities) @ onehot
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return weights, np.where(weights > 0, sums / weights, 0.0)
+
+    weights, y = _level_sums(np.ones((1, len(densities))))
+    func = _MODEL_FUNCS[model]
+    params = _fit_batch(
+        func, x, y, weights, _initial_guess(model, x, y[0])
+    )[0]
+
+    rng = np.random.default_rng(seed)
+    counts = rng.multinomial(
+        len(densities), np.full(len(densities), 1 / len(densities)), n_boot
+    )
+    weights, y = _level_sums(counts)
+    bootstrap = _fit_batch(func, x, y, weights, params)
+    return DoseResponse(model, params, bootstrap, floor)
@@ -0,0 +1,133 @@
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+from fast5_research.fast5_bulk import BulkFast5
+
+from histogram import code_limit
+from instrumentation import span
+from raw_io import calibrate, get_calibration, iter_raw_chunks
+
+
+class EventTable:
+    # One row per event, i.e. per run of consecutive samples within the
+    # event band: first sample, duration [samples], mean and minimum
+    # current [pA].
+
+    def __init__(
+        self, start: np.ndarray, duration: np.ndarray, mean: np.ndarray,
+        minimum: np.ndarray, sample_rate: float = 1.0
+    ) -> None:
+        self.start = np.asarray(start, dtype=np.int64)
+        self.duration = np.asarray(duration, dtype=np.int64)
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.minimum = np.asarray(minimum, dtype=np.float64)
+        self.sample_rate: float = sample_rate
+
+    def __len__(self) -> int:
+        return len(self.start)
+
+    def dwell_times(self) -> np.ndarray:
+        # in seconds
+        return self.duration / self.sample_rate
+
+    def dwell_histogram(
+        self, bins: int = 50
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # (counts, edges) on log spaced bins, from one sample upwards
+        dwell = self.dwell_times()
+        low = 1 / self.sample_rate
+        high = max(float(dwell.max()) if len(dwell) else low, 2 * low)
+        edges = np.geomspace(low, high * (1 + 1e-9), bins + 1)
+        return np.histogram(dwell, edges)
+
+    def amplitude_histogram(
+        self, bins: int = 50, value_range: Optional[Tuple[float, float]] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # (counts, edges) of the mean event currents
+        return np.histogram(self.mean, bins, value_range)
+
+
+def _runs(
+    chunk: np.ndarray, low_band: float, high_band: float
+) -> Tuple[np.ndarray, np.ndarray]:
+    # [start, end) of the runs of samples within the band
+    inside = ((chunk >= low_band) & (chunk < high_band)).view(np.int8)
+    edges = np.flatnonzero(np.diff(inside, prepend=0, append=0))
+    return edges[::2], edges[1::2]
+
+
+def detect_events(
+    chunks: Iterable[np.ndarray], low_band: float, high_band: float,
+    start: int = 0, min_duration: int = 1, sample_rate: float = 1.0
+) -> EventTable:
+    # Run length encoding of the band membership, chunk by chunk. A run
+    # reaching the end of a chunk is carried over and merged with a run
+    # at the start of the next one, so chunk boundaries never split events.
+    parts: List[Tuple[np.ndarray, ...]] = []
+    carry: Optional[Tuple[np.ndarray, ...]] = None
+    pos = start
+    for chunk in chunks:
+        if len(chunk) == 0:
+            continue
+        starts, ends = _runs(chunk, low_band, high_band)
+        # sums and minima over [start, end) and the gaps in between, the
+        # padding keeps an end at the chunk length a valid index
+        padded = np.append(chunk, 0).astype(np.float64, copy=False)
+        limits = np.column_stack((starts, ends)).ravel()
+        if len(limits):
+            sums = np.add.reduceat(padded, limits)[::2]
+            mins = np.minimum.reduceat(padded, limits)[::2]
+        else:
+            sums = mins = np.zeros(0)
+        run = [starts + pos, ends - starts, sums, mins]
+        if carry is not None:
+            if len(starts) and starts[0] == 0:
+                run[0][0] = carry[0][0]
+                run[1][0] += carry[1][0]
+                run[2][0] += carry[2][0]
+                run[3][0] = min(run[3][0], carry[3][0])
+            else:
+                parts.append(carry)
+            carry = None
+        if len(ends) and ends[-1] == len(chunk):
+            carry = tuple(col[-1:] for col in run)
+            run = [col[:-1] for col in run]
+        parts.append(tuple(run))
+        pos += len(chunk)
+    if carry is not None:
+        parts.append(carry)
+
+    if not parts:
+        return EventTable([], [], [], [], sample_rate)
+    first, duration, sums, minimum = (
+        np.concatenate(cols) for cols in zip(*parts)
+    )
+    keep = duration >= min_duration
+    return EventTable(
+        first[keep], duration[keep], sums[keep] / duration[keep],
+        minimum[keep], sample_rate
+    )
+
+
+def get_channel_events(
+    fname: str, channel: int, burnin: int, low_band: float,
+    high_band: float, min_duration: int = 1
+) -> EventTable:
+    # Events of the post burnin signal, bands as of _sanitize_event_bands.
+    # Detected on the ADC codes, the band limits are converted to codes
+    # such that the same samples are within the band as for the band
+    # counts, low_band < value < high_band.
+    with span("events", channel=channel) as events_span, \
+            BulkFast5(fname) as fh:
+        calibration = get_calibration(fh, channel)
+        events = detect_events(
+            iter_raw_chunks(fh, channel, start=burnin, use_scaling=False),
+            code_limit(calibration, low_band, strict=True),
+            code_limit(calibration, high_band),
+            burnin, min_duration, fh.sample_rate
+        )
+        events_span.add(events=len(events))
+    return EventTable(
+        events.start, events.duration, calibrate(events.mean, calibration),
+        calibrate(events.minimum, calibration), events.sample_rate
+    )
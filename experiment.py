@@ -1,31 +1,68 @@
 from typing import Any, List, Literal, Dict, Optional, Tuple, Union
 
-from numpy import mean, median, std
-
-from utils import event_density, determine_scaling
+from band_table import BandTable
+from histogram import ChannelHistogram
+from timeline import DensityTimeline, TimelineKey
 
 
 class Experiment:
 
     def __init__(
-        self, fname, fpath, hashs, properties, band_distribution={}
+        self, fname, fpath, hashs, properties, band_distribution=None
     ) -> None:
         self.name: str = fname
         self.path: str = fpath
-        self.hashs: Dict[Literal['blake2b', 'md5', 'sha3'], str] = hashs
+        self.hashs: Dict[
+            Literal['blake2b', 'md5', 'sha3', 'sampled'], str
+        ] = hashs
         self.properties: Dict[str, Any] = properties
 
+        # one row per channel and band configuration, see band_distribution
+        # for the nested view
+        self.band_table: BandTable = BandTable.empty()
+        if band_distribution:
+            self.band_distribution = band_distribution
+        # {channel ids -> post burnin signal histogram}, active channels only
+        self.histograms: Dict[int, ChannelHistogram] = {}
+        # band counts over time of the active channels
+        self.timelines: Dict[TimelineKey, DensityTimeline] = {}
+        # row id in the experiment store, None until first saved
+        self.db_id: Optional[int] = None
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        # experiments pickled by older versions lack the histograms
+        state.setdefault('histograms', {})
+        state.setdefault('timelines', {})
+        state.setdefault('db_id', None)
+        # and kept their bands as nested dicts
+        if 'band_distribution' in state:
+            state['band_table'] = BandTable.from_band_distribution(
+                state.pop('band_distribution') or {}
+            )
+        self.__dict__.update(state)
+
+    @property
+    def band_distribution(self) -> Dict[int, Dict[
+        Literal['none', 'lower', 'upper', 'both'],
+        Dict[Tuple[float, float], Any]
+    ]]:
         # {channel ids ->
         #   {baseline scaling identifier ->
         #      {event boundaries -> (baseline, band distribution)}
         #   }
         # }
-        self.band_distribution: Optional[
-            Dict[int, Dict[
-                Literal['none', 'lower', 'upper', 'both'],
-                Dict[(float, float), Any]]
-            ]
-        ] = band_distribution
+        # built on access, prefer the band_table for queries
+        return self.band_table.to_band_distribution()
+
+    @band_distribution.setter
+    def band_distribution(self, band_distribution: Dict) -> None:
+        self.band_table = BandTable.from_band_distribution(band_distribution)
+
+    def update_bands(self, band_distribution: Dict) -> None:
+        # new results replace those of the same channel and bounds
+        self.band_table = self.band_table.update(
+            BandTable.from_band_distribution(band_distribution)
+        )
 
     def __str__(self) -> str:
         return '\n'.join(
@@ -37,75 +74,37 @@ class Experiment:
             ]
         )
 
+    def get_hash(self) -> str:
+        # full hash once known, the sampled fingerprint before that
+        if 'blake2b' in self.hashs:
+            return self.hashs['blake2b']
+        return f"sampled:{self.hashs['sampled']}"
+
     def get_active_channels(self) -> Optional[List[int]]:
-        if self.band_distribution == {}:
+        if len(self.band_table) == 0:
             return None
-        return list(self.band_distribution.keys())
+        return self.band_table.channels().tolist()
+
+    def has_histograms(self, burnin: int) -> bool:
+        return self.histograms != {} and all(
+            hist.burnin == burnin for hist in self.histograms.values()
+        )
 
     def get_baseline(self, channel: int) -> Optional[int]:
-        baseline = None
-        try:
-            baseline = next(iter(
-                next(iter(self.band_distribution[channel].values())).values()
-            ))[0]
-        except (KeyError, StopIteration):
+        if (found := self.band_table.lookup(channel)) is None:
             return None
-        return baseline
+        return found[0]
 
     def get_mean_baselines(
         self, event_low: Union[float, int],
         event_high: Union[float, int], filter_mad: bool = True
     ) -> Tuple[float, float]:
-        if self.band_distribution == {}:
-            return None
-
-        scaling = determine_scaling(event_low, event_high)
-        try:
-            band_dict = {
-                c: val[scaling][(event_low, event_high)]
-                for c, val in self.band_distribution.items()
-            }
-        except KeyError:
-            return None
-        baselines = [val[0] for val in band_dict.values()]
-        if filter_mad:
-            bl_median = median(baselines)
-            bl_mad = median([abs(bl - bl_median) for bl in baselines])
-            baselines = [
-                bl for bl in baselines if abs(bl - bl_median) < 3*bl_mad
-            ]
-        return (round(mean(baselines), 2), round(std(baselines), 3))
+        return self.band_table.mean_baselines(
+            event_low, event_high, filter_mad
+        )
 
     def get_mean_events(
         self, event_low: Union[float, int],
         event_high: Union[float, int], filter_mad=True
     ) -> Tuple[float, float]:
-        if self.band_distribution == {}:
-            return None
-
-        scaling = determine_scaling(event_low, event_high)
-        try:
-            band_dict = {
-                c: val[scaling][(event_low, event_high)]
-                for c, val in self.band_distribution.items()
-            }
-        except KeyError:
-            return None
-
-        if filter_mad:
-            baselines = {k: v[0] for k, v in band_dict.items()}
-            bl_median = median(list(baselines.values()))
-            bl_mad = median([abs(bl - bl_median) for bl in baselines.values()])
-            indizes = [
-                k for k, bl in baselines.items()
-                if abs(bl - bl_median) < 3*bl_mad
-            ]
-            events = [
-                event_density(v[1]) for k, v in band_dict.items()
-                if k in indizes
-            ]
-        else:
-            events = [
-                event_density(v[1]) for v in band_dict.values()
-            ]
-        return (round(mean(events), 4), round(std(events), 3))
+        return self.band_table.mean_events(event_low, event_high, filter_mad)
@@ -0,0 +1,611 @@
+from collections import Counter
+from collections.abc import MutableMapping
+import json
+from pathlib import Path
+import pickle
+import sqlite3
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple, Union
+
+import numpy as np
+
+from band_table import BandKey, BandTable, SCALINGS
+from experiment import Experiment
+from fingerprint import FileFingerprint
+from histogram import ChannelHistogram, binned_codes
+from timeline import DensityTimeline, TimelineKey
+from utils import determine_scaling
+
+SQLITE_HEADER = b"SQLite format 3\x00"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS experiments (
+    id INTEGER PRIMARY KEY,
+    key TEXT UNIQUE NOT NULL,
+    name TEXT NOT NULL,
+    path TEXT,
+    blake2b TEXT,
+    sampled TEXT,
+    concentration REAL,
+    properties TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS experiments_blake2b ON experiments (blake2b);
+CREATE INDEX IF NOT EXISTS experiments_sampled ON experiments (sampled);
+CREATE INDEX IF NOT EXISTS experiments_name ON experiments (name);
+CREATE INDEX IF NOT EXISTS experiments_concentration
+    ON experiments (concentration);
+-- event bounds are untyped to keep int (pA) and float (scaled) apart
+CREATE TABLE IF NOT EXISTS channel_results (
+    experiment_id INTEGER NOT NULL
+        REFERENCES experiments (id) ON DELETE CASCADE,
+    channel INTEGER NOT NULL,
+    scaling TEXT NOT NULL,
+    event_low NOT NULL,
+    event_high NOT NULL,
+    baseline INTEGER NOT NULL,
+    low_outs INTEGER NOT NULL,
+    high_outs INTEGER NOT NULL,
+    heavy_outs INTEGER NOT NULL,
+    zeroes INTEGER NOT NULL,
+    events INTEGER NOT NULL,
+    baseline_count INTEGER NOT NULL,
+    PRIMARY KEY (experiment_id, channel, scaling, event_low, event_high)
+);
+-- results of one band setting across experiments, e.g. for calibration
+CREATE INDEX IF NOT EXISTS channel_results_bands
+    ON channel_results (scaling, event_low, event_high);
+CREATE TABLE IF NOT EXISTS channel_histograms (
+    experiment_id INTEGER NOT NULL
+        REFERENCES experiments (id) ON DELETE CASCADE,
+    channel INTEGER NOT NULL,
+    burnin INTEGER NOT NULL,
+    resolution REAL NOT NULL,
+    low REAL NOT NULL,
+    underflow INTEGER NOT NULL,
+    overflow INTEGER NOT NULL,
+    mean REAL NOT NULL,
+    std REAL,
+    baseline INTEGER,
+    -- uint32 bins, empty where they follow from the codes
+    counts BLOB NOT NULL,
+    baseline_mad REAL,
+    -- occupied ADC codes (int16), their counts (uint32) and calibration
+    codes BLOB,
+    code_counts BLOB,
+    code_offset REAL,
+    raw_unit REAL,
+    PRIMARY KEY (experiment_id, channel)
+);
+-- band counts per time window of all active channels, channels holds
+-- their ids (int16), counts the (channel, window, count) uint32 array
+CREATE TABLE IF NOT EXISTS channel_timelines (
+    experiment_id INTEGER NOT NULL
+        REFERENCES experiments (id) ON DELETE CASCADE,
+    burnin INTEGER NOT NULL,
+    window_seconds REAL NOT NULL,
+    scaling TEXT NOT NULL,
+    event_low NOT NULL,
+    event_high NOT NULL,
+    window INTEGER NOT NULL,
+    sample_rate REAL NOT NULL,
+    channels BLOB NOT NULL,
+    counts BLOB NOT NULL,
+    PRIMARY KEY (
+        experiment_id, burnin, window_seconds, scaling, event_low, event_high
+    )
+);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sample_digest TEXT NOT NULL,
+    full_hash TEXT
+);
+"""
+
+
+class ExperimentStore(MutableMapping):
+    # SQLite backed mapping of experiment keys (file hashes) to experiments.
+    # Experiments are read on first access, save() only writes experiment
+    # rows that changed and channel results not yet in the database.
+
+    def __init__(self, db_path: Optional[Union[str, Path]] = None) -> None:
+        # without a path, the store lives in memory until saved to a file
+        self.db_path: Optional[Path] = None if db_path is None \
+            else Path(db_path)
+        if self.db_path is not None and _is_pickle_db(self.db_path):
+            _migrate_pickle_db(self.db_path)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(
+            ":memory:" if self.db_path is None else str(self.db_path),
+            check_same_thread=False
+        )
+        self._conn.execute("PRAGMA foreign_keys = ON")
+        self._conn.executescript(_SCHEMA)
+        self._add_columns()
+
+        self._loaded: Dict[str, Experiment] = {}
+        self._deleted_ids: Set[int] = set()
+        # what is known to be in the database, per experiment id
+        self._saved_meta: Dict[int, Tuple] = {}
+        # baseline and counts as written, per band key
+        self._saved_bands: Dict[int, Dict[BandKey, Tuple]] = {}
+        # band tables are replaced rather than changed on updates
+        self._saved_tables: Dict[int, BandTable] = {}
+        self._saved_hists: Dict[int, Dict[int, ChannelHistogram]] = {}
+        self._saved_timelines: Dict[
+            int, Dict[TimelineKey, DensityTimeline]
+        ] = {}
+        self._saved_fingerprints: Dict[
+            str, Tuple[FileFingerprint, Optional[str]]
+        ] = {}
+
+    def _add_columns(self) -> None:
+        # columns added to tables of existing databases
+        columns = {
+            row[1] for row in self._conn.execute(
+                "PRAGMA table_info(channel_histograms)"
+            )
+        }
+        added = [
+            ('baseline_mad', 'REAL'), ('codes', 'BLOB'),
+            ('code_counts', 'BLOB'), ('code_offset', 'REAL'),
+            ('raw_unit', 'REAL')
+        ]
+        with self._conn:
+            for name, kind in added:
+                if name not in columns:
+                    self._conn.execute(
+                        "ALTER TABLE channel_histograms "
+                        f"ADD COLUMN {name} {kind}"
+                    )
+
+    # ################ Mapping interface ######################################
+    def __getitem__(self, key: str) -> Experiment:
+        with self._lock:
+            if key not in self._loaded:
+                self._loaded[key] = self._load_experiment(key)
+            return self._loaded[key]
+
+    def __setitem__(self, key: str, exp: Experiment) -> None:
+        with self._lock:
+            self._loaded[key] = exp
+            if exp.db_id is not None:
+                self._deleted_ids.discard(exp.db_id)
+
+    def __delitem__(self, key: str) -> None:
+        with self._lock:
+            exp = self[key]
+            del self._loaded[key]
+            if exp.db_id is not None:
+                self._deleted_ids.add(exp.db_id)
+
+    def __contains__(self, key: object) -> bool:
+        with self._lock:
+            if key in self._loaded:
+                return True
+            return self._stored_id(key) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        with self._lock:
+            keys = list(self._loaded.keys())
+            for key, db_id in self._conn.execute(
+                "SELECT key, id FROM experiments"
+            ):
+                if self._is_visible(db_id):
+                    keys.append(key)
+        return iter(keys)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def find_by_sampled(self, identity: str) -> Optional[str]:
+        with self._lock:
+            for key, exp in self._loaded.items():
+                if exp.hashs.get('sampled') == identity:
+                    return key
+            for key, db_id in self._conn.execute(
+                "SELECT key, id FROM experiments WHERE sampled = ?",
+                (identity,)
+            ):
+                if self._is_visible(db_id):
+                    return key
+        return None
+
+    def band_results(
+        self, event_low: Union[float, int], event_high: Union[float, int]
+    ) -> Tuple[List[str], List[str], np.ndarray, np.ndarray, BandTable]:
+        # channel results of all experiments for one band setting, without
+        # loading any experiment: (keys, names, concentrations) per
+        # experiment, the experiment index per row and the rows themselves
+        scaling = determine_scaling(event_low, event_high)
+        with self._lock:
+            # pending results and key changes first
+            self.save()
+            experiments = self._conn.execute(
+                "SELECT id, key, name, concentration FROM experiments "
+                "ORDER BY id"
+            ).fetchall()
+            rows = self._conn.execute(
+                "SELECT experiment_id, channel, baseline, low_outs, "
+                "high_outs, heavy_outs, zeroes, events, baseline_count "
+                "FROM channel_results WHERE scaling = ? AND event_low = ? "
+                "AND event_high = ? ORDER BY experiment_id, channel",
+                (scaling, event_low, event_high)
+            ).fetchall()
+            n_channels = dict(self._conn.execute(
+                "SELECT experiment_id, COUNT(DISTINCT channel) "
+                "FROM channel_results GROUP BY experiment_id"
+            ))
+        # experiments with channels lacking the bounds have no results,
+        # as Experiment.get_mean_events
+        n_rows = Counter(row[0] for row in rows)
+        rows = [row for row in rows if n_rows[row[0]] == n_channels[row[0]]]
+        db_ids = np.array([row[0] for row in experiments], dtype=np.int64)
+        concentrations = np.array(
+            [np.nan if row[3] is None else row[3] for row in experiments],
+            dtype=np.float64
+        )
+        columns = np.array(rows, dtype=np.int64).reshape(-1, 9)
+        table = BandTable(
+            columns[:, 1], np.full(len(rows), SCALINGS.index(scaling)),
+            np.full(len(rows), event_low), np.full(len(rows), event_high),
+            columns[:, 2], columns[:, 3:]
+        )
+        return (
+            [row[1] for row in experiments], [row[2] for row in experiments],
+            concentrations, np.searchsorted(db_ids, columns[:, 0]), table
+        )
+
+    # ################ Loading ################################################
+    def _is_visible(self, db_id: int) -> bool:
+        # rows of deleted experiments and stale keys of loaded (possibly
+        # re-keyed) experiments are hidden until the next save
+        return db_id not in self._deleted_ids and all(
+            exp.db_id != db_id for exp in self._loaded.values()
+        )
+
+    def _stored_id(self, key: str) -> Optional[int]:
+        row = self._conn.execute(
+            "SELECT id FROM experiments WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or not self._is_visible(row[0]):
+            return None
+        return row[0]
+
+    def _load_experiment(self, key: str) -> Experiment:
+        row = self._conn.execute(
+            "SELECT id, name, path, blake2b, sampled, properties "
+            "FROM experiments WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or not self._is_visible(row[0]):
+            raise KeyError(key)
+        db_id, name, fpath, blake2b, sampled, properties = row
+        hashs = {'blake2b': blake2b, 'sampled': sampled}
+        exp = Experiment(
+            name, fpath, {k: v for k, v in hashs.items() if v is not None},
+            json.loads(properties)
+        )
+        exp.db_id = db_id
+
+        rows = self._conn.execute(
+            "SELECT channel, scaling, event_low, event_high, baseline, "
+            "low_outs, high_outs, heavy_outs, zeroes, events, baseline_count "
+            "FROM channel_results WHERE experiment_id = ? ORDER BY channel",
+            (db_id,)
+        ).fetchall()
+        saved_bands = {tuple(row[:4]): tuple(row[4:]) for row in rows}
+        if rows:
+            # straight into the columns of the band table
+            channel, scaling, event_low, event_high, baseline, *counts = \
+                zip(*rows)
+            exp.band_table = BandTable(
+                channel, [SCALINGS.index(name) for name in scaling],
+                event_low, event_high, baseline, np.column_stack(counts)
+            )
+
+        for (
+            channel, burnin, resolution, low, underflow, overflow,
+            mean, std, baseline, counts, baseline_mad, codes, code_counts,
+            code_offset, raw_unit
+        ) in self._conn.execute(
+            "SELECT channel, burnin, resolution, low, underflow, overflow, "
+            "mean, std, baseline, counts, baseline_mad, codes, code_counts, "
+            "code_offset, raw_unit FROM channel_histograms "
+            "WHERE experiment_id = ? ORDER BY channel", (db_id,)
+        ):
+            # histograms saved before the codes were kept have none, the
+            # bins of all others follow from their codes
+            calibration = None
+            if codes is not None:
+                codes = np.frombuffer(codes, dtype=np.int16).copy()
+                code_counts = np.frombuffer(
+                    code_counts, dtype=np.uint32
+                ).copy()
+                calibration = (code_offset, raw_unit)
+                bins = binned_codes(
+                    codes, code_counts, calibration, resolution, low
+                )[1:-1].astype(np.uint32)
+            else:
+                bins = np.frombuffer(counts, dtype=np.uint32).copy()
+            exp.histograms[channel] = ChannelHistogram(
+                bins, underflow, overflow, mean, baseline, burnin,
+                resolution, low, std, baseline_mad, codes, code_counts,
+                calibration
+            )
+
+        for (
+            burnin, window_seconds, scaling, event_low, event_high, window,
+            sample_rate, channels, counts
+        ) in self._conn.execute(
+            "SELECT burnin, window_seconds, scaling, event_low, event_high, "
+            "window, sample_rate, channels, counts FROM channel_timelines "
+            "WHERE experiment_id = ?", (db_id,)
+        ):
+            exp.timelines[
+                (burnin, window_seconds, scaling, event_low, event_high)
+            ] = DensityTimeline(
+                np.frombuffer(channels, dtype=np.int16),
+                np.frombuffer(counts, dtype=np.uint32).copy(),
+                window, burnin, sample_rate
+            )
+
+        self._saved_meta[db_id] = self._meta_row(key, exp)
+        self._saved_bands[db_id] = saved_bands
+        self._saved_tables[db_id] = exp.band_table
+        self._saved_hists[db_id] = dict(exp.histograms)
+        self._saved_timelines[db_id] = dict(exp.timelines)
+        return exp
+
+    def load_settings(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                key: json.loads(value) for key, value
+                in self._conn.execute("SELECT key, value FROM settings")
+            }
+
+    def load_fingerprints(
+        self
+    ) -> Dict[str, Tuple[FileFingerprint, Optional[str]]]:
+        with self._lock:
+            fingerprints = {
+                fpath: (FileFingerprint(size, mtime_ns, digest), full_hash)
+                for fpath, size, mtime_ns, digest, full_hash
+                in self._conn.execute(
+                    "SELECT path, size, mtime_ns, sample_digest, full_hash "
+                    "FROM fingerprints"
+                )
+            }
+            self._saved_fingerprints = dict(fingerprints)
+        return fingerprints
+
+    # ################ Saving #################################################
+    def save(
+        self, settings: Optional[Dict[str, Any]] = None,
+        fingerprints: Optional[
+            Dict[str, Tuple[FileFingerprint, Optional[str]]]
+        ] = None
+    ) -> None:
+        with self._lock, self._conn:
+            if self._deleted_ids:
+                self._conn.executemany(
+                    "DELETE FROM experiments WHERE id = ?",
+                    [(db_id,) for db_id in self._deleted_ids]
+                )
+                for db_id in self._deleted_ids:
+                    self._forget(db_id)
+                self._deleted_ids.clear()
+            # free the keys of re-keyed experiments before writing new ones
+            self._conn.executemany(
+                "UPDATE experiments SET key = '~' || id WHERE id = ?",
+                [
+                    (exp.db_id,) for key, exp in self._loaded.items()
+                    if exp.db_id is not None
+                    and self._saved_meta[exp.db_id][0] != key
+                ]
+            )
+            for key, exp in self._loaded.items():
+                self._save_experiment(key, exp)
+            if settings is not None:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO settings (key, value) "
+                    "VALUES (?, ?)",
+                    [(k, json.dumps(v)) for k, v in settings.items()]
+                )
+            if fingerprints is not None:
+                self._save_fingerprints(fingerprints)
+
+    def _meta_row(self, key: str, exp: Experiment) -> Tuple:
+        conc = exp.properties.get('concentration')
+        return (
+            key, exp.name, str(exp.path), exp.hashs.get('blake2b'),
+            exp.hashs.get('sampled'),
+            None if conc is None or np.isnan(conc) else float(conc),
+            json.dumps(exp.properties)
+        )
+
+    def _save_experiment(self, key: str, exp: Experiment) -> None:
+        meta = self._meta_row(key, exp)
+        if exp.db_id is None:
+            exp.db_id = self._conn.execute(
+                "INSERT INTO experiments (key, name, path, blake2b, sampled, "
+                "concentration, properties) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                meta
+            ).lastrowid
+            self._saved_bands[exp.db_id] = {}
+            self._saved_hists[exp.db_id] = {}
+            self._saved_timelines[exp.db_id] = {}
+        elif self._saved_meta[exp.db_id] != meta:
+            self._conn.execute(
+                "UPDATE experiments SET key = ?, name = ?, path = ?, "
+                "blake2b = ?, sampled = ?, concentration = ?, "
+                "properties = ? WHERE id = ?", (*meta, exp.db_id)
+            )
+        self._saved_meta[exp.db_id] = meta
+
+        if self._saved_tables.get(exp.db_id) is not exp.band_table:
+            self._save_bands(exp)
+
+        saved_hists = self._saved_hists[exp.db_id]
+        self._conn.executemany(
+            "DELETE FROM channel_histograms "
+            "WHERE experiment_id = ? AND channel = ?",
+            [
+                (exp.db_id, channel) for channel in saved_hists
+                if channel not in exp.histograms
+            ]
+        )
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO channel_histograms VALUES "
+            "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    exp.db_id, channel, hist.burnin, hist.resolution,
+                    hist.low, hist.underflow, hist.overflow, hist.mean,
+                    hist.std, hist.baseline, _counts_column(hist),
+                    hist.baseline_mad, *_code_columns(hist)
+                )
+                for channel, hist in exp.histograms.items()
+                if saved_hists.get(channel) is not hist
+            ]
+        )
+        self._saved_hists[exp.db_id] = dict(exp.histograms)
+
+        saved_timelines = self._saved_timelines[exp.db_id]
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO channel_timelines VALUES "
+            "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    exp.db_id, *timeline_key, timeline.window,
+                    timeline.sample_rate, timeline.channels.tobytes(),
+                    timeline.counts.tobytes()
+                )
+                for timeline_key, timeline in exp.timelines.items()
+                if saved_timelines.get(timeline_key) is not timeline
+            ]
+        )
+        self._saved_timelines[exp.db_id] = dict(exp.timelines)
+
+    def _save_bands(self, exp: Experiment) -> None:
+        saved_bands = self._saved_bands[exp.db_id]
+        new_rows = []
+        # rows replaced by BandTable.update are written again
+        for band_key, baseline, band in exp.band_table.rows():
+            values = (
+                baseline, *band['outlier'], band['zeroes'], band['events'],
+                band['baseline']
+            )
+            if saved_bands.get(band_key) == values:
+                continue
+            new_rows.append((exp.db_id, *band_key, *values))
+            saved_bands[band_key] = values
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO channel_results VALUES "
+            "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", new_rows
+        )
+        self._saved_tables[exp.db_id] = exp.band_table
+
+    def _save_fingerprints(
+        self, fingerprints: Dict[str, Tuple[FileFingerprint, Optional[str]]]
+    ) -> None:
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?, ?)",
+            [
+                (
+                    fpath, fingerprint.size, fingerprint.mtime_ns,
+                    fingerprint.sample_digest, full_hash
+                )
+                for fpath, (fingerprint, full_hash) in fingerprints.items()
+                if self._saved_fingerprints.get(fpath)
+                != (fingerprint, full_hash)
+            ]
+        )
+        self._saved_fingerprints = dict(fingerprints)
+
+    def _forget(self, db_id: int) -> None:
+        self._saved_meta.pop(db_id, None)
+        self._saved_bands.pop(db_id, None)
+        self._saved_tables.pop(db_id, None)
+        self._saved_hists.pop(db_id, None)
+        self._saved_timelines.pop(db_id, None)
+
+    def save_as(self, db_path: Union[str, Path]) -> 'ExperimentStore':
+        # copy everything (e.g. of an in-memory store) to a new file and
+        # continue with the loaded experiments on the copy
+        with self._lock:
+            self.save()
+            # replaces whatever was stored at the path before
+            Path(db_path).unlink(missing_ok=True)
+            target = sqlite3.connect(str(db_path))
+            with target:
+                self._conn.backup(target)
+            target.close()
+            store = ExperimentStore(db_path)
+            store._loaded = dict(self._loaded)
+            store._saved_meta = dict(self._saved_meta)
+            store._saved_bands = {
+                k: dict(v) for k, v in self._saved_bands.items()
+            }
+            store._saved_tables = dict(self._saved_tables)
+            store._saved_hists = {
+                k: dict(v) for k, v in self._saved_hists.items()
+            }
+            store._saved_timelines = {
+                k: dict(v) for k, v in self._saved_timelines.items()
+            }
+            store._saved_fingerprints = dict(self._saved_fingerprints)
+        return store
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+# ################ Migration ##################################################
+def _counts_column(hist: ChannelHistogram) -> bytes:
+    # the bins only for histograms without codes, empty otherwise
+    if hist.codes is not None:
+        return b""
+    return hist.counts.astype(np.uint32).tobytes()
+
+
+def _code_columns(hist: ChannelHistogram) -> Tuple:
+    # codes, code_counts, code_offset and raw_unit of a histogram
+    if hist.codes is None:
+        return (None, None, None, None)
+    return (
+        hist.codes.astype(np.int16).tobytes(),
+        hist.code_counts.astype(np.uint32).tobytes(), *hist.calibration
+    )
+
+
+def _is_pickle_db(db_path: Path) -> bool:
+    if not db_path.is_file() or db_path.stat().st_size == 0:
+        return False
+    with open(db_path, 'rb') as fh:
+        return fh.read(len(SQLITE_HEADER)) != SQLITE_HEADER
+
+
+def _migrate_pickle_db(db_path: Path) -> None:
+    # one time conversion of the former pickled experiment dump,
+    # the original file is kept next to the new database
+    with open(db_path, 'rb') as fh:
+        exp_dict = pickle.load(fh)
+    backup = db_path.with_name(db_path.name + ".pickle.bak")
+    db_path.rename(backup)
+    print(f"Migrating {db_path} to SQLite, pickle kept as {backup}")
+
+    store = ExperimentStore(db_path)
+    for key, exp in exp_dict.get('exps', {}).items():
+        exp.db_id = None
+        store[key] = exp
+    store.save(
+        exp_dict.get('settings') or {},
+        exp_dict.get('fingerprints', {})
+    )
+    store.close()
@@ -0,0 +1,70 @@
+from dataclasses import dataclass
+import hashlib
+import mmap
+import os
+import threading
+from typing import Callable, Optional
+
+from instrumentation import span
+
+
+@dataclass(frozen=True)
+class FileFingerprint:
+    # Cheap file identity from the size and a digest of a few blocks spread
+    # over the file. Unlike the full hash it is available right away,
+    # the mtime only serves to detect changed files at a known path.
+    size: int
+    mtime_ns: int
+    sample_digest: str
+
+    @property
+    def identity(self) -> str:
+        return f"{self.size}-{self.sample_digest}"
+
+
+def get_fingerprint(
+    fpath: str, n_blocks: int = 16, block_size: int = 65_536
+) -> FileFingerprint:
+    stat = os.stat(fpath)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(stat.st_size.to_bytes(8, 'little'))
+    with open(fpath, 'rb') as fh:
+        last = max(0, stat.st_size - block_size)
+        for i in range(n_blocks):
+            fh.seek(i * last // max(1, n_blocks - 1))
+            digest.update(fh.read(block_size))
+    return FileFingerprint(stat.st_size, stat.st_mtime_ns, digest.hexdigest())
+
+
+def hash_file(
+    fpath: str, algo: str = 'blake2b', block_size: int = 16 * 2**20
+) -> str:
+    # full content hash, read through mmap in large blocks
+    digest = hashlib.new(algo)
+    with open(fpath, 'rb') as fh, span("hash", algo=algo) as hash_span:
+        if (size := os.fstat(fh.fileno()).st_size) == 0:
+            return digest.hexdigest()
+        hash_span.add(bytes_read=size)
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with memoryview(mm) as view:
+                for start in range(0, len(view), block_size):
+                    digest.update(view[start:start + block_size])
+    return digest.hexdigest()
+
+
+def hash_file_async(
+    fpath: str, callback: Callable[[str, Optional[str]], None],
+    algo: str = 'blake2b'
+) -> threading.Thread:
+    # callback receives the path and the hash (None if hashing failed)
+    def _run():
+        try:
+            file_hash = hash_file(fpath, algo)
+        except OSError as e:
+            print(e)
+            file_hash = None
+        callback(fpath, file_hash)
+
+    thread = threading.Thread(target=_run, daemon=True)
+    thread.start()
+    return thread
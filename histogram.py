@@ -0,0 +1,309 @@
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+import numpy as np
+
+from raw_io import Calibration, calibrate
+
+# all band limits (outliers, zeroes, baseline window, event bands)
+# lie within this range, values outside only count as heavy outliers
+HIST_RANGE = (-100.0, 400.0)
+HIST_RESOLUTION = 0.1
+# raw signals of bulk files are stored as int16 ADC codes
+ADC_CODES = 2**16
+
+
+def bin_indices(
+    chunk: np.ndarray, low: float, resolution: float, n_bins: int
+) -> np.ndarray:
+    # bin -1 collects the underflow, bin n_bins the overflow
+    idx = np.floor((chunk - low) * (1 / resolution))
+    np.clip(idx, -1, n_bins, out=idx)
+    return idx.astype(np.intp)
+
+
+def _weighted_median(values: np.ndarray, counts: np.ndarray) -> float:
+    # np.median of values repeated counts times, values sorted
+    cum_counts = np.cumsum(counts)
+    n = int(cum_counts[-1])
+    lower, upper = np.searchsorted(
+        cum_counts, ((n - 1) // 2, n // 2), side='right'
+    )
+    return float((values[lower] + values[upper]) / 2)
+
+
+def band_masks(
+    values: np.ndarray, low_band: float, high_band: float, baseline: int
+) -> np.ndarray:
+    # (len(values), 6) membership of values in the low, high and heavy
+    # outliers, zeroes, events and baseline (band_table.COUNT_COLUMNS),
+    # the comparisons of the band counts of calibrated samples
+    return np.column_stack((
+        (-100 < values) & (values < -5),
+        (baseline + 30 < values) & (values < 350),
+        (values <= -100) | (max(350, baseline + 30) <= values),
+        (-5 <= values) & (values <= 5),
+        (low_band < values) & (values < high_band),
+        (baseline - 30 <= values) & (values <= baseline + 30),
+    ))
+
+
+def binned_codes(
+    codes: np.ndarray, code_counts: np.ndarray, calibration: Calibration,
+    resolution: float = HIST_RESOLUTION, low: float = HIST_RANGE[0]
+) -> np.ndarray:
+    # histogram bins of the samples of the codes up to HIST_RANGE, the
+    # underflow first and the overflow last
+    n_bins = int(round((HIST_RANGE[1] - low) / resolution))
+    bins = bin_indices(
+        calibrate(codes, calibration), low, resolution, n_bins
+    )
+    # float weights are exact far beyond any channel length
+    return np.bincount(
+        bins + 1, weights=code_counts, minlength=n_bins + 2
+    ).astype(np.int64)
+
+
+def code_values(calibration: Calibration) -> np.ndarray:
+    # calibrated value of every int16 code, indexed by the code itself:
+    # negative codes count from the end like negative numpy indices, so
+    # code_values(...)[codes] calibrates an array of codes
+    codes = np.arange(ADC_CODES, dtype=np.uint16).view(np.int16)
+    return calibrate(codes, calibration)
+
+
+def _in_order(table: np.ndarray) -> np.ndarray:
+    # a table indexed by code, from the smallest code to the largest one
+    return np.roll(table, ADC_CODES // 2)
+
+
+def code_limit(
+    calibration: Calibration, value: float, strict: bool = False
+) -> int:
+    # smallest code calibrated to value or more (above value if strict),
+    # so the samples below value (up to value) are exactly those with
+    # smaller codes
+    values = _in_order(code_values(calibration))
+    side = 'right' if strict else 'left'
+    return int(np.searchsorted(values, value, side)) - ADC_CODES // 2
+
+
+class CodeHistogram:
+    # Exact histogram of the ADC codes of a channel, one bin per code.
+    # Every code stands for a single calibrated value, so medians follow
+    # exactly in constant memory.
+
+    def __init__(self, calibration: Calibration) -> None:
+        self.calibration: Calibration = calibration
+        # indexed like code_values
+        self.counts: np.ndarray = np.zeros(ADC_CODES, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return int(self.counts.sum())
+
+    def add(self, codes: np.ndarray) -> None:
+        # the bit patterns of the codes are their indices
+        self.counts += np.bincount(
+            codes.astype(np.int16, copy=False).view(np.uint16),
+            minlength=ADC_CODES
+        )
+
+    def occupied(self) -> Tuple[np.ndarray, np.ndarray]:
+        # the codes seen, increasing, and their counts
+        counts = _in_order(self.counts)
+        idx = np.flatnonzero(counts)
+        return (idx - ADC_CODES // 2).astype(np.int16), counts[idx]
+
+    def mean(self) -> float:
+        # of the calibrated values, from the exact sum of the codes
+        if (n := len(self)) == 0:
+            return 0.0
+        codes, counts = self.occupied()
+        offset, raw_unit = self.calibration
+        return float(
+            (int(counts @ codes.astype(np.int64)) / n + offset) * raw_unit
+        )
+
+    def std(self) -> float:
+        # sample standard deviation of the calibrated values
+        if (n := len(self)) < 2:
+            return 0.0
+        codes, counts = self.occupied()
+        codes = codes.astype(np.float64)
+        mean = counts @ codes / n
+        variance = counts @ (codes - mean)**2 / (n - 1)
+        return float(np.sqrt(variance) * abs(self.calibration[1]))
+
+    def _window(
+        self, lower: float, upper: float
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # values and counts of the samples within (lower, upper)
+        codes, counts = self.occupied()
+        values = calibrate(codes, self.calibration)
+        first, last = np.searchsorted(values, lower, side='right'), \
+            np.searchsorted(values, upper, side='left')
+        return values[first:last], counts[first:last]
+
+    def median(self, lower: float, upper: float) -> Optional[float]:
+        # np.median of the samples within (lower, upper), None if empty
+        values, counts = self._window(lower, upper)
+        if counts.sum() == 0:
+            return None
+        return _weighted_median(values, counts)
+
+    def mad(self, lower: float, upper: float) -> Optional[float]:
+        # median absolute deviation from the median within (lower, upper)
+        if (median := self.median(lower, upper)) is None:
+            return None
+        values, counts = self._window(lower, upper)
+        deviations = np.abs(values - median)
+        order = np.argsort(deviations, kind='stable')
+        return _weighted_median(deviations[order], counts[order])
+
+
+class ChannelHistogram:
+    # Fixed resolution histogram of the post burnin signal of a channel.
+    # Band counts for arbitrary event bands follow from the occupied ADC
+    # codes and their counts, exactly as from the calibrated samples, so
+    # changing the bands never touches the raw data again. Histograms
+    # recorded without the codes fall back to cumulative bin sums.
+
+    def __init__(
+        self, counts: np.ndarray, underflow: int, overflow: int,
+        mean: float, baseline: Optional[int], burnin: int,
+        resolution: float = HIST_RESOLUTION, low: float = HIST_RANGE[0],
+        std: Optional[float] = None, baseline_mad: Optional[float] = None,
+        codes: Optional[np.ndarray] = None,
+        code_counts: Optional[np.ndarray] = None,
+        calibration: Optional[Calibration] = None
+    ) -> None:
+        self.counts: np.ndarray = counts
+        self.underflow: int = underflow
+        self.overflow: int = overflow
+        self.mean: float = mean
+        # sample standard deviation, needed for kde bandwidths
+        self.std: Optional[float] = std
+        # None for inactive channels
+        self.baseline: Optional[int] = baseline
+        # median absolute deviation within the baseline window
+        self.baseline_mad: Optional[float] = baseline_mad
+        self.burnin: int = burnin
+        self.resolution: float = resolution
+        self.low: float = low
+        # occupied ADC codes, increasing, their counts and calibration
+        self.codes: Optional[np.ndarray] = codes
+        self.code_counts: Optional[np.ndarray] = code_counts
+        self.calibration: Optional[Calibration] = calibration
+
+    @classmethod
+    def from_adc_chunks(
+        cls, chunks: Iterable[np.ndarray], burnin: int,
+        calibration: Calibration, resolution: float = HIST_RESOLUTION
+    ) -> Tuple['ChannelHistogram', CodeHistogram]:
+        # Only the integer codes are counted, the calibrated histogram
+        # follows from the values of the codes once. Its bins are the same
+        # as those of the calibrated samples.
+        codes = CodeHistogram(calibration)
+        for chunk in chunks:
+            codes.add(chunk)
+        return cls.from_codes(codes, burnin, resolution), codes
+
+    @classmethod
+    def from_codes(
+        cls, codes: CodeHistogram, burnin: int,
+        resolution: float = HIST_RESOLUTION
+    ) -> 'ChannelHistogram':
+        low = HIST_RANGE[0]
+        seen, code_counts = codes.occupied()
+        counts = binned_codes(
+            seen, code_counts, codes.calibration, resolution, low
+        )
+        return cls(
+            counts[1:-1].astype(np.uint32), int(counts[0]), int(counts[-1]),
+            codes.mean(), None, burnin, resolution, low, codes.std(),
+            codes=seen, code_counts=code_counts.astype(np.uint32),
+            calibration=codes.calibration
+        )
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        # histograms pickled before the std or MAD were recorded
+        state.setdefault('std', None)
+        state.setdefault('baseline_mad', None)
+        # and before the codes were kept
+        for key in ('codes', 'code_counts', 'calibration'):
+            state.setdefault(key, None)
+        self.__dict__.update(state)
+
+    def __len__(self) -> int:
+        return int(self.counts.sum()) + self.underflow + self.overflow
+
+    @property
+    def bin_edges(self) -> np.ndarray:
+        return self.low + self.resolution * np.arange(len(self.counts) + 1)
+
+    @property
+    def bin_centers(self) -> np.ndarray:
+        return self.bin_edges[:-1] + 0.5 * self.resolution
+
+    def quantile(self, q: float) -> float:
+        # under- and overflow are clamped to the histogram range
+        target = q * len(self)
+        if target <= self.underflow:
+            return self.low
+        idx = np.searchsorted(
+            np.cumsum(self.counts), target - self.underflow
+        )
+        if idx >= len(self.counts):
+            return self.low + self.resolution * len(self.counts)
+        return float(self.bin_centers[idx])
+
+    def get_std(self) -> float:
+        if self.std is not None:
+            return self.std
+        # binned estimate for histograms without a recorded std
+        centers = self.bin_centers
+        weights = self.counts / max(1, self.counts.sum())
+        mean = np.sum(weights * centers)
+        return float(np.sqrt(np.sum(weights * (centers - mean)**2)))
+
+    def bin_index(self, value: float) -> int:
+        # samples below value are those of the bins before this one
+        idx = int(round((value - self.low) / self.resolution))
+        return min(max(idx, 0), len(self.counts))
+
+    def _below(self, cum_counts: np.ndarray, value: float) -> int:
+        # number of samples below value, exact up to the resolution
+        return self.underflow + int(cum_counts[self.bin_index(value)])
+
+    def band_counts(
+        self, low_band: float, high_band: float,
+        baseline: Optional[int] = None
+    ) -> Dict[str, Any]:
+        if baseline is None:
+            baseline = self.baseline
+        if self.codes is not None:
+            low_outs, high_outs, heavy_outs, zeroes, events, baselines = (
+                int(count) for count in self.code_counts.astype(np.int64)
+                @ band_masks(
+                    calibrate(self.codes, self.calibration), low_band,
+                    high_band, baseline
+                )
+            )
+        else:
+            cum_counts = np.concatenate(([0], np.cumsum(self.counts)))
+
+            def below(value):
+                return self._below(cum_counts, value)
+
+            low_outs = max(0, below(-5) - below(-100))
+            zeroes = below(5) - below(-5)
+            events = max(0, below(high_band) - below(low_band))
+            baselines = below(baseline + 30) - below(baseline - 30)
+            high_outs = max(0, below(350) - below(baseline + 30))
+            heavy_outs = below(-100) + len(self) \
+                - below(max(350, baseline + 30))
+        return {
+            'outlier': (low_outs, high_outs, heavy_outs),
+            'zeroes': zeroes,
+            'events': events,
+            'baseline': baselines,
+        }
@@ -0,0 +1,158 @@
+from collections import deque
+import json
+import logging
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+import threading
+import time
+import tracemalloc
+from typing import Any, Deque, Dict, List, Optional, Union
+
+DEFAULT_LOG_PATH = Path.home() / ".nanotrace" / "performance.jsonl"
+
+# Stage timings (spans) of hashing, reading, counting, kde and plotting.
+# Disabled, span() hands out a shared no-op object, so instrumented code
+# costs one function call and a flag check per span.
+
+_enabled = False
+_trace_memory = False
+_records: Deque[Dict[str, Any]] = deque(maxlen=1000)
+_records_lock = threading.Lock()
+_local = threading.local()
+_logger = logging.getLogger("nanotrace.performance")
+_logger.propagate = False
+
+
+class _NullSpan:
+
+    def __enter__(self) -> '_NullSpan':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        return None
+
+    def add(self, **fields: Any) -> None:
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    # Wall time and peak traced allocation of a stage. Extra fields, e.g.
+    # bytes_read, are added along the way. Nested spans record their
+    # parent, the peak of a parent includes that of its children.
+
+    def __init__(self, name: str, **fields: Any) -> None:
+        self.name = name
+        self.fields: Dict[str, Any] = fields
+        self.parent: Optional[Span] = None
+        self._start = 0.0
+        self._mem_start = 0
+        self._mem_peak = 0
+
+    def __enter__(self) -> 'Span':
+        stack = _span_stack()
+        self.parent = stack[-1] if stack else None
+        stack.append(self)
+        if _trace_memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            for span in stack[:-1]:
+                span._mem_peak = max(span._mem_peak, peak)
+            tracemalloc.reset_peak()
+            self._mem_start = self._mem_peak = current
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        wall_time = time.perf_counter() - self._start
+        stack = _span_stack()
+        if stack and stack[-1] is self:
+            stack.pop()
+        record = {
+            'stage': self.name,
+            'parent': None if self.parent is None else self.parent.name,
+            'start': time.time() - wall_time,
+            'wall_time': wall_time,
+            'thread': threading.current_thread().name,
+            'failed': exc_type is not None,
+            **self.fields,
+        }
+        if _trace_memory and tracemalloc.is_tracing():
+            peak = max(self._mem_peak, tracemalloc.get_traced_memory()[1])
+            record['peak_alloc'] = peak - self._mem_start
+            if self.parent is not None:
+                self.parent._mem_peak = max(self.parent._mem_peak, peak)
+        _record(record)
+
+    def add(self, **fields: Any) -> None:
+        for key, value in fields.items():
+            if isinstance(value, (int, float)) and key in self.fields:
+                self.fields[key] += value
+            else:
+                self.fields[key] = value
+
+
+def _span_stack() -> List[Span]:
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def span(name: str, **fields: Any) -> Union[Span, _NullSpan]:
+    if not _enabled:
+        return _NULL_SPAN
+    return Span(name, **fields)
+
+
+def _record(record: Dict[str, Any]) -> None:
+    with _records_lock:
+        _records.append(record)
+    if _logger.handlers:
+        _logger.info(json.dumps(record, default=str))
+
+
+def configure(
+    enabled: bool, log_path: Optional[Union[str, Path]] = DEFAULT_LOG_PATH,
+    trace_memory: bool = True, max_bytes: int = 5 * 2**20,
+    backups: int = 3
+) -> None:
+    # records go to memory and a rotating json lines log, memory tracing
+    # is what makes enabled spans expensive
+    global _enabled, _trace_memory
+    _enabled = enabled
+    _trace_memory = enabled and trace_memory
+    for handler in list(_logger.handlers):
+        _logger.removeHandler(handler)
+        handler.close()
+    if _trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    elif not _trace_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    if not enabled or log_path is None:
+        return
+    try:
+        Path(log_path).parent.mkdir(parents=True, exist_ok=True)
+        handler = RotatingFileHandler(
+            log_path, maxBytes=max_bytes, backupCount=backups
+        )
+    except OSError as e:
+        print(e)
+        return
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    _logger.addHandler(handler)
+    _logger.setLevel(logging.INFO)
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def get_records() -> List[Dict[str, Any]]:
+    with _records_lock:
+        return list(_records)
+
+
+def clear_records() -> None:
+    with _records_lock:
+        _records.clear()
@@ -0,0 +1,55 @@
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+from histogram import ChannelHistogram
+
+
+def normal_reference_bw(hist: ChannelHistogram) -> float:
+    # same rule of thumb as statsmodels' default 'normal_reference'
+    iqr = hist.quantile(0.75) - hist.quantile(0.25)
+    sigma = hist.get_std()
+    if iqr > 0:
+        sigma = min(sigma, iqr / 1.349)
+    return 1.059 * sigma * len(hist) ** (-0.2)
+
+
+def binned_kdes(
+    hists: Sequence[ChannelHistogram],
+    bws: Optional[Sequence[float]] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    # Gaussian kernel density estimates for several channels at once.
+    # The histogram counts are convolved with the kernel in the Fourier
+    # domain, all channels share the support of the histogram bin centers.
+    if len(hists) == 0:
+        raise ValueError("At least one histogram is needed for a KDE.")
+    ref = hists[0]
+    n_bins = len(ref.counts)
+    for hist in hists[1:]:
+        if hist.resolution != ref.resolution or hist.low != ref.low \
+                or len(hist.counts) != n_bins:
+            raise ValueError("Histograms need to share the same bins.")
+    if bws is None:
+        bws = [normal_reference_bw(hist) for hist in hists]
+    bws = np.asarray(bws, dtype=float)[:, np.newaxis]
+
+    # zero padding of four bandwidths keeps the circular convolution
+    # from wrapping density around the histogram range
+    pad = int(np.ceil(4 * bws.max() / ref.resolution))
+    n_fft = 2 ** int(np.ceil(np.log2(n_bins + 2 * pad)))
+    counts = np.stack([hist.counts for hist in hists]).astype(float)
+    freqs = np.fft.rfftfreq(n_fft, d=ref.resolution)
+    # fourier transform of the gaussian kernel
+    kernel_ft = np.exp(-2 * (np.pi * freqs * bws)**2)
+    smoothed = np.fft.irfft(
+        np.fft.rfft(counts, n=n_fft, axis=1) * kernel_ft, n=n_fft, axis=1
+    )[:, :n_bins]
+
+    # normalised by all samples, under- and overflow included: the density
+    # is that of the whole signal as for a kde of the raw data, samples
+    # outside of the range just fall off the support
+    totals = np.array([len(hist) for hist in hists], dtype=float)
+    densities = smoothed / (totals[:, np.newaxis] * ref.resolution)
+    # round off of the fft may leave tiny negative values
+    np.clip(densities, 0, None, out=densities)
+    return ref.bin_centers, densities
@@ -0,0 +1,114 @@
+from collections import OrderedDict
+from hashlib import blake2b
+import os
+from pathlib import Path
+from typing import Optional, Tuple, Union
+from uuid import uuid4
+
+import numpy as np
+
+DEFAULT_CACHE_DIR = Path.home() / ".nanotrace" / "kde_cache"
+
+# (file hash, channel, burnin, resolution, bandwidth)
+KdeKey = Tuple[str, int, int, float, Union[str, float]]
+
+
+class KdeCache:
+    # Persistent store of kernel density estimates, one compressed file
+    # per channel. Files are touched on every hit, the least recently used
+    # ones are evicted once the cache grows beyond max_bytes. Sizes and
+    # the order of use are kept in memory, the directory is only scanned
+    # on first use.
+
+    def __init__(
+        self, directory: Optional[Union[str, Path]] = None,
+        max_bytes: int = 256 * 2**20
+    ) -> None:
+        self.directory: Path = Path(directory or DEFAULT_CACHE_DIR)
+        self.max_bytes: int = max_bytes
+        self.hits: int = 0
+        self.misses: int = 0
+        # {file name -> size}, least recently used first
+        self._entries: Optional["OrderedDict[str, int]"] = None
+        self._nbytes: int = 0
+
+    @property
+    def nbytes(self) -> int:
+        self._load_entries()
+        return self._nbytes
+
+    def _load_entries(self) -> None:
+        if self._entries is not None:
+            return
+        entries = []
+        for path in self.directory.glob("*.npz"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, path.name, stat.st_size))
+        self._entries = OrderedDict(
+            (name, size) for _, name, size in sorted(entries)
+        )
+        self._nbytes = sum(self._entries.values())
+
+    def _forget(self, path: Path) -> None:
+        self._load_entries()
+        self._nbytes -= self._entries.pop(path.name, 0)
+
+    def _path(self, key: KdeKey) -> Path:
+        digest = blake2b(repr(key).encode(), digest_size=16).hexdigest()
+        return self.directory / f"{digest}.npz"
+
+    def get(self, key: KdeKey) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                support = data['support'].astype(float)
+                density = data['density'].astype(float)
+            os.utime(path)
+        except FileNotFoundError:
+            self._forget(path)
+            self.misses += 1
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            # broken entry, e.g. from an interrupted write
+            print(e)
+            path.unlink(missing_ok=True)
+            self._forget(path)
+            self.misses += 1
+            return None
+        self._load_entries()
+        if path.name in self._entries:
+            self._entries.move_to_end(path.name)
+        self.hits += 1
+        return support, density
+
+    def put(
+        self, key: KdeKey, support: np.ndarray, density: np.ndarray
+    ) -> None:
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            path = self._path(key)
+            tmp_path = path.with_suffix(f".{os.getpid()}.{uuid4().hex}.tmp")
+            with open(tmp_path, 'wb') as fh:
+                np.savez_compressed(
+                    fh, support=support.astype(np.float32),
+                    density=density.astype(np.float32)
+                )
+            os.replace(tmp_path, path)
+            size = path.stat().st_size
+        except OSError as e:
+            print(e)
+            return
+        self._forget(path)
+        self._entries[path.name] = size
+        self._nbytes += size
+        self.evict()
+
+    def evict(self) -> None:
+        self._load_entries()
+        while self._entries and self._nbytes > self.max_bytes:
+            name, size = self._entries.popitem(last=False)
+            (self.directory / name).unlink(missing_ok=True)
+            self._nbytes -= size
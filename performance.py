@@ -0,0 +1,132 @@
+import time
+from typing import Any, Union
+
+import dearpygui.dearpygui as dpg
+
+from context import Context
+import instrumentation
+from raw_io import get_raw_cache
+
+DpgItem = Union[int, str]
+
+
+def add_performance(tab_tag: DpgItem, context: Context):
+    with dpg.tab(label="Performance", parent=tab_tag) as tab:
+        dpg.add_spacer(height=5)
+        with dpg.group(horizontal=True):
+            dpg.add_checkbox(
+                label="Record stage timings", tag="instrumentation",
+                default_value=context.settings.get('instrumentation', False),
+                callback=toggle_instrumentation, user_data=context
+            )
+            with dpg.tooltip(dpg.last_item()):
+                dpg.add_text(
+                    "[time, bytes read and peak allocation per stage,\n"
+                    f" also logged to {instrumentation.DEFAULT_LOG_PATH}]"
+                )
+            dpg.add_button(
+                label="Refresh", callback=refresh_performance,
+                user_data=context
+            )
+            dpg.add_button(
+                label="Clear", callback=clear_performance, user_data=context
+            )
+        dpg.add_spacer(height=5)
+        dpg.add_text(tag="cache_info")
+        dpg.add_spacer(height=5)
+        with dpg.table(
+            tag="performance_table", header_row=True, resizable=True,
+            borders_innerH=True, borders_outerH=True, scrollY=True,
+            height=-1, policy=dpg.mvTable_SizingStretchProp
+        ):
+            for label in (
+                "Time", "Stage", "Parent", "Wall [s]", "Read [MiB]",
+                "Peak [MiB]", "Details"
+            ):
+                dpg.add_table_column(label=label)
+    # show what was recorded whenever the tab is opened
+    with dpg.item_handler_registry() as handler:
+        dpg.add_item_clicked_handler(
+            callback=refresh_performance, user_data=context
+        )
+    dpg.bind_item_handler_registry(tab, handler)
+    return tab
+
+
+def setup_instrumentation(context: Context) -> None:
+    instrumentation.configure(context.settings.get('instrumentation', False))
+
+
+# ################ Callbacks ##################################################
+
+def toggle_instrumentation(
+    sender: DpgItem,
+    app_data: Any,
+    user_data: Context
+) -> None:
+    user_data.settings['instrumentation'] = dpg.get_value(sender)
+    setup_instrumentation(user_data)
+
+
+def refresh_performance(
+    sender: DpgItem,
+    app_data: Any,
+    user_data: Context
+) -> None:
+    _show_cache_info(user_data)
+    dpg.delete_item("performance_table", children_only=True, slot=1)
+    # newest first
+    for record in reversed(instrumentation.get_records()):
+        details = {
+            k: v for k, v in record.items() if k not in (
+                'stage', 'parent', 'start', 'wall_time', 'bytes_read',
+                'peak_alloc'
+            )
+        }
+        with dpg.table_row(parent="performance_table"):
+            dpg.add_text(
+                time.strftime("%H:%M:%S", time.localtime(record['start']))
+            )
+            dpg.add_text(record['stage'])
+            dpg.add_text(record['parent'] or "")
+            dpg.add_text(f"{record['wall_time']:.3f}")
+            dpg.add_text(_mib(record.get('bytes_read')))
+            dpg.add_text(_mib(record.get('peak_alloc')))
+            dpg.add_text(", ".join(
+                f"{k}={round(v, 3) if isinstance(v, float) else v}"
+                for k, v in details.items()
+            ))
+
+
+def clear_performance(
+    sender: DpgItem,
+    app_data: Any,
+    user_data: Context
+) -> None:
+    instrumentation.clear_records()
+    refresh_performance(sender, app_data, user_data)
+
+
+def _show_cache_info(context: Context) -> None:
+    prefetcher = context.prefetcher
+    kde_cache = context.kde_cache
+    lines = [
+        f"Prefetch: {_hit_rate(prefetcher.hits, prefetcher.misses)}, "
+        f"{len(prefetcher)} channels in {_mib(prefetcher.nbytes)} MiB",
+        f"KDE cache: {_hit_rate(kde_cache.hits, kde_cache.misses)}"
+    ]
+    if (raw_cache := get_raw_cache()) is not None:
+        lines.append(
+            f"Raw cache: {_hit_rate(raw_cache.hits, raw_cache.misses)}"
+        )
+    dpg.set_value("cache_info", "\n".join(lines))
+
+
+def _hit_rate(hits: int, misses: int) -> str:
+    if hits + misses == 0:
+        return "no requests"
+    return f"{hits} hits, {misses} misses ({hits / (hits + misses):.0%})"
+
+
+def _mib(value: Any) -> str:
+    return "" if value is None else f"{value / 2**20:.1f}"
@@ -0,0 +1,199 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+import threading
+from typing import Callable, Iterator, List, Optional, Tuple
+
+import numpy as np
+from fast5_research.fast5_bulk import BulkFast5
+
+from decimation import MinMaxPyramid
+from histogram import ChannelHistogram
+from instrumentation import span
+from raw_io import calibrate, get_calibration, iter_raw_chunks, raw_length
+from utils import set_histogram_baseline
+
+
+@dataclass
+class PrefetchedChannel:
+    # the calibrated signal with its min/max levels, the post burnin
+    # histogram if the experiment had none
+    pyramid: MinMaxPyramid
+    burnin: int
+    histogram: Optional[ChannelHistogram] = None
+
+    @property
+    def nbytes(self) -> int:
+        levels = sum(
+            mins.nbytes + maxs.nbytes for mins, maxs in self.pyramid.levels
+        )
+        hist = 0 if self.histogram is None else self.histogram.counts.nbytes
+        return self.pyramid.data.nbytes + levels + hist
+
+
+class Prefetcher:
+    # Reads the channels of the open file into memory in a background
+    # thread, in the order they are likely to be plotted. Reading waits
+    # while paused() holds, i.e. while jobs of the user are running, the
+    # order may change between channels. The least recently used channels
+    # are dropped once they take more than max_bytes.
+
+    def __init__(
+        self, max_bytes: int = 512 * 2**20,
+        paused: Optional[Callable[[], bool]] = None
+    ) -> None:
+        self.max_bytes: int = max_bytes
+        self.paused: Callable[[], bool] = paused or (lambda: False)
+        self.hits: int = 0
+        self.misses: int = 0
+        # {(file path, channel) -> prefetched data}, least recent first
+        self._cache: "OrderedDict[Tuple[str, int], PrefetchedChannel]" = \
+            OrderedDict()
+        self._nbytes: int = 0
+        # channels still to read, next first
+        self._queue: List[int] = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    def start(
+        self, fpath: str, channels: List[int], burnin: int,
+        histograms: bool = False
+    ) -> None:
+        # replaces the channels of any previous file
+        self.stop()
+        with self._lock:
+            for key in [key for key in self._cache if key[0] != fpath]:
+                self._nbytes -= self._cache.pop(key).nbytes
+            # a queue of its own, a stopped thread might still pop
+            self._queue = list(channels)
+        if self.max_bytes <= 0 or not channels:
+            return
+        self._stop = threading.Event()
+        threading.Thread(
+            target=self._run,
+            args=(fpath, self._queue, burnin, histograms, self._stop),
+            name="nanotrace_prefetch", daemon=True
+        ).start()
+
+    def stop(self) -> None:
+        # the thread ends after its current chunk
+        self._stop.set()
+        with self._lock:
+            self._queue = []
+
+    def prioritize(self, channel: int) -> None:
+        # the channel next, then those after it as picked from the list
+        with self._lock:
+            self._queue.sort(key=lambda chan: (chan < channel, chan))
+
+    def get(
+        self, fpath: str, channel: int, burnin: Optional[int] = None
+    ) -> Optional[PrefetchedChannel]:
+        # with a burnin, only entries with a histogram of it are hits
+        with self._lock:
+            entry = self._cache.get((fpath, channel))
+            if entry is None or burnin is not None and (
+                entry.histogram is None or entry.burnin != burnin
+            ):
+                self.misses += 1
+                return None
+            self._cache.move_to_end((fpath, channel))
+            self.hits += 1
+            return entry
+
+    def evict(self) -> None:
+        with self._lock:
+            while self._cache and self._nbytes > self.max_bytes:
+                self._nbytes -= self._cache.popitem(last=False)[1].nbytes
+
+    def _put(self, key: Tuple[str, int], entry: PrefetchedChannel) -> None:
+        with self._lock:
+            self._cache[key] = entry
+            self._nbytes += entry.nbytes
+        self.evict()
+
+    def _next_channel(self, fpath: str, queue: List[int]) -> Optional[int]:
+        with self._lock:
+            while queue:
+                channel = queue.pop(0)
+                if (fpath, channel) not in self._cache:
+                    return channel
+        return None
+
+    def _run(
+        self, fpath: str, queue: List[int], burnin: int, histograms: bool,
+        stop: threading.Event
+    ) -> None:
+        try:
+            with BulkFast5(fpath) as fh:
+                while not stop.is_set():
+                    if self._wait(stop):
+                        return
+                    if (channel := self._next_channel(fpath, queue)) is None:
+                        return
+                    entry = self._read(fh, channel, burnin, histograms, stop)
+                    if entry is not None and not stop.is_set():
+                        self._put((fpath, channel), entry)
+        except Exception as e:
+            print(e)
+
+    def _wait(self, stop: threading.Event) -> bool:
+        # True once stopped
+        while self.paused():
+            if stop.wait(0.1):
+                return True
+        return stop.is_set()
+
+    def _chunks(
+        self, fh: BulkFast5, channel: int, start: int, stop_at: Optional[int],
+        stop: threading.Event
+    ) -> Iterator[np.ndarray]:
+        # ADC codes, a quarter of the calibrated size
+        for chunk in iter_raw_chunks(
+            fh, channel, start, stop_at, use_scaling=False
+        ):
+            if self._wait(stop):
+                return
+            yield chunk
+
+    def _read(
+        self, fh: BulkFast5, channel: int, burnin: int, histograms: bool,
+        stop: threading.Event
+    ) -> Optional[PrefetchedChannel]:
+        if not fh.has_raw(channel) \
+                or raw_length(fh, channel) * 8 > self.max_bytes:
+            return None
+        calibration = get_calibration(fh, channel)
+        with span("prefetch", channel=channel) as prefetch_span:
+            chunks = list(self._chunks(fh, channel, 0, burnin, stop))
+            rest = self._chunks(fh, channel, burnin, None, stop)
+            hist = None
+            if histograms:
+                # chunked like utils.get_channel_histogram, same result
+                hist, codes = ChannelHistogram.from_adc_chunks(
+                    self._collect(rest, chunks), burnin, calibration
+                )
+                set_histogram_baseline(hist, codes)
+            else:
+                chunks.extend(rest)
+            if stop.is_set() or not chunks:
+                return None
+            codes = np.concatenate(chunks)
+            prefetch_span.add(bytes_read=codes.nbytes)
+            return PrefetchedChannel(
+                MinMaxPyramid(calibrate(codes, calibration)), burnin, hist
+            )
+
+    @staticmethod
+    def _collect(
+        chunks: Iterator[np.ndarray], collected: List[np.ndarray]
+    ) -> Iterator[np.ndarray]:
+        for chunk in chunks:
+            collected.append(chunk)
+            yield chunk
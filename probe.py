@@ -0,0 +1,63 @@
+from dataclasses import dataclass
+from typing import Literal
+
+import numpy as np
+from fast5_research.fast5_bulk import BulkFast5
+
+from raw_io import calibrate, get_calibration, raw_length
+
+ProbeState = Literal['dead', 'active', 'uncertain']
+
+
+@dataclass
+class ChannelProbe:
+    state: ProbeState
+    # mean current [pA] of the probed samples and its standard error
+    mean: float
+    stderr: float
+    samples: int
+
+
+def probe_channel(
+    fh: BulkFast5, channel: int, burnin: int, margin: float = 5.0,
+    blocks: int = 16, block_size: int = 2048
+) -> ChannelProbe:
+    # Classifies a channel by the activity criterion of the full scan,
+    # |mean| > 1 pA and samples within (150, 350) pA, from blocks spread
+    # evenly over the post burnin signal. A channel is dead only if its
+    # mean stays within 1 pA by margin standard errors of the block means.
+    # It is active if the mean clears 1 pA by the margin and samples hit
+    # the range, anything else is uncertain and read in full. Activity
+    # shorter than the spacing of the blocks can go unseen. Blocks start
+    # at hdf5 chunks, each decompresses a single chunk. Short channels are
+    # left uncertain, probing would not save a read.
+    length = raw_length(fh, channel) if fh.has_raw(channel) else 0
+    if length - burnin < 4 * blocks * block_size:
+        return ChannelProbe('uncertain', np.nan, np.nan, 0)
+    # read from the file, probing must not fill the raw cache with
+    # channels that are never read in full
+    dataset = fh[fh.__raw_data__.format(channel)]
+    chunk = dataset.chunks[0] if dataset.chunks else 1
+    block_size = min(block_size, chunk)
+    starts = np.linspace(burnin, length - block_size, blocks).astype(int)
+    starts = np.minimum(-(-starts // chunk) * chunk, length - block_size)
+    codes = np.stack([dataset[start:start + block_size] for start in starts])
+    calibration = get_calibration(fh, channel)
+    raw_unit = calibration[1]
+    values = calibrate(codes, calibration)
+    block_means = values.mean(axis=1)
+    noise = max(float(np.sqrt(values.var(axis=1).mean())), raw_unit)
+    mean = float(block_means.mean())
+    stderr = max(
+        float(block_means.std(ddof=1)) / np.sqrt(blocks),
+        noise / np.sqrt(values.size)
+    )
+
+    if abs(mean) + margin * stderr <= 1:
+        state = 'dead'
+    elif abs(mean) - margin * stderr > 1 \
+            and np.any((values > 150) & (values < 350)):
+        state = 'active'
+    else:
+        state = 'uncertain'
+    return ChannelProbe(state, mean, stderr, int(values.size))
@@ -0,0 +1,121 @@
+import os
+from pathlib import Path
+from typing import Dict, Optional, Tuple, Union
+from uuid import uuid4
+
+import numpy as np
+from fast5_research.fast5_bulk import BulkFast5
+
+from fingerprint import get_fingerprint
+from instrumentation import span
+
+DEFAULT_CACHE_DIR = Path.home() / ".nanotrace" / "raw_cache"
+
+
+class RawCache:
+    # Decoded raw (ADC) signal of channels, one .npy file per file and
+    # channel, memory mapped on reads. A channel is decompressed once, then
+    # any range is a slice of the mapping. Files are touched on every hit,
+    # the least recently used ones are evicted once the cache grows beyond
+    # max_bytes. Files are told apart by their fingerprint.
+
+    def __init__(
+        self, directory: Optional[Union[str, Path]] = None,
+        max_bytes: int = 4 * 2**30
+    ) -> None:
+        self.directory: Path = Path(directory or DEFAULT_CACHE_DIR)
+        self.max_bytes: int = max_bytes
+        self.hits: int = 0
+        self.misses: int = 0
+        # {(path, size, mtime) -> fingerprint identity}
+        self._file_keys: Dict[Tuple[str, int, int], str] = {}
+
+    def _file_key(self, fpath: str) -> str:
+        stat = os.stat(fpath)
+        known = (fpath, stat.st_size, stat.st_mtime_ns)
+        if known not in self._file_keys:
+            self._file_keys[known] = get_fingerprint(fpath).identity
+        return self._file_keys[known]
+
+    def _path(self, fpath: str, channel: int) -> Path:
+        return self.directory / self._file_key(fpath) / f"{channel}.npy"
+
+    def get(self, fh: BulkFast5, channel: int) -> Optional[np.ndarray]:
+        # read only mapping of the whole channel, decoded on a miss;
+        # None for channels that do not fit into the cache
+        path = self._path(fh.filename, channel)
+        try:
+            data = np.load(path, mmap_mode='r')
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return self._decode(fh, channel, path)
+        except (OSError, ValueError) as e:
+            # broken entry, e.g. from an interrupted write
+            print(e)
+            path.unlink(missing_ok=True)
+            self.misses += 1
+            return self._decode(fh, channel, path)
+        self.hits += 1
+        return data
+
+    def _decode(
+        self, fh: BulkFast5, channel: int, path: Path,
+        chunk_size: int = 1_048_576
+    ) -> Optional[np.ndarray]:
+        dataset = fh[fh.__raw_data__.format(channel)]
+        if dataset.size * dataset.dtype.itemsize > self.max_bytes:
+            return None
+        # unique per call, threads of a process may decode the same channel
+        tmp_path = path.with_suffix(f".{os.getpid()}.{uuid4().hex}.tmp")
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with span("raw_decode", channel=channel) as decode_span:
+                data = np.lib.format.open_memmap(
+                    tmp_path, mode='w+', dtype=dataset.dtype,
+                    shape=dataset.shape
+                )
+                for pos in range(0, len(data), chunk_size):
+                    data[pos:pos + chunk_size] = \
+                        dataset[pos:pos + chunk_size]
+                data.flush()
+                del data
+                decode_span.add(
+                    bytes_read=dataset.size * dataset.dtype.itemsize
+                )
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(e)
+            tmp_path.unlink(missing_ok=True)
+            return None
+        self.evict()
+        try:
+            return np.load(path, mmap_mode='r')
+        except OSError:
+            # evicted right away by a concurrent writer
+            return None
+
+    def evict(self) -> None:
+        entries = []
+        for path in self.directory.glob("*/*.npy"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink(missing_ok=True)
+            except OSError as e:
+                # still mapped elsewhere (windows)
+                print(e)
+                continue
+            total -= size
+            try:
+                path.parent.rmdir()
+            except OSError:
+                # other channels of the file are left
+                pass
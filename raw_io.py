@@ -0,0 +1,115 @@
+from pathlib import Path
+from typing import Iterator, Optional, Tuple, Union
+
+import numpy as np
+from fast5_research.fast5_bulk import BulkFast5
+
+from raw_cache import RawCache
+
+# samples per chunk, 8 MiB of calibrated float data
+DEFAULT_CHUNK_SIZE = 1_048_576
+
+# (offset, pA per ADC code) of a channel
+Calibration = Tuple[float, float]
+
+# optional cache of decoded channels shared by all readers, see
+# configure_cache
+_raw_cache: Optional[RawCache] = None
+
+
+def configure_cache(
+    max_bytes: int, directory: Optional[Union[str, Path]] = None
+) -> None:
+    # a budget of 0 disables the cache, files on disk are left alone
+    global _raw_cache
+    if max_bytes <= 0:
+        _raw_cache = None
+        return
+    if _raw_cache is None or (
+        directory is not None and Path(directory) != _raw_cache.directory
+    ):
+        _raw_cache = RawCache(directory, max_bytes)
+    _raw_cache.max_bytes = max_bytes
+    _raw_cache.evict()
+
+
+def cache_settings() -> Tuple[int, Optional[str]]:
+    # arguments to configure_cache, e.g. for worker processes
+    if _raw_cache is None:
+        return 0, None
+    return _raw_cache.max_bytes, str(_raw_cache.directory)
+
+
+def get_raw_cache() -> Optional[RawCache]:
+    return _raw_cache
+
+
+def raw_length(fh: BulkFast5, channel: int) -> int:
+    # number of samples, without reading any of them
+    if not fh.has_raw(channel):
+        raise KeyError(f'Channel {channel} does not contain raw data.')
+    return fh[fh.__raw_data__.format(channel)].shape[0]
+
+
+def _cached_channel(fh: BulkFast5, channel: int) -> Optional[np.ndarray]:
+    if _raw_cache is None or not fh.has_raw(channel):
+        return None
+    return _raw_cache.get(fh, channel)
+
+
+def get_calibration(fh: BulkFast5, channel: int) -> Calibration:
+    meta_data = fh.get_metadata(channel)
+    return (
+        meta_data['offset'], meta_data['range'] / meta_data['digitisation']
+    )
+
+
+def calibrate(data: np.ndarray, calibration: Calibration) -> np.ndarray:
+    # ADC codes to pA, the same floats as BulkFast5.get_raw gives
+    offset, raw_unit = calibration
+    return (data + offset) * raw_unit
+
+
+def _scale(fh: BulkFast5, channel: int, data: np.ndarray) -> np.ndarray:
+    return calibrate(data, get_calibration(fh, channel))
+
+
+def read_raw(
+    fh: BulkFast5, channel: int, start: Optional[int] = None,
+    stop: Optional[int] = None, use_scaling: bool = True
+) -> np.ndarray:
+    # BulkFast5.get_raw served from the raw cache where enabled, unscaled
+    # data is then a slice of the memory mapped file
+    if (cached := _cached_channel(fh, channel)) is None:
+        return fh.get_raw(
+            channel, raw_indices=(start, stop), use_scaling=use_scaling
+        )
+    if not use_scaling:
+        return cached[start:stop]
+    return _scale(fh, channel, cached[start:stop])
+
+
+def iter_raw_chunks(
+    fh: BulkFast5, channel: int, start: int = 0, stop: Optional[int] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE, use_scaling: bool = True,
+    use_cache: bool = True
+) -> Iterator[np.ndarray]:
+    # Yields the raw data of [start, stop) in pieces of at most chunk_size
+    # samples, cut at multiples of chunk_size. Data before start (e.g. the
+    # burnin) is never read, at most one chunk is held at a time. Without
+    # use_cache the file is read even with the raw cache enabled.
+    length = raw_length(fh, channel)
+    stop = length if stop is None else min(stop, length)
+    pos = max(0, start)
+    cached = _cached_channel(fh, channel) if use_cache else None
+    while pos < stop:
+        end = min(stop, (pos // chunk_size + 1) * chunk_size)
+        if cached is None:
+            yield fh.get_raw(
+                channel, raw_indices=(pos, end), use_scaling=use_scaling
+            )
+        elif use_scaling:
+            yield _scale(fh, channel, cached[pos:end])
+        else:
+            yield cached[pos:end]
+        pos = end
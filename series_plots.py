@@ -1,17 +1,28 @@
 from argparse import ArgumentError
 from dataclasses import dataclass
 import random
-from typing import Literal, Optional, Union, Any, Collection, Sequence, List
+from typing import (
+    Literal, Optional, Union, Any, Collection, Sequence, List, Tuple
+)
 
 import dearpygui.dearpygui as dpg
 import numpy as np
-import statsmodels.api as sm
 
 from fast5_research.fast5_bulk import BulkFast5
 from context import Context
+from decimation import MinMaxPyramid, WindowedRawSource
+from events import EventTable
+from histogram import HIST_RESOLUTION
+from kde import binned_kdes
+from raw_io import read_raw
+from instrumentation import span
+from tasks import executor
+import utils
 
 DpgItem = Union[int, str]
-# TODO: resolve progress bar issue...
+
+# (frame, x-axis, y-axis) of plots whose axes are freed at that frame
+_pending_axes: List[Tuple[int, DpgItem, DpgItem]] = []
 
 
 # cf. https://www.python.org/dev/peps/pep-0484/#the-numeric-tower
@@ -27,58 +38,224 @@ class SeriesData:
     y_lims: Sequence[float]
     y_datas: List[Collection[float]]
     h_lines: Optional[Sequence[float]] = None
+    # level of detail sources, re-queried for the visible x-range on zoom
+    lods: Optional[List[Union[MinMaxPyramid, WindowedRawSource]]] = None
+    x_scale: float = 1.0
+    # legend entries, one per series
+    labels: Optional[List[str]] = None
 
 
 def _plot_series(target: DpgItem, data: SeriesData) -> None:
-    with dpg.plot(label=data.title, height=-1, width=-1, parent=target) as plt:
+    points = sum(len(x_data) for x_data in data.x_datas)
+    with span("plot_upload", points=points), dpg.plot(
+        label=data.title, height=-1, width=-1, parent=target
+    ) as plt:
+        if data.labels is not None:
+            dpg.add_plot_legend()
         x_axis = dpg.add_plot_axis(dpg.mvXAxis, label=data.x_label)
         y_axis = dpg.add_plot_axis(dpg.mvYAxis, label=data.y_label)
         dpg.set_axis_limits(x_axis, *data.x_lims)
         dpg.set_axis_limits(y_axis, *data.y_lims)
 
-        for x_data, y_data in zip(data.x_datas, data.y_datas):
-            dpg.add_line_series(x_data, y_data, parent=y_axis)
-        # wait a frame to have axis limits registered (some BUG/RACE here?)
-        dpg.split_frame()
-        dpg.set_axis_limits_auto(x_axis)
-        dpg.set_axis_limits_auto(y_axis)
+        labels = data.labels or [None] * len(data.x_datas)
+        series = [
+            dpg.add_line_series(x_data, y_data, label=label, parent=y_axis)
+            for x_data, y_data, label in zip(
+                data.x_datas, data.y_datas, labels
+            )
+        ]
+        # free the axes once the limits are registered a frame later,
+        # split_frame would block the render loop this runs in
+        _release_axes_later(x_axis, y_axis)
         if data.h_lines:
             dpg.add_hline_series(
                 [float(val) for val in data.h_lines], parent=y_axis
             )
-    dpg.configure_item(target, on_close=lambda: dpg.delete_item(plt))
+    handler = None
+    if data.lods is not None:
+        handler = _add_lod_handler(plt, x_axis, series, data)
+
+    def _close():
+        dpg.delete_item(plt)
+        if handler is not None:
+            dpg.delete_item(handler)
+    dpg.configure_item(target, on_close=_close)
+
+
+def _release_axes_later(x_axis: DpgItem, y_axis: DpgItem) -> None:
+    # dearpygui keeps one callback per frame, plots created in the same
+    # frame share it
+    frame = dpg.get_frame_count() + 2
+    if all(due != frame for due, _, _ in _pending_axes):
+        dpg.set_frame_callback(frame, lambda: _release_axes(frame))
+    _pending_axes.append((frame, x_axis, y_axis))
+
+
+def _release_axes(frame: int) -> None:
+    due = [(x, y) for pending, x, y in _pending_axes if pending <= frame]
+    _pending_axes[:] = [
+        entry for entry in _pending_axes if entry[0] > frame
+    ]
+    for x_axis, y_axis in due:
+        _set_axes_auto(x_axis, y_axis)
+
+
+def _set_axes_auto(x_axis: DpgItem, y_axis: DpgItem) -> None:
+    if dpg.does_item_exist(x_axis):
+        dpg.set_axis_limits_auto(x_axis)
+        dpg.set_axis_limits_auto(y_axis)
+
+
+def _add_lod_handler(
+    plt: DpgItem, x_axis: DpgItem, series: List[DpgItem], data: SeriesData
+) -> DpgItem:
+    # checked every frame the plot is visible, the series only get new
+    # data once the visible x-range changes. Streamed windows are never
+    # read here: the coarser cached level is drawn until the missing
+    # windows are loaded in the background.
+    state = {'x_lims': None, 'loading': set()}
+
+    def _loaded(keys, redraw=True):
+        state['loading'] -= keys
+        if redraw:
+            # with the new windows, failed ones are retried on the next
+            # change of the range
+            state['x_lims'] = None
+
+    def _update_lod(sender, app_data, user_data):
+        x_lims = tuple(dpg.get_axis_limits(x_axis))
+        if x_lims == state['x_lims']:
+            return
+        state['x_lims'] = x_lims
+        # min and max per pixel column
+        max_points = 2 * max(dpg.get_item_rect_size(plt)[0], 500)
+        start, stop = (lim * data.x_scale for lim in x_lims)
+        # one width of margin on each side keeps short pans seamless
+        width = stop - start
+        query = (start - width, stop + width, 3 * max_points)
+        for i, (item, lod) in enumerate(zip(series, data.lods)):
+            if not isinstance(lod, WindowedRawSource):
+                result = lod.query(*query)
+            else:
+                missing = {
+                    (i, key) for key in lod.missing(*query)
+                } - state['loading']
+                if missing:
+                    state['loading'] |= missing
+                    executor.submit(
+                        "Loading squiggle", lod.load,
+                        [key for _, key in missing],
+                        on_done=lambda _, keys=missing: _loaded(keys),
+                        on_fail=lambda keys=missing: _loaded(keys, False)
+                    )
+                if (result := lod.cached_query(*query)) is None:
+                    # nothing cached this coarse, keep the current data
+                    continue
+            x_data, y_data = result
+            dpg.set_value(
+                item, [(x_data / data.x_scale).tolist(), y_data.tolist()]
+            )
+
+    with dpg.item_handler_registry() as handler:
+        dpg.add_item_visible_handler(callback=_update_lod)
+    dpg.bind_item_handler_registry(plt, handler)
+    return handler
 
 
 def _get_kdes(
-    context: Context, channels: List[int]
-) -> List[sm.nonparametric.KDEUnivariate]:
-    fpath = context.active_exp.path
+    context: Context, channels: List[int],
+    progress: Optional[utils.ProgressCallback] = None
+) -> Tuple[np.ndarray, List[np.ndarray]]:
+    exp = context.active_exp
     burnin = context.settings['burnin']
     kde_resolution = context.settings['kde_resolution']
+    bandwidth = context.settings['kde_bandwidth']
+    cache = context.kde_cache
 
-    progress_bar = "Progress Bar"
-    dpg.configure_item(progress_bar, show=True, width=175)
-    kdes = []
+    # cached histograms of active channels, the rest is read once here
+    use_cached = exp.has_histograms(burnin)
+    keys = {
+        chan: (exp.get_hash(), chan, burnin, HIST_RESOLUTION, bandwidth)
+        for chan in channels
+    }
+    support = None
+    densities = {}
+    missing = {}
     for count, chan in enumerate(channels):
-        dpg.set_value(progress_bar, count/len(channels))
-        dpg.configure_item(
-            progress_bar,
-            overlay=f"Calculating KDE {count+1}/{len(channels)}"
-        )
+        if (hit := cache.get(keys[chan])) is not None:
+            support, densities[chan] = hit
+            continue
+        if progress is not None:
+            progress(
+                count/len(channels),
+                f"Reading channel {count+1}/{len(channels)}"
+            )
+        if use_cached and chan in exp.histograms:
+            hist = exp.histograms[chan]
+        elif (prefetched := context.prefetcher.get(
+            exp.path, chan, burnin
+        )) is not None:
+            hist = prefetched.histogram
+        else:
+            hist = utils.get_channel_histogram(exp.path, chan, burnin)
+        if hist is not None:
+            missing[chan] = hist
 
-        with BulkFast5(fpath) as fh:
-            raw_data = fh.get_raw(chan)[burnin:]
-        kde = sm.nonparametric.KDEUnivariate(raw_data)
-        kde.fit(gridsize=min(kde_resolution, len(raw_data)))
-        kdes.append(kde)
-    dpg.configure_item(progress_bar, show=False)
-    return kdes
+    if missing:
+        bws = None
+        if bandwidth != 'normal_reference':
+            bws = [float(bandwidth)] * len(missing)
+        with span(
+            "kde_fit", channels=len(missing), cached=len(densities)
+        ):
+            support, new_densities = binned_kdes(
+                list(missing.values()), bws
+            )
+        for chan, density in zip(missing.keys(), new_densities):
+            densities[chan] = density
+            cache.put(keys[chan], support, density)
+    if support is None:
+        return np.empty(0), []
+
+    # the support is the histogram grid, thin it out if asked for less
+    step = max(1, int(np.ceil(len(support) / kde_resolution)))
+    return support[::step], [
+        densities[chan][::step] for chan in channels if chan in densities
+    ]
+
+
+def _get_timeline_data(
+    context: Context, channel: Optional[int],
+    progress: Optional[utils.ProgressCallback] = None
+) -> SeriesData:
+    # densities over time of one channel or averaged over active channels
+    timeline = context.get_density_timeline(progress)
+    times = timeline.times()
+    x_datas, y_datas = [], []
+    for key in ('events', 'zeroes', 'baseline'):
+        if channel is None:
+            densities = timeline.mean_densities(key)
+        else:
+            densities = timeline.densities(key, channel)
+        # windows past the end of the channel
+        recorded = ~np.isnan(densities)
+        x_datas.append(times[recorded])
+        y_datas.append(densities[recorded])
+    window = timeline.window / timeline.sample_rate
+    which = "active channels" if channel is None else f"Channel {channel}"
+    return SeriesData(
+        f"{context.active_exp.name}\n{which}, {window:g} s windows",
+        "time [s]", (0, float(times[-1] + window / 2) if len(times) else 1),
+        x_datas, "density", (0, 1), y_datas,
+        labels=["events", "zeroes", "baseline"]
+    )
 
 
 def _get_series_data(
     context: Context,
     flavour: Literal['raw', 'dens'],
-    channels: List[int]
+    channels: List[int],
+    progress: Optional[utils.ProgressCallback] = None
 ) -> SeriesData:
     fpath = context.active_exp.path
     channel_id = channels[0] if len(channels) == 1 else channels
@@ -91,21 +268,42 @@ def _get_series_data(
         channel = channels[0]
         x_axis_scale = 1.0
         x_label = "index"
-        with BulkFast5(fpath) as fh:
-            y_data = [fh.get_raw(channel)]
-            if context.settings['scale_in_seconds']:
-                x_axis_scale = fh.sample_rate
-                x_label = "time [s]"
-        x_lims = (0, int(100_000/x_axis_scale))
-        y_label = "current [pA]"
-        y_lims = (-20, 350)
-        x_data = [np.arange(0, len(y_data[0])) / x_axis_scale]
+        prefetched = context.prefetcher.get(fpath, channel)
+        with span(
+            "squiggle_data", channel=channel,
+            streamed=context.settings['stream_raw'],
+            prefetched=prefetched is not None
+        ):
+            with BulkFast5(fpath) as fh:
+                if context.settings['scale_in_seconds']:
+                    x_axis_scale = fh.sample_rate
+                    x_label = "time [s]"
+                if prefetched is not None:
+                    # already in memory, streaming saves nothing
+                    lods = [prefetched.pyramid]
+                elif not context.settings['stream_raw']:
+                    lods = [MinMaxPyramid(read_raw(fh, channel))]
+            if prefetched is None and context.settings['stream_raw']:
+                # only the visible part of the channel is ever loaded
+                lods = [WindowedRawSource(
+                    fpath, channel, zone_map=context.get_zone_map()
+                )]
+            x_lims = (0, int(100_000/x_axis_scale))
+            y_label = "current [pA]"
+            y_lims = (-20, 350)
+            # initial view, refined for the visible range once plotted
+            x_data, y_data = [], []
+            for lod in lods:
+                x_lod, y_lod = lod.query(0, 200_000, 4_000)
+                x_data.append(x_lod / x_axis_scale)
+                y_data.append(y_lod)
         if context.settings['plot_event_bands']:
             h_lines = context.get_event_bands(channel)
     elif flavour == 'dens':
-        kdes = _get_kdes(context, channels)
-        x_data = [kde.support for kde in kdes]
-        y_data = [kde.density for kde in kdes]
+        lods = None
+        x_axis_scale = 1.0
+        support, y_data = _get_kdes(context, channels, progress)
+        x_data = [support for _ in y_data]
         x_label = "current [pA]"
         x_lims = (-20, 350)
         y_label = "density"
@@ -118,7 +316,8 @@ def _get_series_data(
         ]
         raise ArgumentError(" ".join(msg))
     return SeriesData(
-        title, x_label, x_lims, x_data, y_label, y_lims, y_data, h_lines
+        title, x_label, x_lims, x_data, y_label, y_lims, y_data, h_lines,
+        lods, x_axis_scale
     )
 
 
@@ -130,9 +329,10 @@ def show_raw(
     if not (channel := dpg.get_value("channel")):
         # no channel set, fail silently, TODO: add handling ie message?
         return
-    series_data = _get_series_data(user_data, "raw", [int(channel)])
-    target = dpg.add_window(label="Raw Data", width=800, height=600)
-    _plot_series(target, series_data)
+    executor.submit(
+        "Loading squiggle", _get_series_data, user_data, "raw",
+        [int(channel)], on_done=lambda data: _show_window("Raw Data", data)
+    )
 
 
 def show_kde(
@@ -143,9 +343,11 @@ def show_kde(
     if not (channel := dpg.get_value("channel")):
         # no channel set, fail silently, TODO: add handling ie message?
         return
-    series_data = _get_series_data(user_data, "dens", [int(channel)])
-    target = dpg.add_window(label="Kernel Density", width=800, height=600)
-    _plot_series(target, series_data)
+    executor.submit(
+        "Computing density", _get_series_data, user_data, "dens",
+        [int(channel)],
+        on_done=lambda data: _show_window("Kernel Density", data)
+    )
 
 
 def show_rand_kde(
@@ -162,6 +364,86 @@ def show_rand_kde(
     else:
         chans = active_chans
 
-    series_data = _get_series_data(user_data, "dens", chans)
-    target = dpg.add_window(label="Kernel Density", width=800, height=600)
+    executor.submit(
+        "Computing densities", _get_series_data, user_data, "dens", chans,
+        on_done=lambda data: _show_window("Kernel Density", data)
+    )
+
+
+def show_timeline(
+    sender: DpgItem,
+    app_data: Any,
+    user_data: Context
+) -> None:
+    if not (channel := dpg.get_value("channel")):
+        # no channel set, fail silently, TODO: add handling ie message?
+        return
+    executor.submit(
+        "Computing densities over time", _get_timeline_data, user_data,
+        int(channel),
+        on_done=lambda data: _show_window("Density over Time", data)
+    )
+
+
+def show_mean_timeline(
+    sender: DpgItem,
+    app_data: Any,
+    user_data: Context
+) -> None:
+    executor.submit(
+        "Computing densities over time", _get_timeline_data, user_data,
+        None, on_done=lambda data: _show_window("Density over Time", data)
+    )
+
+
+def show_events(
+    sender: DpgItem,
+    app_data: Any,
+    user_data: Context
+) -> None:
+    if not (channel := dpg.get_value("channel")):
+        # no channel set, fail silently, TODO: add handling ie message?
+        return
+    channel = int(channel)
+    executor.submit(
+        "Detecting events", user_data.get_channel_events, channel,
+        on_done=lambda events: _show_events_window(
+            f"{user_data.active_exp.name}, Channel {channel}", events
+        )
+    )
+
+
+def _show_events_window(title: str, events: EventTable) -> None:
+    # dwell time and amplitude histograms next to each other
+    target = dpg.add_window(label="Event Statistics", width=800, height=450)
+    if len(events) == 0:
+        dpg.add_text(f"{title}: no events", parent=target)
+        return
+    dwell = events.dwell_times()
+    dpg.add_text(
+        f"{title}: {len(events)} events, median dwell time "
+        f"{np.median(dwell)*1e3:.2f} ms, mean amplitude "
+        f"{np.mean(events.mean):.1f} pA", parent=target
+    )
+    with dpg.group(horizontal=True, parent=target):
+        for (counts, edges), x_label, log_scale in (
+            (events.dwell_histogram(), "dwell time [s]", True),
+            (events.amplitude_histogram(), "mean current [pA]", False)
+        ):
+            with dpg.plot(height=-1, width=385):
+                dpg.add_plot_axis(
+                    dpg.mvXAxis, label=x_label,
+                    scale=dpg.mvPlotScale_Log10 if log_scale
+                    else dpg.mvPlotScale_Linear
+                )
+                y_axis = dpg.add_plot_axis(dpg.mvYAxis, label="events")
+                dpg.add_stair_series(
+                    edges.tolist(), np.append(counts, 0).tolist(),
+                    parent=y_axis
+                )
+
+
+def _show_window(label: str, series_data: SeriesData) -> None:
+    # on the render thread, once the data is ready
+    target = dpg.add_window(label=label, width=800, height=600)
     _plot_series(target, series_data)
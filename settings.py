@@ -1,12 +1,13 @@
 from typing import Union, Dict, Any
 from pathlib import Path
+import os
 import time
 
 import dearpygui.dearpygui as dpg
 from command_central import _show_experiment_info
 
 from context import Context
-from utils import determine_scaling
+from performance import setup_instrumentation
 
 DpgItem = Union[int, str]
 
@@ -17,6 +18,7 @@ def add_settings(tab_tag: DpgItem, context: Context):
         _add_database_select(context)
         _add_event_distribution_settings(context)
         _add_plot_settings(context)
+        _add_processing_settings(context)
     settings = context.settings
     update_event_bands(
         min_ev=settings.get('min_event_band', 0.27),
@@ -137,6 +139,12 @@ def _add_plot_settings(context: Context):
             dpg.add_text("Show event bands:      ")
             dpg.add_text("x-axis labeling:")
             dpg.add_text("Random KDEs:")
+            dpg.add_text("Stream squiggle data:")
+            with dpg.tooltip(dpg.last_item()):
+                dpg.add_text("[load only the visible part of a channel]")
+            dpg.add_text("Density window [s]:")
+            with dpg.tooltip(dpg.last_item()):
+                dpg.add_text("[time resolution of densities over time]")
         with dpg.group():
             dpg.add_checkbox(
                 tag="show_bands", default_value=False,
@@ -152,6 +160,78 @@ def _add_plot_settings(context: Context):
                 max_value=126, default_value=10,
                 callback=select_random_kdes, user_data=context
             )
+            dpg.add_checkbox(
+                tag="stream_raw",
+                default_value=context.settings.get('stream_raw', True),
+                callback=toggle_stream_raw, user_data=context
+            )
+            dpg.add_slider_int(
+                tag="density_window", clamped=True, min_value=1,
+                max_value=600,
+                default_value=context.settings.get('density_window', 10),
+                callback=select_density_window, user_data=context
+            )
+    dpg.add_spacer(height=5)
+    dpg.add_separator()
+
+
+def _add_processing_settings(context: Context):
+    dpg.add_spacer(height=2)
+    dpg.add_text("Processing Settings:")
+    dpg.add_spacer(height=2)
+    with dpg.group(horizontal=True):
+        # table like grouping, have labels in first group for auto alignment
+        with dpg.group():
+            dpg.add_text("Scan workers:          ")
+            with dpg.tooltip(dpg.last_item()):
+                dpg.add_text("[processes used to scan the channels]")
+            dpg.add_text("Probe margin:")
+            with dpg.tooltip(dpg.last_item()):
+                dpg.add_text(
+                    "[confidence to skip dead channels, 0 reads all]"
+                )
+            dpg.add_text("KDE cache [MB]:")
+            with dpg.tooltip(dpg.last_item()):
+                dpg.add_text("[disk space for stored density plots]")
+            dpg.add_text("Prefetch [MB]:")
+            with dpg.tooltip(dpg.last_item()):
+                dpg.add_text("[memory for channels read ahead, 0 disables]")
+            dpg.add_text("Raw cache [MB]:")
+            with dpg.tooltip(dpg.last_item()):
+                dpg.add_text(
+                    "[disk space for decompressed raw signals, 0 disables]"
+                )
+        with dpg.group():
+            dpg.add_slider_int(
+                tag="scan_workers", clamped=True, min_value=1,
+                max_value=os.cpu_count() or 1,
+                default_value=context.settings.get('scan_workers', 1),
+                callback=select_scan_workers, user_data=context
+            )
+            dpg.add_slider_float(
+                tag="probe_margin", clamped=True, min_value=0,
+                max_value=10, format="%.1f",
+                default_value=context.settings.get('probe_margin', 5.0),
+                callback=select_probe_margin, user_data=context
+            )
+            dpg.add_slider_int(
+                tag="kde_cache_mb", clamped=True, min_value=0,
+                max_value=4096,
+                default_value=context.settings.get('kde_cache_mb', 256),
+                callback=select_kde_cache_size, user_data=context
+            )
+            dpg.add_slider_int(
+                tag="prefetch_mb", clamped=True, min_value=0,
+                max_value=16384,
+                default_value=context.settings.get('prefetch_mb', 512),
+                callback=select_prefetch_size, user_data=context
+            )
+            dpg.add_slider_int(
+                tag="raw_cache_mb", clamped=True, min_value=0,
+                max_value=65536,
+                default_value=context.settings.get('raw_cache_mb', 0),
+                callback=select_raw_cache_size, user_data=context
+            )
     dpg.add_spacer(height=5)
     dpg.add_separator()
 
@@ -213,16 +293,26 @@ def choose_db(
     update_plot_settings(
         settings.get('random_kdes', 10),
         settings.get('scale_in_seconds', False),
-        settings.get('plot_event_bands', False)
+        settings.get('plot_event_bands', False),
+        settings.get('stream_raw', True)
     )
+    dpg.set_value("scan_workers", settings.get('scan_workers', 1))
+    dpg.set_value("probe_margin", settings.get('probe_margin', 5.0))
+    dpg.set_value("kde_cache_mb", settings.get('kde_cache_mb', 256))
+    dpg.set_value("prefetch_mb", settings.get('prefetch_mb', 512))
+    dpg.set_value("raw_cache_mb", settings.get('raw_cache_mb', 0))
+    dpg.set_value("density_window", settings.get('density_window', 10))
+    dpg.set_value("instrumentation", settings.get('instrumentation', False))
+    setup_instrumentation(user_data)
     dpg.configure_item("save_exps", show=True)
     dpg.configure_item("exit_button", label="Save Experiments and Quit")
 
 
 def update_plot_settings(
-    random_kdes: int, scale: bool, show_bands: bool
+    random_kdes: int, scale: bool, show_bands: bool, stream_raw: bool
 ) -> None:
     dpg.set_value("show_bands", show_bands)
+    dpg.set_value("stream_raw", stream_raw)
     axis_label = "seconds" if scale else "datapoints"
     dpg.configure_item("axis_labeling", default_value=axis_label)
     dpg.configure_item("random_kdes", default_value=random_kdes)
@@ -348,23 +438,7 @@ def update_context_with_settings(
             or user_data.active_exp.get_active_channels() is None:
         return
 
-    min_ev = user_data.settings['min_event_band']
-    max_ev = user_data.settings['max_event_band']
-    scaling = determine_scaling(min_ev, max_ev)
-    bands = user_data.active_exp.band_distribution
-    if bands == {}:
-        recompute = True
-    else:
-        try:
-            if (min_ev, max_ev) in next(iter(bands.values()))[scaling].keys():
-                recompute = False
-            else:
-                recompute = True
-        except (KeyError, StopIteration):
-            # KeyError stems from scaling missing as key
-            # StopIteration stems from empty bands dict
-            recompute = True
-            pass
+    recompute = not user_data.has_band_distribution()
     if recompute:
         dpg.configure_item("func_choose", show=False)
         dpg.configure_item("exp_info", show=False)
@@ -373,6 +447,9 @@ def update_context_with_settings(
             dpg.configure_item("channel", items=chans)
             dpg.configure_item("toggle_channels", show=True)
             dpg.configure_item("func_choose", show=True)
+            if user_data.has_channel_histograms():
+                # cheap, no need to wait for the user
+                user_data.calculate_band_distributions()
             if user_data.has_band_distribution():
                 _show_experiment_info(user_data)
             else:
@@ -392,6 +469,14 @@ def toggle_show_bands(
     user_data.settings['plot_event_bands'] = dpg.get_value(sender)
 
 
+def toggle_stream_raw(
+    sender: DpgItem,
+    app_data: Dict[str, Any],
+    user_data: Context
+) -> None:
+    user_data.settings['stream_raw'] = dpg.get_value(sender)
+
+
 def select_random_kdes(
     sender: DpgItem,
     app_data: Dict[str, Any],
@@ -400,6 +485,14 @@ def select_random_kdes(
     user_data.settings['random_kdes'] = dpg.get_value(sender)
 
 
+def select_density_window(
+    sender: DpgItem,
+    app_data: Dict[str, Any],
+    user_data: Context
+) -> None:
+    user_data.settings['density_window'] = dpg.get_value(sender)
+
+
 def select_axis_labeling(
     sender: DpgItem,
     app_data: Dict[str, Any],
@@ -407,3 +500,49 @@ def select_axis_labeling(
 ) -> None:
     user_data.settings['scale_in_seconds'] \
         = (dpg.get_value(sender) == 'seconds')
+
+
+def select_scan_workers(
+    sender: DpgItem,
+    app_data: Dict[str, Any],
+    user_data: Context
+) -> None:
+    user_data.settings['scan_workers'] = dpg.get_value(sender)
+
+
+def select_probe_margin(
+    sender: DpgItem,
+    app_data: Dict[str, Any],
+    user_data: Context
+) -> None:
+    user_data.settings['probe_margin'] = dpg.get_value(sender)
+
+
+def select_kde_cache_size(
+    sender: DpgItem,
+    app_data: Dict[str, Any],
+    user_data: Context
+) -> None:
+    user_data.settings['kde_cache_mb'] = dpg.get_value(sender)
+    # shrink right away if the budget got smaller
+    user_data.kde_cache.evict()
+
+
+def select_prefetch_size(
+    sender: DpgItem,
+    app_data: Dict[str, Any],
+    user_data: Context
+) -> None:
+    user_data.settings['prefetch_mb'] = dpg.get_value(sender)
+    user_data.prefetcher.max_bytes = user_data.settings['prefetch_mb'] * 2**20
+    user_data.prefetcher.evict()
+
+
+def select_raw_cache_size(
+    sender: DpgItem,
+    app_data: Dict[str, Any],
+    user_data: Context
+) -> None:
+    user_data.settings['raw_cache_mb'] = dpg.get_value(sender)
+    # evicts right away if the budget got smaller
+    user_data.configure_raw_cache()
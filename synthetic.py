@@ -0,0 +1,129 @@
+import argparse
+from typing import Iterable, Optional, Union
+
+import h5py
+import numpy as np
+
+# calibration of the generated files, current = (adc + offset) * range/digi
+ADC_OFFSET = -10.0
+ADC_RANGE = 1402.882
+ADC_DIGITISATION = 8192.0
+
+
+def synthetic_channel(
+    rng: np.random.Generator, length: int, baseline: float,
+    noise: float = 8.0, event_rate: float = 5.0, event_dwell: float = 40.0,
+    event_level: float = 0.35, zero_rate: float = 0.05,
+    sample_rate: float = 4000.0
+) -> np.ndarray:
+    # Current trace of an open pore: gaussian noise around the baseline,
+    # blockades at event_level * baseline with exponential dwell times
+    # (event_rate per second, event_dwell samples on average) and short
+    # drops to zero current (zero_rate per second).
+    current = rng.normal(baseline, noise, length)
+    for rate, dwell, level in (
+        (event_rate, event_dwell, event_level * baseline),
+        (zero_rate, 10 * event_dwell, 0.0)
+    ):
+        n_events = rng.poisson(rate * length / sample_rate)
+        if n_events == 0:
+            continue
+        starts = rng.integers(0, length, n_events)
+        ends = np.minimum(
+            length, starts + 1 + rng.exponential(dwell, n_events).astype(int)
+        )
+        mask = np.zeros(length + 1, dtype=np.int32)
+        np.add.at(mask, starts, 1)
+        np.add.at(mask, ends, -1)
+        blocked = np.cumsum(mask[:-1]) > 0
+        current[blocked] = rng.normal(
+            level, noise / 2 if level else 2.0, int(blocked.sum())
+        )
+    return current
+
+
+def write_bulk_file(
+    fpath: str, channels: int = 126, length: int = 1_000_000,
+    baseline: float = 220.0, baseline_spread: float = 20.0,
+    event_rate: float = 5.0, dead_channels: Union[float, Iterable[int]] = 0.3,
+    sample_rate: int = 4000, seed: int = 0,
+    compression: Optional[str] = 'gzip', saturated_channels: Iterable[int] = ()
+) -> None:
+    # Bulk FAST5 in the layout read by fast5_research.BulkFast5. Dead
+    # channels are either a fraction of all channels or explicit ids and
+    # only carry noise around zero, saturated channels sit at the upper
+    # end of the ADC range.
+    rng = np.random.default_rng(seed)
+    if isinstance(dead_channels, float):
+        dead = set(rng.choice(
+            np.arange(1, channels + 1),
+            int(round(dead_channels * channels)), replace=False
+        ).tolist())
+    else:
+        dead = set(dead_channels)
+    saturated = set(saturated_channels)
+    meta = {
+        'offset': ADC_OFFSET,
+        'range': ADC_RANGE,
+        'digitisation': ADC_DIGITISATION,
+        'sample_rate': float(sample_rate),
+    }
+    unit = ADC_RANGE / ADC_DIGITISATION
+
+    with h5py.File(fpath, 'w') as fh:
+        fh.create_group('UniqueGlobalKey/tracking_id').attrs['run_id'] = \
+            f"synthetic_{seed}"
+        fh.create_group('UniqueGlobalKey/context_tags').attrs[
+            'sample_frequency'
+        ] = str(sample_rate)
+        fh.create_group('Meta').attrs['sample_rate'] = sample_rate
+        for c in range(1, channels + 1):
+            if c in saturated:
+                # a few codes below the clipping limit
+                current = rng.normal(
+                    (2**15 - 4 + ADC_OFFSET) * unit, 1.0, length
+                )
+            elif c in dead:
+                current = rng.normal(0.0, 2.0, length)
+            else:
+                current = synthetic_channel(
+                    rng, length,
+                    baseline + rng.uniform(-1, 1) * baseline_spread,
+                    event_rate=event_rate, sample_rate=sample_rate
+                )
+            raw = np.round(current / unit - ADC_OFFSET)
+            raw = np.clip(raw, -2**15, 2**15 - 1).astype(np.int16)
+            for group in (
+                f'IntermediateData/Channel_{c}', f'Raw/Channel_{c}'
+            ):
+                attrs = fh.create_group(f'{group}/Meta').attrs
+                for key, value in meta.items():
+                    attrs[key] = value
+            fh.create_dataset(
+                f'Raw/Channel_{c}/Signal', data=raw,
+                compression=compression, chunks=True
+            )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Write a synthetic bulk FAST5 file."
+    )
+    parser.add_argument("fpath")
+    parser.add_argument("--channels", type=int, default=126)
+    parser.add_argument("--length", type=int, default=1_000_000)
+    parser.add_argument("--baseline", type=float, default=220.0)
+    parser.add_argument("--event-rate", type=float, default=5.0)
+    parser.add_argument(
+        "--dead", type=float, default=0.3, help="fraction of dead channels"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    write_bulk_file(
+        args.fpath, args.channels, args.length, args.baseline,
+        event_rate=args.event_rate, dead_channels=args.dead, seed=args.seed
+    )
+
+
+if __name__ == '__main__':
+    main()
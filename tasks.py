@@ -0,0 +1,131 @@
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import threading
+from typing import Any, Callable, List, Optional, Tuple, Union
+
+import dearpygui.dearpygui as dpg
+
+DpgItem = Union[int, str]
+
+
+class TaskCancelled(Exception):
+    pass
+
+
+class Task:
+    # Handle of a background job. The job reports its progress through it,
+    # which doubles as the point where a cancellation takes effect.
+
+    def __init__(self, name: str) -> None:
+        self.name: str = name
+        self.progress: float = 0.0
+        self.message: str = name
+        self._cancel = threading.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def cancel(self) -> None:
+        self._cancel.set()
+
+    def report(self, fraction: float, message: Optional[str] = None) -> None:
+        if self.cancelled:
+            raise TaskCancelled(self.name)
+        self.progress = fraction
+        if message is not None:
+            self.message = message
+
+
+class TaskExecutor:
+    # Runs long jobs off the render thread, one after the other as they
+    # share the context. poll() is called every frame: it mirrors the
+    # progress of the running job and hands finished results to their
+    # callbacks on the render thread.
+
+    def __init__(
+        self, progress_bar: DpgItem = "Progress Bar",
+        cancel_button: DpgItem = "cancel_task"
+    ) -> None:
+        self.progress_bar = progress_bar
+        self.cancel_button = cancel_button
+        self._pool = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="nanotrace_task"
+        )
+        # (task, on_done or on_fail, their arguments)
+        self._finished: "queue.SimpleQueue[Tuple[Task, Any, Any]]" = \
+            queue.SimpleQueue()
+        self._tasks: List[Task] = []
+        self._shown = False
+
+    @property
+    def busy(self) -> bool:
+        return self._tasks != []
+
+    def submit(
+        self, name: str, func: Callable[..., Any], *args,
+        on_done: Optional[Callable[[Any], None]] = None,
+        on_fail: Optional[Callable[[], None]] = None, **kwargs
+    ) -> Task:
+        # func is called with an additional progress keyword, a
+        # utils.ProgressCallback that raises TaskCancelled once cancelled;
+        # on_done gets the result, on_fail is called on errors/cancellation
+        task = Task(name)
+        self._tasks.append(task)
+
+        def _run():
+            try:
+                result = func(*args, progress=task.report, **kwargs)
+            except Exception as e:
+                if isinstance(e, TaskCancelled):
+                    print(f"{task.name} cancelled")
+                else:
+                    print(e)
+                self._finished.put((task, on_fail, ()))
+                return
+            self._finished.put((task, on_done, (result,)))
+
+        self._pool.submit(_run)
+        return task
+
+    def cancel(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+
+    def poll(self) -> None:
+        while True:
+            try:
+                task, callback, args = self._finished.get_nowait()
+            except queue.Empty:
+                break
+            self._tasks.remove(task)
+            if callback is not None:
+                try:
+                    callback(*args)
+                except Exception as e:
+                    print(e)
+        self._show_progress()
+
+    def _show_progress(self) -> None:
+        if not dpg.does_item_exist(self.progress_bar):
+            return
+        if not self._tasks:
+            if self._shown:
+                dpg.configure_item(self.progress_bar, show=False)
+                dpg.configure_item(self.cancel_button, show=False)
+                self._shown = False
+            return
+        task = self._tasks[0]
+        dpg.set_value(self.progress_bar, task.progress)
+        dpg.configure_item(
+            self.progress_bar, overlay=task.message, show=True, width=175
+        )
+        dpg.configure_item(self.cancel_button, show=True)
+        self._shown = True
+
+    def shutdown(self) -> None:
+        self.cancel()
+        self._pool.shutdown(wait=False)
+
+
+executor = TaskExecutor()
@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+
+from experiment import Experiment
+from utils import determine_scaling, event_density
+
+
+def _old_band_dict(band_distribution, event_low, event_high):
+    # the former lookups of Experiment, None where a channel lacks bounds
+    scaling = determine_scaling(event_low, event_high)
+    try:
+        return {
+            c: val[scaling][(event_low, event_high)]
+            for c, val in band_distribution.items()
+        }
+    except KeyError:
+        return None
+
+
+def _old_mean_events(band_distribution, event_low, event_high, filter_mad):
+    if not band_distribution or (band_dict := _old_band_dict(
+        band_distribution, event_low, event_high
+    )) is None:
+        return None
+    if filter_mad:
+        baselines = {k: v[0] for k, v in band_dict.items()}
+        bl_median = np.median(list(baselines.values()))
+        bl_mad = np.median(
+            [abs(bl - bl_median) for bl in baselines.values()]
+        )
+        events = [
+            event_density(v[1]) for k, v in band_dict.items()
+            if abs(baselines[k] - bl_median) < 3*bl_mad
+        ]
+    else:
+        events = [event_density(v[1]) for v in band_dict.values()]
+    return (round(np.mean(events), 4), round(np.std(events), 3))
+
+
+def _old_mean_baselines(
+    band_distribution, event_low, event_high, filter_mad
+):
+    if not band_distribution or (band_dict := _old_band_dict(
+        band_distribution, event_low, event_high
+    )) is None:
+        return None
+    baselines = [val[0] for val in band_dict.values()]
+    if filter_mad:
+        bl_median = np.median(baselines)
+        bl_mad = np.median([abs(bl - bl_median) for bl in baselines])
+        baselines = [
+            bl for bl in baselines if abs(bl - bl_median) < 3*bl_mad
+        ]
+    return (round(np.mean(baselines), 2), round(np.std(baselines), 3))
+
+
+def _band_distribution(rng, channels, bounds):
+    # a few channels far off the common baseline are masked by the MAD
+    distribution = {}
+    for c in channels:
+        baseline = int(rng.integers(210, 230))
+        if c % 10 == 0:
+            baseline += 80
+        for low, high in bounds:
+            distribution.setdefault(c, {}).setdefault(
+                determine_scaling(low, high), {}
+            )[(low, high)] = (baseline, {
+                'outlier': tuple(int(n) for n in rng.integers(0, 100, 3)),
+                'zeroes': int(rng.integers(0, 1000)),
+                'events': int(rng.integers(100, 10_000)),
+                'baseline': int(rng.integers(50_000, 100_000)),
+            })
+    return distribution
+
+
+BOUNDS = [(0.27, 0.48), (40, 130), (0.3, 150)]
+
+
+def _experiments():
+    rng = np.random.default_rng(0)
+    full = _band_distribution(rng, range(1, 61), BOUNDS)
+    # one channel lacks the last bounds
+    partial = _band_distribution(rng, range(1, 41), BOUNDS)
+    del partial[7]['lower']
+    return [full, partial, {}]
+
+
+@pytest.mark.parametrize('filter_mad', [True, False])
+@pytest.mark.parametrize('bounds', BOUNDS + [(0.1, 0.2)])
+@pytest.mark.parametrize('which', range(3))
+def test_means_match_the_former_dict_aggregation(which, bounds, filter_mad):
+    distribution = _experiments()[which]
+    exp = Experiment("run.fast5", "run.fast5", {}, {}, distribution)
+    assert exp.get_mean_events(*bounds, filter_mad) \
+        == _old_mean_events(distribution, *bounds, filter_mad)
+    assert exp.get_mean_baselines(*bounds, filter_mad) \
+        == _old_mean_baselines(distribution, *bounds, filter_mad)
+
+
+def test_mad_mask_excludes_off_baseline_channels():
+    distribution = _experiments()[0]
+    exp = Experiment("run.fast5", "run.fast5", {}, {}, distribution)
+    table = exp.band_table.select(0.27, 0.48)
+    excluded = set(table.channel[~table.mad_mask()].tolist())
+    assert excluded == {c for c in distribution if c % 10 == 0}
@@ -0,0 +1,41 @@
+import os
+import shutil
+
+from context import Context
+from fingerprint import get_fingerprint
+from synthetic import write_bulk_file
+
+
+def _flip_unsampled_byte(fpath):
+    # same size and sampled blocks (see get_fingerprint), other contents
+    step = (os.path.getsize(fpath) - 65_536) // 15
+    pos = (step + 65_536) // 2
+    with open(fpath, 'r+b') as fh:
+        fh.seek(pos)
+        byte = fh.read(1)[0]
+        fh.seek(pos)
+        fh.write(bytes([byte ^ 1]))
+
+
+def test_sampled_match_is_verified_by_the_full_hash(tmp_path):
+    first = str(tmp_path / "run_1nM.fast5")
+    write_bulk_file(first, channels=2, length=1_000_000, compression=None)
+    context = Context(str(tmp_path / "exps.db"))
+    context.update_context(first, hash_in_background=False)
+    exp = context.active_exp
+
+    moved = str(tmp_path / "moved_1nM.fast5")
+    shutil.copy(first, moved)
+    context.update_context(moved, hash_in_background=False)
+    assert context.active_exp is exp
+
+    changed = str(tmp_path / "changed_1nM.fast5")
+    shutil.copy(first, changed)
+    _flip_unsampled_byte(changed)
+    assert get_fingerprint(changed).identity \
+        == get_fingerprint(first).identity
+    context.update_context(changed, hash_in_background=False)
+    assert context.active_exp is not exp
+    assert context.active_exp.hashs['blake2b'] != exp.hashs['blake2b']
+    assert exp.path == moved
+    context.exps.close()
@@ -0,0 +1,24 @@
+import numpy as np
+
+from decimation import WindowedRawSource
+from synthetic import write_bulk_file
+
+
+def test_cached_query_never_reads(tmp_path):
+    fpath = str(tmp_path / "squiggle.fast5")
+    write_bulk_file(fpath, channels=1, length=300_000, dead_channels=[])
+    source = WindowedRawSource(fpath, 1)
+    coarse, fine = (0, 300_000, 4000), (0, 50_000, 4000)
+
+    assert source.cached_query(*coarse) is None
+    source.load(source.missing(*coarse))
+    assert source.missing(*coarse) == []
+    x_data, y_data = source.cached_query(*coarse)
+    expected = WindowedRawSource(fpath, 1).query(*coarse)
+    assert np.array_equal(x_data, expected[0])
+    assert np.array_equal(y_data, expected[1])
+
+    # finer windows are missing, the coarser level stands in
+    assert source.missing(*fine)
+    x_data, _ = source.cached_query(*fine)
+    assert 0 < len(x_data) < len(source.query(*fine)[0])
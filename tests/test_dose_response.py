@@ -0,0 +1,127 @@
+import numpy as np
+import pytest
+
+from dose_response import experiment_densities, fit_dose_response
+from experiment import Experiment
+from experiment_store import ExperimentStore
+from utils import determine_scaling
+
+# bottom, top, log10 of the half effective concentration and hill slope
+TRUE_PARAMS = np.array([2.0, 12.0, 0.5, 1.3])
+LEVELS = np.array([0.0, 0.03, 0.1, 0.3, 1.0, 3.0, 10.0, 30.0, 100.0])
+
+
+def _logistic(concentrations, params):
+    bottom, top, log_ec50, hill = params
+    with np.errstate(divide='ignore'):
+        x = np.log10(concentrations)
+    return bottom + (top - bottom) / (1 + 10 ** (hill * (log_ec50 - x)))
+
+
+def _calibrants(rng, noise, replicates=4):
+    concentrations = np.repeat(LEVELS, replicates)
+    densities = _logistic(concentrations, TRUE_PARAMS) \
+        + rng.normal(0, noise, len(concentrations))
+    return concentrations, densities
+
+
+def test_logistic_fit_recovers_known_parameters():
+    rng = np.random.default_rng(1)
+    fit = fit_dose_response(
+        *_calibrants(rng, 0.05), model='logistic', n_boot=200
+    )
+    assert fit.params == pytest.approx(TRUE_PARAMS, abs=0.1)
+    assert fit.bootstrap.shape == (200, 4)
+    # the bootstrap scatters around the fit
+    low, high = np.percentile(fit.bootstrap, [2.5, 97.5], axis=0)
+    assert np.all((low <= fit.params) & (fit.params <= high))
+    assert np.all(high - low < 0.5)
+
+
+def test_linear_fit_recovers_known_parameters():
+    rng = np.random.default_rng(2)
+    concentrations = np.repeat(np.array([0.0, 1.0, 2.0, 5.0, 10.0]), 3)
+    densities = 0.5 + 1.5 * concentrations \
+        + rng.normal(0, 0.05, len(concentrations))
+    fit = fit_dose_response(concentrations, densities, n_boot=100)
+    assert fit.params == pytest.approx([0.5, 1.5], abs=0.05)
+    assert fit.predict([4.0]) == pytest.approx([6.5], abs=0.1)
+
+
+@pytest.mark.parametrize('model', ['linear', 'logistic'])
+def test_invert_round_trips_the_fit(model):
+    rng = np.random.default_rng(3)
+    fit = fit_dose_response(
+        *_calibrants(rng, 0.05), model=model, n_boot=100
+    )
+    concentrations = np.array([0.05, 0.5, 2.0, 20.0])
+    estimate, low, high = fit.invert(fit.predict(concentrations))
+    assert estimate == pytest.approx(concentrations, rel=1e-6)
+    assert np.all((low <= estimate) & (estimate <= high))
+
+
+def test_invert_is_nan_outside_of_the_calibrated_range():
+    rng = np.random.default_rng(4)
+    fit = fit_dose_response(
+        *_calibrants(rng, 0.05), model='logistic', n_boot=100
+    )
+    estimate, low, high = fit.invert([fit.params[0] - 1, fit.params[1] + 1])
+    assert np.all(np.isnan(estimate))
+    assert np.all(np.isnan(low)) and np.all(np.isnan(high))
+
+
+def test_too_few_concentrations_are_rejected():
+    with pytest.raises(ValueError):
+        fit_dose_response([1.0, 1.0, 2.0, 3.0], [1, 2, 3, 4], 'logistic')
+
+
+def _band_distribution(rng, channels, bounds):
+    # channels 10, 20, ... far off the common baseline
+    distribution = {}
+    for c in channels:
+        baseline = int(rng.integers(210, 230)) + (80 if c % 10 == 0 else 0)
+        distribution[c] = {determine_scaling(*bounds): {bounds: (baseline, {
+            'outlier': tuple(int(n) for n in rng.integers(0, 100, 3)),
+            'zeroes': int(rng.integers(0, 1000)),
+            'events': int(rng.integers(100, 10_000)),
+            'baseline': int(rng.integers(50_000, 100_000)),
+        })}}
+    return distribution
+
+
+@pytest.mark.parametrize('filter_mad', [True, False])
+def test_experiment_densities_match_the_experiments(tmp_path, filter_mad):
+    rng = np.random.default_rng(5)
+    bounds = (0.27, 0.48)
+    store = ExperimentStore(tmp_path / "exps.db")
+    for i, concentration in enumerate((1.0, 10.0, None, 3.0)):
+        bands = _band_distribution(
+            rng, range(1, int(rng.integers(20, 127))), bounds
+        )
+        if i == 3:
+            # a channel without these bounds, no mean for the experiment
+            del bands[5]['both']
+            bands[5]['none'] = {(40, 130): (220, {
+                'outlier': (1, 2, 3), 'zeroes': 4, 'events': 5,
+                'baseline': 50
+            })}
+        properties = {} if concentration is None \
+            else {'concentration': concentration}
+        store[f"hash{i}"] = Experiment(
+            f"run{i}.fast5", f"run{i}.fast5", {'blake2b': f"hash{i}"},
+            properties, bands
+        )
+    store.save()
+
+    data = experiment_densities(*store.band_results(*bounds), filter_mad)
+    assert sorted(data.keys) == sorted(store)
+    for key, density, sd in zip(data.keys, data.densities, data.sd):
+        expected = store[key].get_mean_events(*bounds, filter_mad)
+        if expected is None:
+            assert np.isnan(density)
+        else:
+            assert (density, sd) == pytest.approx(expected, abs=1e-3)
+            assert density == pytest.approx(expected[0], abs=1e-4)
+    assert store["hash3"].get_mean_events(*bounds) is None
+    assert np.isnan(data.concentrations[data.keys.index("hash2")])
+    store.close()
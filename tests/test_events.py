@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+from fast5_research.fast5_bulk import BulkFast5
+
+from events import detect_events, get_channel_events
+from histogram import code_limit
+from raw_io import calibrate
+from synthetic import write_bulk_file
+
+
+def _reference_events(values, low_band, high_band, min_duration=1):
+    # sample by sample run length encoding of low_band < value < high_band
+    events = []
+    run = []
+    for i, value in enumerate(np.append(values, np.nan)):
+        if low_band < value < high_band:
+            run.append(i)
+            continue
+        if len(run) >= min_duration:
+            samples = values[run[0]:run[-1] + 1]
+            events.append((run[0], len(run), samples.mean(), samples.min()))
+        run = []
+    return [np.array(col) for col in zip(*events)] or [np.zeros(0)] * 4
+
+
+def _signal(rng, n=20_000):
+    # open pore with blockades of a few up to hundreds of samples
+    values = rng.normal(220, 5, n)
+    for start in rng.integers(0, n, 60):
+        values[start:start + rng.integers(1, 400)] = rng.normal(90, 15)
+    return values
+
+
+def _split(rng, values, n_chunks):
+    # chunks of random length, some of a single sample and some empty
+    cuts = np.sort(rng.integers(0, len(values), n_chunks))
+    return np.split(values, cuts)
+
+
+def _assert_events(table, expected, start=0):
+    first, duration, mean, minimum = expected
+    assert np.array_equal(table.start, first + start)
+    assert np.array_equal(table.duration, duration)
+    assert table.mean == pytest.approx(mean)
+    assert np.array_equal(table.minimum, minimum)
+
+
+@pytest.mark.parametrize('min_duration', [1, 5])
+@pytest.mark.parametrize('n_chunks', [0, 3, 200])
+def test_chunk_boundaries_never_split_events(n_chunks, min_duration):
+    rng = np.random.default_rng(n_chunks)
+    values = _signal(rng)
+    events = detect_events(
+        _split(rng, values, n_chunks), 50, 150, start=1000,
+        min_duration=min_duration
+    )
+    _assert_events(
+        events, _reference_events(values, 50, 150, min_duration), 1000
+    )
+
+
+def test_events_reaching_the_last_sample():
+    values = np.array([220, 90, 90, 220, 90, 90], dtype=np.float64)
+    events = detect_events([values[:2], values[2:5], values[5:]], 50, 150)
+    _assert_events(events, _reference_events(values, 50, 150))
+
+
+def test_code_limits_exclude_samples_on_the_band_limits():
+    # every band limit is the value of a code, samples on the limits are
+    # outside the band as for the band counts
+    calibration = (0.0, 0.5)
+    codes = np.array(
+        [440, 100, 101, 440, 299, 300, 301, 440, 100, 200, 300, 440],
+        dtype=np.int16
+    )
+    values = calibrate(codes, calibration)
+    events = detect_events(
+        [codes[:5], codes[5:]],
+        code_limit(calibration, 50.0, strict=True),
+        code_limit(calibration, 150.0)
+    )
+    expected = _reference_events(values, 50.0, 150.0)
+    assert np.array_equal(events.start, expected[0])
+    assert np.array_equal(events.duration, expected[1])
+    assert np.array_equal(events.duration, [1, 1, 1])
+
+
+def test_channel_events_match_the_calibrated_signal(tmp_path):
+    fpath = str(tmp_path / "events.fast5")
+    write_bulk_file(
+        fpath, channels=1, length=200_000, dead_channels=[], event_rate=50
+    )
+    with BulkFast5(fpath) as fh:
+        values = fh.get_raw(1)[5000:]
+    # a low band on the most frequent blockade value, those samples are
+    # outside the band
+    blockades, counts = np.unique(
+        values[(60 < values) & (values < 160)], return_counts=True
+    )
+    low_band = float(blockades[np.argmax(counts)])
+    events = get_channel_events(fpath, 1, 5000, low_band, 160)
+    assert len(events)
+    _assert_events(events, _reference_events(values, low_band, 160), 5000)
@@ -0,0 +1,197 @@
+import pickle
+import sqlite3
+
+import numpy as np
+import pytest
+
+from dose_response import experiment_densities
+from experiment import Experiment
+from experiment_store import ExperimentStore
+from histogram import ChannelHistogram, CodeHistogram
+
+
+def _band(events):
+    return {
+        'outlier': (1, 2, 3), 'zeroes': 4, 'events': events, 'baseline': 50
+    }
+
+
+def test_replaced_bands_are_written_again(tmp_path):
+    db = tmp_path / "exps.db"
+    store = ExperimentStore(db)
+    exp = Experiment("run.fast5", "run.fast5", {'blake2b': "abc"}, {})
+    exp.update_bands({3: {'none': {(0, 250): (220, _band(10))}}})
+    store["abc"] = exp
+    store.save()
+
+    # same channel and bounds, e.g. results merged after hashing
+    exp.update_bands({3: {'none': {(0, 250): (225, _band(20))}}})
+    store.save()
+    store.close()
+
+    reopened = ExperimentStore(db)
+    baseline, band = reopened["abc"].band_table.lookup(3, 0, 250)
+    reopened.close()
+    assert (baseline, band['events']) == (225, 20)
+
+
+def _old_band_distribution(rng, channels):
+    # {channel -> {scaling -> {bounds -> (baseline, band)}}}
+    return {
+        c: {
+            'both': {(0.27, 0.48): (
+                int(rng.integers(200, 240)), {
+                    'outlier': tuple(int(n) for n in rng.integers(0, 50, 3)),
+                    'zeroes': int(rng.integers(0, 500)),
+                    'events': int(rng.integers(100, 5000)),
+                    'baseline': int(rng.integers(50_000, 90_000)),
+                }
+            )},
+            'none': {(40, 130): (
+                int(rng.integers(200, 240)), _band(int(rng.integers(1, 100)))
+            )},
+        }
+        for c in channels
+    }
+
+
+def _old_experiment(name, file_hash, concentration, band_distribution):
+    # as pickled before the band table and histograms
+    exp = Experiment.__new__(Experiment)
+    exp.__dict__.update(
+        name=name, path=f"/data/{name}", hashs={'blake2b': file_hash},
+        properties={'concentration': concentration},
+        band_distribution=band_distribution
+    )
+    return exp
+
+
+def test_pickle_database_is_migrated_once(tmp_path):
+    rng = np.random.default_rng(0)
+    bands = {
+        f"hash{i}": _old_band_distribution(rng, rng.choice(
+            np.arange(1, 127), 20, replace=False
+        ).tolist())
+        for i in range(3)
+    }
+    concentrations = {'hash0': 1.0, 'hash1': 10.0, 'hash2': float('nan')}
+    db = tmp_path / "exps.db"
+    with open(db, 'wb') as fh:
+        pickle.dump({
+            'settings': {'burnin': 1000, 'min_event_band': 0.27},
+            'exps': {
+                key: _old_experiment(
+                    f"run_{key}.fast5", key, concentrations[key], band
+                )
+                for key, band in bands.items()
+            }
+        }, fh)
+
+    store = ExperimentStore(db)
+    backup = tmp_path / "exps.db.pickle.bak"
+    assert backup.is_file()
+    assert store.load_settings() == {'burnin': 1000, 'min_event_band': 0.27}
+    assert sorted(store) == sorted(bands)
+    for key, band in bands.items():
+        exp = store[key]
+        expected = Experiment(exp.name, exp.path, {}, {}, band)
+        assert exp.band_distribution == band
+        for bounds in ((0.27, 0.48), (40, 130)):
+            assert exp.get_mean_events(*bounds) \
+                == expected.get_mean_events(*bounds)
+            assert exp.get_mean_baselines(*bounds) \
+                == expected.get_mean_baselines(*bounds)
+
+    data = experiment_densities(*store.band_results(0.27, 0.48))
+    for key, density, concentration in zip(
+        data.keys, data.densities, data.concentrations
+    ):
+        assert density == pytest.approx(
+            store[key].get_mean_events(0.27, 0.48)[0], abs=1e-4
+        )
+        assert concentration == pytest.approx(
+            concentrations[key], nan_ok=True
+        )
+    store.close()
+
+    # a database now, opened without migrating again
+    backup_mtime = backup.stat().st_mtime_ns
+    reopened = ExperimentStore(db)
+    assert backup.stat().st_mtime_ns == backup_mtime
+    assert not (tmp_path / "exps.db.pickle.bak.pickle.bak").exists()
+    assert sorted(reopened) == sorted(bands)
+    assert reopened['hash1'].band_distribution == bands['hash1']
+    reopened.close()
+
+
+def test_columns_are_added_to_older_databases(tmp_path):
+    db = tmp_path / "exps.db"
+    codes = CodeHistogram((0.0, 0.5))
+    codes.add(np.arange(-200, 800, dtype=np.int16))
+    store = ExperimentStore(db)
+    exp = Experiment("run.fast5", "run.fast5", {'blake2b': "abc"}, {})
+    exp.histograms[1] = ChannelHistogram.from_codes(codes, 0)
+    store["abc"] = exp
+    store.save()
+    store.close()
+    with sqlite3.connect(db) as conn:
+        # as written before the codes were kept, with the bins
+        conn.execute(
+            "UPDATE channel_histograms SET counts = ?",
+            (exp.histograms[1].counts.astype(np.uint32).tobytes(),)
+        )
+        for column in (
+            'baseline_mad', 'codes', 'code_counts', 'code_offset',
+            'raw_unit'
+        ):
+            conn.execute(
+                f"ALTER TABLE channel_histograms DROP COLUMN {column}"
+            )
+    conn.close()
+
+    store = ExperimentStore(db)
+    hist = store["abc"].histograms[1]
+    assert hist.codes is None and hist.baseline_mad is None
+    assert np.array_equal(hist.counts, exp.histograms[1].counts)
+    # and written again with all columns
+    store["abc"].histograms[1] = exp.histograms[1]
+    store.save()
+    store.close()
+    reopened = ExperimentStore(db)
+    assert np.array_equal(
+        reopened["abc"].histograms[1].codes, exp.histograms[1].codes
+    )
+    reopened.close()
+
+
+def test_bins_of_histograms_with_codes_are_not_stored(tmp_path):
+    db = tmp_path / "exps.db"
+    rng = np.random.default_rng(3)
+    store = ExperimentStore(db)
+    exp = Experiment("run.fast5", "run.fast5", {'blake2b': "abc"}, {})
+    for channel, calibration in ((1, (0.0, 0.5)), (2, (-3.0, 0.3125))):
+        codes = CodeHistogram(calibration)
+        codes.add(rng.integers(-500, 1500, 50_000).astype(np.int16))
+        exp.histograms[channel] = ChannelHistogram.from_codes(codes, 10)
+    legacy = ChannelHistogram(
+        rng.integers(0, 100, 5000).astype(np.uint32), 3, 4, 220.0, 220, 10
+    )
+    exp.histograms[3] = legacy
+    store["abc"] = exp
+    store.save()
+    store.close()
+    with sqlite3.connect(db) as conn:
+        sizes = dict(conn.execute(
+            "SELECT channel, length(counts) FROM channel_histograms"
+        ))
+    conn.close()
+    assert sizes == {1: 0, 2: 0, 3: legacy.counts.nbytes}
+
+    reopened = ExperimentStore(db)
+    for channel, hist in exp.histograms.items():
+        loaded = reopened["abc"].histograms[channel]
+        assert loaded.counts.dtype == np.uint32
+        assert np.array_equal(loaded.counts, hist.counts)
+        assert (loaded.underflow, loaded.overflow) \
+            == (hist.underflow, hist.overflow)
+    reopened.close()
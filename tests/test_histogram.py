@@ -0,0 +1,121 @@
+import numpy as np
+import pytest
+
+from histogram import ChannelHistogram, CodeHistogram
+from raw_io import calibrate
+from synthetic import ADC_DIGITISATION, ADC_OFFSET, ADC_RANGE
+from timeline import window_band_counts
+from utils import _sanitize_event_bands, get_histogram_baseline
+
+CALIBRATIONS = [
+    (ADC_OFFSET, ADC_RANGE / ADC_DIGITISATION),
+    # every band limit is the value of a code
+    (0.0, 0.5),
+]
+
+
+def _codes(rng, calibration, n=100_000):
+    # open pore, blockades, zeroes and outliers on both sides
+    values = np.concatenate([
+        rng.normal(220, 10, n),
+        rng.normal(90, 20, n // 4),
+        rng.normal(0, 4, n // 10),
+        rng.normal(-100, 3, n // 50),
+        rng.normal(350, 3, n // 50),
+    ])
+    rng.shuffle(values)
+    offset, raw_unit = calibration
+    return np.round(values / raw_unit - offset).astype(np.int16)
+
+
+def _float_band_counts(values, low_band, high_band, baseline):
+    # the comparisons of the band counts on calibrated samples
+    def count(mask):
+        return int(np.sum(mask))
+
+    return {
+        'outlier': (
+            count((-100 < values) & (values < -5)),
+            count((baseline + 30 < values) & (values < 350)),
+            count(
+                (values <= -100) | (max(350, baseline + 30) <= values)
+            ),
+        ),
+        'zeroes': count((-5 <= values) & (values <= 5)),
+        'events': count((low_band < values) & (values < high_band)),
+        'baseline': count(
+            (baseline - 30 <= values) & (values <= baseline + 30)
+        ),
+    }
+
+
+def _histogram(codes, calibration):
+    code_hist = CodeHistogram(calibration)
+    code_hist.add(codes)
+    hist = ChannelHistogram.from_codes(code_hist, 0)
+    hist.baseline = get_histogram_baseline(hist, code_hist)
+    return hist
+
+
+@pytest.mark.parametrize('calibration', CALIBRATIONS)
+@pytest.mark.parametrize('scaling, event_low, event_high', [
+    ('both', 0.27, 0.48), ('none', 40, 130), ('lower', 0.5, 200),
+])
+def test_band_counts_match_float_comparisons(
+    calibration, scaling, event_low, event_high
+):
+    codes = _codes(np.random.default_rng(0), calibration)
+    hist = _histogram(codes, calibration)
+    bands = _sanitize_event_bands(
+        scaling, event_low, event_high, hist.baseline
+    )
+    assert hist.band_counts(*bands) == _float_band_counts(
+        calibrate(codes, calibration), *bands, hist.baseline
+    )
+
+
+@pytest.mark.parametrize('calibration', CALIBRATIONS)
+def test_window_band_counts_add_up_to_band_counts(calibration):
+    codes = _codes(np.random.default_rng(1), calibration)
+    hist = _histogram(codes, calibration)
+    bands = _sanitize_event_bands('none', 40, 130, hist.baseline)
+    window = 10_000
+    windows = window_band_counts(
+        np.array_split(codes, 7), hist, window, *bands, calibration
+    )
+    values = calibrate(codes, calibration)
+    for i, row in enumerate(windows):
+        counts = _float_band_counts(
+            values[i * window:(i + 1) * window], *bands, hist.baseline
+        )
+        assert list(row) == [
+            *counts['outlier'], counts['zeroes'], counts['events'],
+            counts['baseline']
+        ]
+
+
+@pytest.mark.parametrize('calibration', CALIBRATIONS)
+@pytest.mark.parametrize('n', [100_000, 100_001])
+def test_code_median_and_mad_match_numpy(calibration, n):
+    codes = _codes(np.random.default_rng(2), calibration, n)
+    code_hist = CodeHistogram(calibration)
+    code_hist.add(codes)
+    values = calibrate(codes, calibration)
+    for lower, upper in ((-1000, 1000), (150, 350), (60, 120)):
+        window = values[(lower < values) & (values < upper)]
+        median = np.median(window)
+        assert code_hist.median(lower, upper) == median
+        assert code_hist.mad(lower, upper) \
+            == np.median(np.abs(window - median))
+
+
+def test_code_median_of_an_even_count_averages_the_middle_values():
+    calibration = (0.0, 0.5)
+    code_hist = CodeHistogram(calibration)
+    # 150 pA lies outside the window, 210 and 250 pA in the middle
+    code_hist.add(np.array([300, 300, 400, 420, 500, 600], dtype=np.int16))
+    assert code_hist.median(150, 350) == 230.0
+    assert code_hist.median(150, 350) == np.median([200, 210, 250, 300])
+    assert code_hist.mad(150, 350) == 25.0
+    assert code_hist.median(350, 400) is None
+    assert code_hist.mad(350, 400) is None
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+from histogram import ChannelHistogram, CodeHistogram
+from kde import binned_kdes, normal_reference_bw
+from synthetic import ADC_DIGITISATION, ADC_OFFSET, ADC_RANGE
+
+CALIBRATION = (ADC_OFFSET, ADC_RANGE / ADC_DIGITISATION)
+
+
+def _channel(rng, n=200_000):
+    # open pore around 220 pA, blockades at 80 pA and a few samples
+    # outside of the histogram range
+    values = np.concatenate([
+        rng.normal(220, 8, n),
+        rng.normal(80, 4, n // 4),
+        rng.normal(-300, 5, n // 100),
+        rng.normal(600, 5, n // 100),
+    ])
+    codes = np.round(values / CALIBRATION[1] - ADC_OFFSET).astype(np.int16)
+    hist = CodeHistogram(CALIBRATION)
+    hist.add(codes)
+    return (codes + ADC_OFFSET) * CALIBRATION[1], \
+        ChannelHistogram.from_codes(hist, 0)
+
+
+def test_binned_kde_matches_statsmodels():
+    kde_module = pytest.importorskip("statsmodels.nonparametric.kde")
+    rng = np.random.default_rng(0)
+    channels = [_channel(rng) for _ in range(2)]
+    support, densities = binned_kdes([hist for _, hist in channels])
+    for (values, hist), density in zip(channels, densities):
+        kde = kde_module.KDEUnivariate(values)
+        kde.fit(bw=normal_reference_bw(hist), fft=True, gridsize=2**16)
+        exact = np.interp(support, kde.support, kde.density)
+        assert np.max(np.abs(exact - density)) < 0.01 * exact.max()
+
+
+def test_density_is_normalised_to_all_samples():
+    # samples outside of the histogram range keep their share, as in a
+    # kde of the whole signal
+    values, hist = _channel(np.random.default_rng(1))
+    support, densities = binned_kdes([hist])
+    inside = np.mean((values >= support[0]) & (values < support[-1]))
+    area = densities[0].sum() * hist.resolution
+    assert area == pytest.approx(inside, abs=1e-3)
+    assert area < 1
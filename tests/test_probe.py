@@ -0,0 +1,60 @@
+import h5py
+import numpy as np
+from fast5_research.fast5_bulk import BulkFast5
+
+from probe import probe_channel
+from synthetic import (
+    ADC_DIGITISATION, ADC_OFFSET, ADC_RANGE, synthetic_channel,
+    write_bulk_file
+)
+from utils import get_channel_histograms
+
+BURNIN = 50_000
+LENGTH = 450_000
+MARGIN = 5.0
+# dead throughout, with an open pore for the given part of the signal
+# after the burnin, fully active
+DEAD = [1, 2, 3, 4]
+PARTLY_ACTIVE = {5: (0.75, 1.0), 6: (0.0, 0.2), 7: (0.45, 0.6)}
+SATURATED = [8]
+
+
+def _open_pore(fpath, channel, start, end):
+    rng = np.random.default_rng(channel)
+    first = BURNIN + int(start * (LENGTH - BURNIN))
+    last = BURNIN + int(end * (LENGTH - BURNIN))
+    current = synthetic_channel(rng, last - first, 210.0)
+    codes = np.round(current * ADC_DIGITISATION / ADC_RANGE - ADC_OFFSET)
+    with h5py.File(fpath, 'r+') as fh:
+        fh[f'Raw/Channel_{channel}/Signal'][first:last] = codes
+
+
+def test_probe_agrees_with_full_scan(tmp_path):
+    fpath = str(tmp_path / "probe.fast5")
+    write_bulk_file(
+        fpath, channels=10, length=LENGTH, seed=2,
+        dead_channels=DEAD + list(PARTLY_ACTIVE),
+        saturated_channels=SATURATED
+    )
+    for channel, (start, end) in PARTLY_ACTIVE.items():
+        _open_pore(fpath, channel, start, end)
+
+    with BulkFast5(fpath) as fh:
+        states = {
+            c: probe_channel(fh, c, BURNIN, MARGIN).state
+            for c in range(1, 11)
+        }
+    full = get_channel_histograms(fpath, BURNIN)
+    probed = get_channel_histograms(fpath, BURNIN, probe_margin=MARGIN)
+
+    assert set(full) == set(range(1, 11)) - set(DEAD) - set(SATURATED)
+    # dead only if inactive, active only if active
+    assert all(c not in full for c, s in states.items() if s == 'dead')
+    assert all(c in full for c, s in states.items() if s == 'active')
+    # the probe saves reads, but only where the mean is bound near 0 pA
+    assert all(states[c] == 'dead' for c in DEAD)
+    assert all(states[c] == 'uncertain' for c in SATURATED)
+    assert list(probed) == list(full)
+    for c, hist in full.items():
+        assert np.array_equal(probed[c].counts, hist.counts)
+        assert probed[c].baseline == hist.baseline
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+from fast5_research.fast5_bulk import BulkFast5
+
+from raw_io import configure_cache, get_raw_cache
+from synthetic import write_bulk_file
+from zone_map import (
+    COARSE_BINS, COARSE_EDGES, ZoneMapStore, build_zone_map
+)
+
+
+@pytest.fixture
+def bulk_file(tmp_path):
+    fpath = str(tmp_path / "zones.fast5")
+    write_bulk_file(fpath, channels=3, length=300_001, dead_channels=[2])
+    return fpath
+
+
+def test_histograms_and_stats_match_the_samples(bulk_file):
+    zone_map = build_zone_map(bulk_file, "abc")
+    with BulkFast5(bulk_file) as fh:
+        values = fh.get_raw(1)
+    for start in (0, zone_map.hist_size, 5 * zone_map.hist_size):
+        tail = values[start:]
+        assert np.array_equal(
+            zone_map.histogram(1, start), np.bincount(
+                np.searchsorted(COARSE_EDGES, tail, side='right'),
+                minlength=COARSE_BINS
+            )
+        )
+        stats = zone_map.range_stats(1, start)
+        assert stats['samples'] == len(tail)
+        assert stats['mean'] == pytest.approx(tail.mean())
+        assert stats['std'] == pytest.approx(tail.std(), rel=1e-6)
+    assert zone_map.activity(1, 1000) == 'active'
+    assert zone_map.activity(2, 1000) == 'dead'
+
+
+def test_building_bypasses_the_raw_cache(bulk_file, tmp_path):
+    configure_cache(2**30, tmp_path / "raw_cache")
+    try:
+        build_zone_map(bulk_file, "abc")
+        cache = get_raw_cache()
+        assert (cache.hits, cache.misses) == (0, 0)
+        assert not list((tmp_path / "raw_cache").glob("*"))
+    finally:
+        configure_cache(0)
+
+
+def test_only_maps_within_the_budget_stay_loaded(bulk_file, tmp_path):
+    zone_map = build_zone_map(bulk_file, "abc")
+    for max_bytes, kept in ((zone_map.nbytes, True), (0, False)):
+        store = ZoneMapStore(tmp_path / str(max_bytes), max_bytes)
+        store.put(zone_map)
+        assert (store.get("abc") is store.get("abc")) == kept
+        assert store.get("abc").channels.keys() == zone_map.channels.keys()
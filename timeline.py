@@ -0,0 +1,176 @@
+from typing import Dict, Iterable, List, Literal, Optional, Tuple, Union
+
+import numpy as np
+from fast5_research.fast5_bulk import BulkFast5
+
+from band_table import COUNT_COLUMNS, count_densities
+from histogram import (
+    ChannelHistogram, band_masks, bin_indices, code_values
+)
+from instrumentation import span
+from raw_io import Calibration, get_calibration, iter_raw_chunks
+from utils import (
+    ProgressCallback, _sanitize_event_bands, _update_channel_progress,
+    determine_scaling
+)
+
+# (burnin, window [s], scaling, event_low, event_high) of a timeline
+TimelineKey = Tuple[int, float, str, Union[float, int], Union[float, int]]
+
+
+class DensityTimeline:
+    # Band counts of consecutive time windows after the burnin, per active
+    # channel (n_channels, n_windows, COUNT_COLUMNS). The windows of a
+    # channel add up to the band counts of its histogram. Shorter channels
+    # are padded with empty windows, their densities are NaN.
+
+    def __init__(
+        self, channels: np.ndarray, counts: np.ndarray, window: int,
+        start: int, sample_rate: float
+    ) -> None:
+        self.channels = np.asarray(channels, dtype=np.int16)
+        self.counts = np.asarray(counts, dtype=np.uint32).reshape(
+            len(self.channels), -1, len(COUNT_COLUMNS)
+        )
+        self.window: int = window
+        self.start: int = start
+        self.sample_rate: float = sample_rate
+
+    @property
+    def n_windows(self) -> int:
+        return self.counts.shape[1]
+
+    def times(self) -> np.ndarray:
+        # window centers in seconds since the start of the recording
+        centers = self.start + (np.arange(self.n_windows) + 0.5) * self.window
+        return centers / self.sample_rate
+
+    def densities(
+        self, key: Literal['outlier', 'zeroes', 'events', 'baseline'] =
+        'events', channel: Optional[int] = None
+    ) -> np.ndarray:
+        # (n_channels, n_windows), one row for a given channel
+        counts = self.counts.astype(np.int64)
+        if channel is not None:
+            counts = counts[self.channels == channel][0]
+        return count_densities(counts, key)
+
+    def mean_densities(
+        self, key: Literal['outlier', 'zeroes', 'events', 'baseline'] =
+        'events'
+    ) -> np.ndarray:
+        # averaged over the channels recorded in each window
+        densities = self.densities(key)
+        valid = ~np.isnan(densities)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(valid, densities, 0).sum(axis=0) \
+                / valid.sum(axis=0)
+
+
+def window_band_counts(
+    chunks: Iterable[np.ndarray], hist: ChannelHistogram, window: int,
+    low_band: float, high_band: float, calibration: Calibration
+) -> np.ndarray:
+    # Band counts per window of window samples in one pass over chunks of
+    # ADC codes, counted like the histogram. Every code is mapped to a
+    # segment of codes with the same band memberships, one bincount per
+    # chunk counts all segments of all windows; the band counts are sums
+    # of segments.
+    segment_of, segments = _code_segments(
+        hist, low_band, high_band, calibration
+    )
+    n_segments = len(segments)
+    seg_counts = np.zeros((0, n_segments), dtype=np.int64)
+    pos = 0
+    for chunk in chunks:
+        chunk_segments = segment_of[chunk]
+        windows = (pos + np.arange(len(chunk))) // window
+        first = pos // window
+        counts = np.bincount(
+            (windows - first) * n_segments + chunk_segments
+        )
+        counts = np.pad(counts, (0, -len(counts) % n_segments)).reshape(
+            -1, n_segments
+        )
+        if (missing := first + len(counts) - len(seg_counts)) > 0:
+            seg_counts = np.pad(seg_counts, ((0, missing), (0, 0)))
+        seg_counts[first:first + len(counts)] += counts
+        pos += len(chunk)
+    return seg_counts @ segments
+
+
+def _code_segments(
+    hist: ChannelHistogram, low_band: float, high_band: float,
+    calibration: Calibration
+) -> Tuple[np.ndarray, np.ndarray]:
+    # segment of every code, indexed like code_values, and the band counts
+    # a sample of each segment adds to
+    if hist.codes is not None:
+        # exact, the comparisons of the histogram's band counts
+        segments, segment_of = np.unique(
+            band_masks(
+                code_values(calibration), low_band, high_band, hist.baseline
+            ), axis=0, return_inverse=True
+        )
+        return segment_of.reshape(-1), segments.astype(np.int64)
+    # binned like histograms recorded without their codes: segments lie
+    # between consecutive band limits
+    n_bins = len(hist.counts)
+    t = hist.bin_index
+    bl = hist.baseline
+    # (count column, first bin, end bin), -1 and n_bins hold under-/overflow
+    ranges = [
+        (0, t(-100), t(-5)),
+        (1, t(bl + 30), t(350)),
+        (2, -1, t(-100)),
+        (2, t(max(350, bl + 30)), n_bins + 1),
+        (3, t(-5), t(5)),
+        (4, t(low_band), t(high_band)),
+        (5, t(bl - 30), t(bl + 30)),
+    ]
+    edges = np.unique([limit for _, a, b in ranges for limit in (a, b)])
+    segments = np.zeros((len(edges) + 1, len(COUNT_COLUMNS)), dtype=np.int64)
+    for column, a, b in ranges:
+        if a < b:
+            first, last = np.searchsorted(edges, (a, b))
+            segments[first + 1:last + 1, column] += 1
+    segment_of = np.searchsorted(edges, bin_indices(
+        code_values(calibration), hist.low, hist.resolution, n_bins
+    ), side='right')
+    return segment_of, segments
+
+
+def get_density_timeline(
+    fname: str, histograms: Dict[int, ChannelHistogram],
+    event_low: Union[float, int], event_high: Union[float, int],
+    window_seconds: float, progress: Optional[ProgressCallback] = None
+) -> DensityTimeline:
+    # one chunked read of every active channel, the bands are those of the
+    # channel histograms
+    scaling = determine_scaling(event_low, event_high)
+    channels: List[int] = sorted(histograms)
+    rows = []
+    with span("timeline", channels=len(channels)) as timeline_span, \
+            BulkFast5(fname) as fh:
+        sample_rate = fh.sample_rate
+        window = max(1, int(round(window_seconds * sample_rate)))
+        burnin = 0
+        for i, channel in enumerate(channels, start=1):
+            _update_channel_progress(progress, i, len(channels))
+            hist = histograms[channel]
+            burnin = hist.burnin
+            rows.append(window_band_counts(
+                iter_raw_chunks(
+                    fh, channel, start=hist.burnin, use_scaling=False
+                ), hist, window, *_sanitize_event_bands(
+                    scaling, event_low, event_high, hist.baseline
+                ), get_calibration(fh, channel)
+            ))
+            timeline_span.add(bytes_read=2 * len(hist))
+    n_windows = max((len(row) for row in rows), default=0)
+    counts = np.zeros(
+        (len(channels), n_windows, len(COUNT_COLUMNS)), dtype=np.uint32
+    )
+    for i, row in enumerate(rows):
+        counts[i, :len(row)] = row
+    return DensityTimeline(channels, counts, window, burnin, sample_rate)
@@ -1,134 +1,442 @@
+from dataclasses import dataclass, fields
+import multiprocessing
+from queue import Empty
 import numpy as np
 import re
-import dearpygui.dearpygui as dpg
+import time
 from fast5_research.fast5_bulk import BulkFast5
 
-from typing import Any, Dict, Literal, Optional, Tuple, Union
+from typing import (
+    Any, Callable, Dict, Iterator, List, Literal, Optional, Set, Tuple,
+    Union
+)
 
+from histogram import ChannelHistogram, CodeHistogram
+from instrumentation import span
+from probe import probe_channel
+from raw_io import (
+    cache_settings, configure_cache, get_calibration, iter_raw_chunks,
+    raw_length
+)
 
-# TODO/HACK introduce seperate progress bar variable
-#          and simplify handling thereof
-def _is_active_channel(fname: str, channel: int, burnin: int) -> bool:
-    try:
-        with BulkFast5(fname) as fh:
-            raw_data = fh.get_raw(channel)[burnin:]
-    except Exception as e:
-        print(e)
-        return False
 
-    return (
-        np.abs(np.mean(raw_data)) > 1
-        and len(raw_data[np.logical_and(raw_data > 150, raw_data < 350)]) > 0
-    )
+# progress(fraction done, message), e.g. forwarded to a progress bar
+ProgressCallback = Callable[[float, str], None]
 
 
-def _update_channel_progress(channel: int) -> bool:
-    dpg.set_value("Progress Bar", (channel-1)/126)
-    dpg.configure_item(
-        "Progress Bar", overlay=f"Checking channel {channel}/126", width=175
-    )
-    return True
+def _update_channel_progress(
+    progress: Optional[ProgressCallback], channel: int, total: int = 126
+) -> None:
+    if progress is not None:
+        progress((channel-1)/total, f"Checking channel {channel}/{total}")
+
+
+@dataclass
+class ScanStats:
+    # bookkeeping of a channel scan compared to the former two-read path,
+    # which decoded every active channel a second time for its bands
+    channels: int = 0
+    active: int = 0
+    # dead channels spared a full read by the probe or a zone map
+    skipped: int = 0
+    bytes_read: int = 0
+    bytes_saved: int = 0
+    read_time: float = 0.0
+    count_time: float = 0.0
+    time_saved: float = 0.0
+    # elapsed time of the whole scan, read and count times add up
+    # over all workers
+    wall_time: float = 0.0
+
+    @property
+    def throughput(self) -> float:
+        # samples (int16 ADC codes) per second of elapsed time
+        return self.bytes_read / 2 / self.wall_time if self.wall_time else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"Scanned {self.channels} channels ({self.active} active, "
+            f"{self.skipped} skipped as dead), "
+            f"read {self.bytes_read/2**20:.1f} MiB in {self.read_time:.2f}s, "
+            f"counted in {self.count_time:.2f}s; "
+            f"saved {self.bytes_saved/2**20:.1f} MiB "
+            f"and ~{self.time_saved:.2f}s of re-reading; "
+            f"{self.throughput/1e6:.1f} M samples/s"
+        )
+
+    def add(self, other: 'ScanStats') -> None:
+        for field in fields(self):
+            setattr(
+                self, field.name,
+                getattr(self, field.name) + getattr(other, field.name)
+            )
 
 
-def get_channel_details(
+def get_channel_histograms(
     fname: str, burnin: int,
-    event_low: Union[float, int], event_high: Union[float, int]
-) -> Dict[int, Dict[str, float]]:
-    dpg.configure_item("Progress Bar", show=True)
+    stats: Optional[ScanStats] = None, workers: int = 1,
+    progress: Optional[ProgressCallback] = None, probe_margin: float = 0.0
+) -> Dict[int, ChannelHistogram]:
+    return scan_files(
+        [fname], burnin, stats, workers, progress, probe_margin=probe_margin
+    )[fname]
+
 
+def get_band_distributions(
+    histograms: Dict[int, ChannelHistogram],
+    event_low: Union[float, int], event_high: Union[float, int]
+) -> Dict[int, Dict[str, Any]]:
     scaling = determine_scaling(event_low, event_high)
-    result = {
-        c: band_details for c in range(1, 127)
-        if _update_channel_progress(c) and
-        _is_active_channel(fname, c, burnin) and
-        (
-            band_details := _get_band_distribution(
-                fname, c, burnin, scaling, event_low, event_high
-            )
-        ) is not None
+    return {
+        c: _band_distribution_from_histogram(
+            hist, scaling, event_low, event_high
+        )
+        for c, hist in histograms.items()
     }
 
-    dpg.configure_item("Progress Bar", show=False)
-    return result
 
+# (file, channel, histogram or None) of a finished scan task
+ResultCallback = Callable[[str, int, Optional[ChannelHistogram]], None]
 
-def determine_scaling(
-    event_low: Union[float, int], event_high: Union[float, int]
-) -> Literal['none', 'both', 'lower', 'upper']:
-    if isinstance(event_low, int):
-        if isinstance(event_high, int):
-            return 'none'
+
+def scan_files(
+    fnames: List[str], burnin: int,
+    stats: Optional[ScanStats] = None, workers: int = 1,
+    progress: Optional[ProgressCallback] = None,
+    on_result: Optional[ResultCallback] = None, probe_margin: float = 0.0,
+    dead: Optional[Dict[str, Set[int]]] = None
+) -> Dict[str, Dict[int, ChannelHistogram]]:
+    # Every (file, channel) pair is a task of one shared queue, longest
+    # channels first. Idle workers pull the next task, so files of very
+    # different lengths do not leave workers waiting behind the longest.
+    # With a positive probe_margin, channels are probed first and clearly
+    # dead ones are not read in full (see probe.probe_channel). Channels
+    # of dead, e.g. from a zone map, are reported inactive without a read.
+    if stats is None:
+        stats = ScanStats()
+    dead = dead or {}
+    with span("schedule", files=len(fnames)):
+        tasks = _schedule_scan_tasks(fnames, burnin)
+    start = time.perf_counter()
+    result = {fname: {} for fname in fnames}
+    known_dead = [
+        (fname, c) for fname, c in tasks if c in dead.get(fname, ())
+    ]
+    tasks = [
+        (fname, c) for fname, c in tasks if c not in dead.get(fname, ())
+    ]
+    stats.channels += len(known_dead)
+    stats.skipped += len(known_dead)
+    if on_result is not None:
+        for fname, channel in known_dead:
+            on_result(fname, channel, None)
+
+    def _collect(done, fname, channel, hist, channel_stats):
+        _update_channel_progress(progress, done, len(tasks))
+        stats.add(channel_stats)
+        if hist is not None:
+            result[fname][channel] = hist
+        if on_result is not None:
+            on_result(fname, channel, hist)
+
+    with span("scan", files=len(fnames), workers=workers) as scan_span:
+        if workers > 1:
+            _scan_tasks_parallel(
+                tasks, burnin, workers, _collect, progress, probe_margin
+            )
         else:
-            return 'upper'
-    elif isinstance(event_high, int):
-        return 'lower'
-    else:
-        return 'both'
-    assert False
+            handles = _HandleCache()
+            try:
+                for done, (fname, channel) in enumerate(tasks, start=1):
+                    channel_stats = ScanStats()
+                    hist = _scan_task(
+                        handles, fname, channel, burnin, channel_stats,
+                        probe_margin
+                    )
+                    _collect(done, fname, channel, hist, channel_stats)
+            finally:
+                handles.close()
+        stats.wall_time += time.perf_counter() - start
+        # read_time is mostly hdf5 decompression, count_time numpy
+        scan_span.add(
+            channels=stats.channels, active=stats.active,
+            skipped=stats.skipped,
+            bytes_read=stats.bytes_read, read_time=stats.read_time,
+            count_time=stats.count_time, throughput=stats.throughput,
+            bytes_saved=stats.bytes_saved, time_saved=stats.time_saved
+        )
+
+    # merge in channel order, independent of which worker finished first
+    return {
+        fname: {c: hists[c] for c in sorted(hists)}
+        for fname, hists in result.items()
+    }
+
+
+def _schedule_scan_tasks(
+    fnames: List[str], burnin: int
+) -> List[Tuple[str, int]]:
+    # longest processing time first, ties keep a file's channels together
+    lengths = {}
+    for fname in fnames:
+        try:
+            with BulkFast5(fname) as fh:
+                for c in range(1, 127):
+                    lengths[(fname, c)] = raw_length(fh, c) \
+                        if fh.has_raw(c) else 0
+        except OSError as e:
+            print(e)
+            # still scheduled, reported back as inactive
+            lengths.update({(fname, c): 0 for c in range(1, 127)})
+    return sorted(
+        lengths,
+        key=lambda task: (-max(0, lengths[task] - burnin), task[0], task[1])
+    )
 
 
-def get_baseline(raw_data):
-    baseline = None
+def _scan_tasks_parallel(
+    tasks: List[Tuple[str, int]], burnin: int, workers: int,
+    collect: Callable[..., None], progress: Optional[ProgressCallback],
+    probe_margin: float = 0.0
+) -> None:
+    workers = min(workers, len(tasks))
+    # spawn instead of fork, the gui process must not be duplicated
+    mp_context = multiprocessing.get_context('spawn')
+    task_queue = mp_context.Queue()
+    result_queue = mp_context.Queue()
+    for task in tasks:
+        task_queue.put(task)
+    for _ in range(workers):
+        task_queue.put(None)
+    procs = [
+        mp_context.Process(
+            target=_scan_worker,
+            args=(
+                task_queue, result_queue, burnin, cache_settings(),
+                probe_margin
+            ),
+            daemon=True
+        )
+        for _ in range(workers)
+    ]
+    for proc in procs:
+        proc.start()
 
+    done = 0
     try:
-        if np.abs(np.mean(raw_data)) > 1:
-            baseline = int(np.median(
-                raw_data[np.logical_and(raw_data > 150, raw_data < 350)]
-            ))
+        while done < len(tasks):
+            try:
+                fname, channel, hist, channel_stats = result_queue.get(
+                    timeout=0.5
+                )
+            except Empty:
+                if not any(proc.is_alive() for proc in procs):
+                    raise RuntimeError(
+                        f"Scan workers died, {len(tasks)-done} channels left"
+                    )
+                # keeps cancellation responsive while workers read
+                _update_channel_progress(progress, done + 1, len(tasks))
+                continue
+            done += 1
+            collect(done, fname, channel, hist, channel_stats)
     finally:
-        return baseline
+        # workers are stopped early if collecting raised (cancellation)
+        # or the workers died
+        for proc in procs:
+            if done < len(tasks):
+                proc.terminate()
+            proc.join()
 
 
-def _get_band_distribution(
-    fname: str, channel: int, burnin: int,
-    scaling: Literal['both', 'none', 'lower', 'upper'] = 'both',
-    event_low: float = 0.27, event_high: float = 0.48
-) -> Optional[Dict[int, Dict[str, Any]]]:
+def _scan_worker(
+    task_queue: multiprocessing.Queue, result_queue: multiprocessing.Queue,
+    burnin: int, raw_cache: Tuple[int, Optional[str]] = (0, None),
+    probe_margin: float = 0.0
+) -> None:
+    # runs in a worker process with file handles of its own, every task
+    # is reported back to keep the progress count exact
+    configure_cache(*raw_cache)
+    handles = _HandleCache()
     try:
-        with BulkFast5(fname) as fh:
-            raw_data = fh.get_raw(channel)[burnin:]
+        while (task := task_queue.get()) is not None:
+            fname, channel = task
+            channel_stats = ScanStats()
+            hist = _scan_task(
+                handles, fname, channel, burnin, channel_stats, probe_margin
+            )
+            result_queue.put((fname, channel, hist, channel_stats))
+    finally:
+        handles.close()
+
+
+class _HandleCache:
+    # open bulk files of a worker, the least recently used is closed
+    # once more than max_open files are in use
+
+    def __init__(self, max_open: int = 4) -> None:
+        self.max_open = max_open
+        self._handles: Dict[str, BulkFast5] = {}
+
+    def get(self, fname: str) -> BulkFast5:
+        if (fh := self._handles.pop(fname, None)) is None:
+            fh = BulkFast5(fname)
+            if len(self._handles) >= self.max_open:
+                oldest = next(iter(self._handles))
+                self._handles.pop(oldest).close()
+        self._handles[fname] = fh
+        return fh
+
+    def close(self) -> None:
+        for fh in self._handles.values():
+            fh.close()
+        self._handles = {}
+
+
+def _scan_task(
+    handles: _HandleCache, fname: str, channel: int, burnin: int,
+    stats: ScanStats, probe_margin: float = 0.0
+) -> Optional[ChannelHistogram]:
+    try:
+        fh = handles.get(fname)
+    except OSError as e:
+        print(e)
+        stats.channels += 1
+        return None
+    return _scan_channel(fh, channel, burnin, stats, probe_margin)
+
+
+def _scan_channel(
+    fh: BulkFast5, channel: int, burnin: int, stats: ScanStats,
+    probe_margin: float = 0.0
+) -> Optional[ChannelHistogram]:
+    # single chunked read per channel: activity check, baseline and the
+    # histogram for all band counts are accumulated in the same pass
+    stats.channels += 1
+    start = time.perf_counter()
+    read_time = stats.read_time
+    bytes_read = stats.bytes_read
+    try:
+        if probe_margin > 0:
+            probe = probe_channel(fh, channel, burnin, probe_margin)
+            stats.bytes_read += 2 * probe.samples
+            stats.read_time += time.perf_counter() - start
+            if probe.state == 'dead':
+                stats.skipped += 1
+                stats.bytes_saved += \
+                    raw_length(fh, channel) * 8 - 2 * probe.samples
+                return None
+        hist, codes = ChannelHistogram.from_adc_chunks(
+            _timed_chunks(iter_raw_chunks(
+                fh, channel, start=burnin, use_scaling=False
+            ), stats),
+            burnin, get_calibration(fh, channel)
+        )
+        # the former path decoded the burnin and the whole channel twice
+        full_bytes = raw_length(fh, channel) * 8
     except Exception as e:
         print(e)
         return None
+    read_time = stats.read_time - read_time
+    bytes_read = stats.bytes_read - bytes_read
+    stats.count_time += time.perf_counter() - start - read_time
 
-    if (baseline_val := get_baseline(raw_data)) is None:
+    # the baseline range doubles as activity criterion
+    if set_histogram_baseline(hist, codes) is None:
+        stats.bytes_saved += full_bytes - bytes_read
         return None
+    stats.active += 1
+    stats.bytes_saved += 2*full_bytes - bytes_read
+    stats.time_saved += read_time
+    return hist
+
+
+def _timed_chunks(
+    chunks: Iterator[np.ndarray], stats: ScanStats
+) -> Iterator[np.ndarray]:
+    while True:
+        start = time.perf_counter()
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            return
+        stats.read_time += time.perf_counter() - start
+        stats.bytes_read += chunk.nbytes
+        yield chunk
+
+
+def get_channel_histogram(
+    fname: str, channel: int, burnin: int
+) -> Optional[ChannelHistogram]:
+    # any channel, active or not, e.g. for density plots
+    try:
+        with span("channel_histogram", channel=channel) as hist_span, \
+                BulkFast5(fname) as fh:
+            hist, codes = ChannelHistogram.from_adc_chunks(
+                iter_raw_chunks(
+                    fh, channel, start=burnin, use_scaling=False
+                ), burnin, get_calibration(fh, channel)
+            )
+            hist_span.add(bytes_read=2 * len(hist))
+    except Exception as e:
+        print(e)
+        return None
+    set_histogram_baseline(hist, codes)
+    return hist
+
+
+def _band_distribution_from_histogram(
+    hist: ChannelHistogram,
+    scaling: Literal['both', 'none', 'lower', 'upper'],
+    event_low: Union[float, int], event_high: Union[float, int]
+) -> Dict[str, Dict[Tuple[float, float], Any]]:
     low_band, high_band = _sanitize_event_bands(
-        scaling, event_low, event_high, baseline_val
-        )
-    low_outs = np.sum(np.logical_and(-100 < raw_data, raw_data < -5))
-    zeroes = np.sum(np.logical_and(-5 <= raw_data, raw_data <= 5))
-    events = np.sum(np.logical_and(
-        low_band < raw_data,
-        raw_data < high_band
-    ))
-    baselines = np.sum(np.logical_and(
-        baseline_val - 30 <= raw_data,
-        raw_data <= baseline_val + 30
-    ))
-    high_outs = np.sum(np.logical_and(
-        baseline_val + 30 < raw_data,
-        raw_data < 350
-    ))
-    heavy_outs = np.sum(np.logical_or(
-        raw_data <= -100,
-        max(350, baseline_val + 30) <= raw_data
-    ))
+        scaling, event_low, event_high, hist.baseline
+    )
     return {
         scaling: {
             (event_low, event_high): (
-                baseline_val,
-                {
-                    'outlier': (low_outs, high_outs, heavy_outs),
-                    'zeroes': zeroes,
-                    'events': events,
-                    'baseline': baselines,
-                }
+                hist.baseline, hist.band_counts(low_band, high_band)
             )
         }
     }
 
 
+def determine_scaling(
+    event_low: Union[float, int], event_high: Union[float, int]
+) -> Literal['none', 'both', 'lower', 'upper']:
+    if isinstance(event_low, int):
+        if isinstance(event_high, int):
+            return 'none'
+        else:
+            return 'upper'
+    elif isinstance(event_high, int):
+        return 'lower'
+    else:
+        return 'both'
+    assert False
+
+
+def get_histogram_baseline(
+    hist: ChannelHistogram, codes: CodeHistogram
+) -> Optional[int]:
+    # exact median of the samples within (150, 350) pA of channels with a
+    # mean current
+    if np.abs(hist.mean) <= 1:
+        return None
+    median = codes.median(150, 350)
+    return None if median is None else int(median)
+
+
+def set_histogram_baseline(
+    hist: ChannelHistogram, codes: CodeHistogram
+) -> Optional[int]:
+    # baseline and its median absolute deviation, None if inactive
+    hist.baseline = get_histogram_baseline(hist, codes)
+    if hist.baseline is not None:
+        hist.baseline_mad = codes.mad(150, 350)
+    return hist.baseline
+
+
 def _sanitize_event_bands(
     scaling: Literal['both', 'none', 'lower', 'upper'],
     event_low: float, event_high: float, baseline_val: int
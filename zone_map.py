@@ -0,0 +1,409 @@
+from dataclasses import dataclass
+import os
+from pathlib import Path
+import threading
+import time
+from typing import (
+    Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+)
+from uuid import uuid4
+
+import numpy as np
+from fast5_research.fast5_bulk import BulkFast5
+
+from histogram import HIST_RANGE, code_values
+from instrumentation import span
+from probe import ProbeState
+from raw_io import (
+    DEFAULT_CHUNK_SIZE, Calibration, get_calibration, iter_raw_chunks,
+    raw_length
+)
+
+DEFAULT_BLOCK_SIZE = 4096
+# blocks per coarse histogram, whose uint16 counts cover all its samples
+HIST_BLOCKS = 8
+# coarse histogram [pA], counts below and above go to the outer columns
+COARSE_EDGES = np.arange(HIST_RANGE[0], HIST_RANGE[1] + 10, 10.0)
+COARSE_BINS = len(COARSE_EDGES) + 1
+
+
+@dataclass
+class ChannelZones:
+    # per block of a channel: minimum and maximum ADC code, sum and sum of
+    # squares of the codes; per hist_blocks blocks the coarse histogram
+    # (n_hists, COARSE_BINS)
+    length: int
+    calibration: Calibration
+    minima: np.ndarray
+    maxima: np.ndarray
+    sums: np.ndarray
+    squares: np.ndarray
+    counts: np.ndarray
+
+
+class ZoneMap:
+    # Summary of every block of block_size samples of every channel of a
+    # bulk file, built in one pass over the ADC codes. Statistics of a
+    # range, activity and min/max decimation are answered at block
+    # resolution without reading the raw data again, coarse histograms
+    # at the resolution of hist_blocks blocks.
+
+    def __init__(
+        self, file_hash: str, block_size: int,
+        channels: Dict[int, ChannelZones], hist_blocks: int = HIST_BLOCKS
+    ) -> None:
+        self.file_hash: str = file_hash
+        self.block_size: int = block_size
+        self.hist_blocks: int = hist_blocks
+        self.channels: Dict[int, ChannelZones] = channels
+
+    def __contains__(self, channel: int) -> bool:
+        return channel in self.channels
+
+    @property
+    def nbytes(self) -> int:
+        return sum(
+            zones.minima.nbytes + zones.maxima.nbytes + zones.sums.nbytes
+            + zones.squares.nbytes + zones.counts.nbytes
+            for zones in self.channels.values()
+        )
+
+    @property
+    def hist_size(self) -> int:
+        # samples per coarse histogram
+        return self.block_size * self.hist_blocks
+
+    def _blocks(
+        self, channel: int, start: int = 0, stop: Optional[int] = None,
+        size: Optional[int] = None
+    ) -> Tuple[ChannelZones, slice, int]:
+        # blocks of size samples (block_size by default) starting within
+        # [start, stop) and their number of samples
+        size = self.block_size if size is None else size
+        zones = self.channels[channel]
+        stop = zones.length if stop is None else min(stop, zones.length)
+        first = -(-max(0, start) // size)
+        last = max(first, -(-stop // size))
+        samples = max(0, min(last * size, zones.length) - first * size)
+        return zones, slice(first, last), samples
+
+    def range_stats(
+        self, channel: int, start: int = 0, stop: Optional[int] = None
+    ) -> Dict[str, float]:
+        # samples, mean, std, min and max [pA] of the blocks in the range
+        zones, blocks, samples = self._blocks(channel, start, stop)
+        if samples == 0:
+            return {'samples': 0, 'mean': np.nan, 'std': np.nan,
+                    'min': np.nan, 'max': np.nan}
+        offset, raw_unit = zones.calibration
+        mean = zones.sums[blocks].sum(dtype=np.int64) / samples
+        var = max(0.0, zones.squares[blocks].sum() / samples - mean**2)
+        return {
+            'samples': samples,
+            'mean': (mean + offset) * raw_unit,
+            'std': np.sqrt(var) * raw_unit,
+            'min': (zones.minima[blocks].min() + offset) * raw_unit,
+            'max': (zones.maxima[blocks].max() + offset) * raw_unit,
+        }
+
+    def histogram(
+        self, channel: int, start: int = 0, stop: Optional[int] = None
+    ) -> np.ndarray:
+        # coarse counts of the histograms starting within the range, see
+        # COARSE_EDGES
+        zones, hists, _ = self._blocks(channel, start, stop, self.hist_size)
+        return zones.counts[hists].sum(axis=0, dtype=np.int64)
+
+    def activity(self, channel: int, burnin: int) -> ProbeState:
+        # The activity criterion of the scan, |mean| > 1 pA and samples
+        # within (150, 350) pA after the burnin, from the blocks after the
+        # burnin. The mean is off by at most tolerance for the block cut
+        # by the burnin. The counts of the histogram cut by the burnin and
+        # the outer coarse bins of the range count towards dead, not
+        # towards active.
+        zones = self.channels.get(channel)
+        if zones is None or zones.length <= burnin:
+            return 'dead'
+        stats = self.range_stats(channel, burnin)
+        if stats['samples'] == 0:
+            return 'uncertain'
+        counts = self.histogram(channel, burnin)
+        near = counts.copy()
+        tolerance = 0.0
+        if stats['samples'] < zones.length - burnin:
+            cut = burnin // self.block_size
+            offset, raw_unit = zones.calibration
+            extreme = raw_unit * max(
+                abs(zones.minima[cut] + offset),
+                abs(zones.maxima[cut] + offset)
+            )
+            tolerance = (zones.length - burnin - stats['samples']) \
+                * (extreme + abs(stats['mean'])) / (zones.length - burnin)
+        if burnin % self.hist_size:
+            near += zones.counts[burnin // self.hist_size]
+        mean = abs(stats['mean'])
+        # bins [140, 360) and [160, 340) pA, see COARSE_EDGES
+        low, high = np.searchsorted(COARSE_EDGES, (150, 350), side='right')
+        if mean + tolerance <= 1 or not near[low - 1:high + 1].any():
+            return 'dead'
+        if mean - tolerance > 1 and counts[low + 1:high - 1].any():
+            return 'active'
+        return 'uncertain'
+
+    def dead_channels(self, burnin: int) -> Set[int]:
+        return {
+            c for c in range(1, 127) if self.activity(c, burnin) == 'dead'
+        }
+
+    def min_max(
+        self, channel: int, start: int, stop: int, bucket: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # calibrated minima and maxima of the buckets of [start, stop),
+        # start and bucket are multiples of the block size
+        zones, blocks, _ = self._blocks(channel, start, stop)
+        starts = np.arange(
+            0, blocks.stop - blocks.start, bucket // self.block_size
+        )
+        if len(starts) == 0:
+            return np.empty(0, np.float32), np.empty(0, np.float32)
+        offset, raw_unit = zones.calibration
+        mins = np.minimum.reduceat(zones.minima[blocks], starts)
+        maxs = np.maximum.reduceat(zones.maxima[blocks], starts)
+        return (
+            ((mins + offset) * raw_unit).astype(np.float32),
+            ((maxs + offset) * raw_unit).astype(np.float32)
+        )
+
+    def save(self, path: Path) -> None:
+        channels = sorted(self.channels)
+        zones = [self.channels[c] for c in channels]
+        tmp_path = path.with_suffix(f".{os.getpid()}.{uuid4().hex}.tmp")
+        with open(tmp_path, 'wb') as fh:
+            np.savez_compressed(
+                fh, file_hash=self.file_hash, block_size=self.block_size,
+                hist_blocks=self.hist_blocks,
+                channels=np.array(channels, dtype=np.int16),
+                lengths=np.array([z.length for z in zones], dtype=np.int64),
+                calibrations=np.array(
+                    [z.calibration for z in zones], dtype=np.float64
+                ).reshape(-1, 2),
+                minima=_concat([z.minima for z in zones], np.int16),
+                maxima=_concat([z.maxima for z in zones], np.int16),
+                sums=_concat([z.sums for z in zones], np.int32),
+                squares=_concat([z.squares for z in zones], np.int64),
+                counts=_concat(
+                    [z.counts for z in zones], np.uint16
+                ).reshape(-1, COARSE_BINS)
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Path) -> 'ZoneMap':
+        with np.load(path) as npz:
+            # every access of an npz member decompresses it again
+            data = {key: npz[key] for key in npz.files}
+        block_size = int(data['block_size'])
+        hist_size = block_size * int(data['hist_blocks'])
+        columns = ('minima', 'maxima', 'sums', 'squares')
+        channels = {}
+        pos = hist_pos = 0
+        for channel, length, calibration in zip(
+            data['channels'], data['lengths'], data['calibrations']
+        ):
+            end = pos - (-int(length) // block_size)
+            hist_end = hist_pos - (-int(length) // hist_size)
+            channels[int(channel)] = ChannelZones(
+                int(length), (float(calibration[0]), float(calibration[1])),
+                *(data[column][pos:end] for column in columns),
+                data['counts'][hist_pos:hist_end]
+            )
+            pos, hist_pos = end, hist_end
+        return cls(
+            str(data['file_hash']), block_size, channels,
+            int(data['hist_blocks'])
+        )
+
+
+def _concat(arrays: List[np.ndarray], dtype: type) -> np.ndarray:
+    if not arrays:
+        return np.zeros(0, dtype=dtype)
+    return np.concatenate(arrays).astype(dtype, copy=False)
+
+
+def channel_zones(
+    chunks: Iterable[np.ndarray], length: int, calibration: Calibration,
+    block_size: int = DEFAULT_BLOCK_SIZE, hist_blocks: int = HIST_BLOCKS
+) -> ChannelZones:
+    # one pass over chunks of ADC codes, cut at multiples of
+    # block_size * hist_blocks
+    hist_size = block_size * hist_blocks
+    coarse_of = np.searchsorted(
+        COARSE_EDGES, code_values(calibration), side='right'
+    ).astype(np.int64)
+    parts = []
+    hists = []
+    for chunk in chunks:
+        full = len(chunk) // block_size * block_size
+        for blocks in (
+            chunk[:full].reshape(-1, block_size), chunk[full:].reshape(1, -1)
+        ):
+            if blocks.size == 0:
+                continue
+            # squares of int16 codes fit into int32
+            wide = blocks.astype(np.int32)
+            parts.append((
+                blocks.min(axis=1), blocks.max(axis=1),
+                wide.sum(axis=1, dtype=np.int64).astype(np.int32),
+                (wide * wide).sum(axis=1, dtype=np.int64)
+            ))
+        # the coarse bin of every sample, shifted to its histogram's bins
+        bins = coarse_of[chunk]
+        bins += np.arange(len(chunk)) // hist_size * COARSE_BINS
+        hists.append(np.bincount(
+            bins, minlength=-(-len(chunk) // hist_size) * COARSE_BINS
+        ).reshape(-1, COARSE_BINS).astype(np.uint16))
+    if not parts:
+        empty = np.zeros(0, dtype=np.int64)
+        return ChannelZones(
+            length, calibration, empty.astype(np.int16),
+            empty.astype(np.int16), empty.astype(np.int32), empty,
+            np.zeros((0, COARSE_BINS), dtype=np.uint16)
+        )
+    return ChannelZones(
+        length, calibration, *(np.concatenate(cols) for cols in zip(*parts)),
+        np.concatenate(hists)
+    )
+
+
+def build_zone_map(
+    fname: str, file_hash: str, block_size: int = DEFAULT_BLOCK_SIZE,
+    paused: Optional[Callable[[], bool]] = None
+) -> ZoneMap:
+    # a histogram fits its uint16 counts, a block sum int32
+    hist_size = block_size * HIST_BLOCKS
+    assert hist_size <= np.iinfo(np.uint16).max
+    chunk_size = max(1, DEFAULT_CHUNK_SIZE // hist_size) * hist_size
+    channels = {}
+    with span("zone_map") as zone_span, BulkFast5(fname) as fh:
+        for channel in range(1, 127):
+            if not fh.has_raw(channel):
+                continue
+            length = raw_length(fh, channel)
+            # straight from the file, a single pass would only evict the
+            # channels of the raw cache
+            channels[channel] = channel_zones(
+                _paused_chunks(iter_raw_chunks(
+                    fh, channel, chunk_size=chunk_size, use_scaling=False,
+                    use_cache=False
+                ), paused),
+                length, get_calibration(fh, channel), block_size
+            )
+            zone_span.add(bytes_read=2 * length)
+    return ZoneMap(file_hash, block_size, channels)
+
+
+def _paused_chunks(
+    chunks: Iterator[np.ndarray], paused: Optional[Callable[[], bool]]
+) -> Iterator[np.ndarray]:
+    # waits between chunks while paused() holds
+    for chunk in chunks:
+        while paused is not None and paused():
+            time.sleep(0.1)
+        yield chunk
+
+
+class ZoneMapStore:
+    # One compressed zone map per bulk file in a directory next to the
+    # experiment database, named by the full hash of the file. A changed
+    # file has a new hash and gets a new map. Maps of hashes unknown to
+    # the database are pruned once the database is opened.
+
+    def __init__(
+        self, directory: Union[str, Path], max_bytes: int = 128 * 2**20
+    ) -> None:
+        self.directory: Path = Path(directory)
+        # largest map kept loaded
+        self.max_bytes: int = max_bytes
+        self._building: Set[str] = set()
+        self._loaded: Optional[ZoneMap] = None
+        self._lock = threading.Lock()
+
+    def _path(self, file_hash: str) -> Path:
+        return self.directory / f"{file_hash}.npz"
+
+    def has(self, file_hash: str) -> bool:
+        return self._path(file_hash).is_file()
+
+    def get(self, file_hash: str) -> Optional[ZoneMap]:
+        # the last map is kept loaded within max_bytes
+        with self._lock:
+            if self._loaded is not None \
+                    and self._loaded.file_hash == file_hash:
+                return self._loaded
+        path = self._path(file_hash)
+        try:
+            zone_map = ZoneMap.load(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            # broken entry, e.g. from an interrupted write, or one with
+            # histograms per block, built again
+            print(e)
+            path.unlink(missing_ok=True)
+            return None
+        if zone_map.file_hash != file_hash:
+            path.unlink(missing_ok=True)
+            return None
+        with self._lock:
+            self._loaded = zone_map if zone_map.nbytes <= self.max_bytes \
+                else None
+        return zone_map
+
+    def put(self, zone_map: ZoneMap) -> None:
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            zone_map.save(self._path(zone_map.file_hash))
+        except OSError as e:
+            print(e)
+
+    def build_async(
+        self, fname: str, file_hash: str,
+        paused: Optional[Callable[[], bool]] = None
+    ) -> Optional[threading.Thread]:
+        # at most one build per file, None if nothing is left to do
+        with self._lock:
+            if file_hash in self._building or self.has(file_hash):
+                return None
+            self._building.add(file_hash)
+
+        def _run():
+            try:
+                self.put(build_zone_map(fname, file_hash, paused=paused))
+            except Exception as e:
+                print(e)
+            finally:
+                with self._lock:
+                    self._building.discard(file_hash)
+
+        thread = threading.Thread(
+            target=_run, name="nanotrace_zone_map", daemon=True
+        )
+        thread.start()
+        return thread
+
+    def remove(self, file_hash: str) -> None:
+        with self._lock:
+            if self._loaded is not None \
+                    and self._loaded.file_hash == file_hash:
+                self._loaded = None
+        try:
+            self._path(file_hash).unlink(missing_ok=True)
+        except OSError as e:
+            print(e)
+
+    def prune(self, file_hashes: Iterable[str]) -> None:
+        # removes the maps of all other files
+        keep = set(file_hashes) | self._building
+        for path in self.directory.glob("*.npz"):
+            if path.stem not in keep:
+                self.remove(path.stem)